@@ -1,8 +1,21 @@
+import os
+
+import anyio
+from broadcast import broadcaster
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routes.demo_routes import router as demo_router
+from routes.sync_routes import router as sync_router
 from routes.todo_routes import router as todo_router
 from starlette.responses import RedirectResponse
+from view import todo_view
+
+# Worker threads that run the routes. The routes use blocking SQLAlchemy sessions, so
+# they are plain functions that FastAPI runs on these threads instead of the event loop.
+API_THREADS = int(os.environ.get("API_THREADS", "20"))
+# "on" serves GET /todo and GET /todo/{client_id}/{todo_id} from an in-memory copy of the
+# todos that follows the change feed, see view.py. It holds every todo in memory.
+TODO_VIEW = os.environ.get("TODO_VIEW", "off")
 
 app = FastAPI()
 
@@ -12,12 +25,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
     allow_credentials=True,
+    # The cursors of the next page and of the changes following GET /todo
+    expose_headers=["X-Next-Cursor", "X-Change-Cursor", "ETag"],
 )
 
 
 @app.on_event("startup")
 async def startup_event():
     global consumer_process
+    anyio.to_thread.current_default_thread_limiter().total_tokens = API_THREADS
+    broadcaster.start(todo_view.load() if TODO_VIEW == "on" else None)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    broadcaster.stop()
 
 
 @app.get("/")
@@ -27,3 +49,4 @@ def main():
 
 app.include_router(demo_router)
 app.include_router(todo_router)
+app.include_router(sync_router)
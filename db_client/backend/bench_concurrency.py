@@ -0,0 +1,110 @@
+"""Benchmark of concurrent requests against a running client backend.
+
+Creates a few todos with POST /todo/bulk, then reads them with GET /todo/{client_id}/{id}
+and GET /todo from 1, 2, 4, ... concurrent workers, each on its own keep-alive
+connection. The todos are deleted at the end, so they only reach the other clients
+for the duration of a run. While the routes blocked the event loop, requests were served one at a
+time and from 16 workers on they timed out waiting for a pooled connection, as the
+blocked loop could not run the cleanups that return them. With the threadpooled routes
+the throughput grows with the workers as long as the backend has idle CPUs and
+database connections, API_THREADS and DB_POOL_SIZE bound it.
+
+Usage: python bench_concurrency.py [base_url] [requests per level] [max concurrency]
+"""
+import http.client
+import json
+import statistics
+import sys
+import threading
+import time
+from typing import List
+from urllib.parse import urlsplit
+
+CLIENT_ID = "bench"
+TODOS = 100
+
+
+def bulk(url, body: dict) -> dict:
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    connection.request(
+        "POST",
+        "/todo/bulk",
+        body=json.dumps(body),
+        headers={"Content-Type": "application/json"},
+    )
+    response = connection.getresponse()
+    assert response.status == 200, response.read()
+    result = json.loads(response.read())
+    connection.close()
+    return result
+
+
+def create_todos(url) -> List[int]:
+    body = {
+        "create": [
+            {"client_id": CLIENT_ID, "title": f"bench {i}", "description": "bench"}
+            for i in range(TODOS)
+        ]
+    }
+    return [result["id"] for result in bulk(url, body)["create"]]
+
+
+def delete_todos(url, ids: List[int]):
+    bulk(url, {"delete": [{"id": todo_id, "client_id": CLIENT_ID} for todo_id in ids]})
+
+
+def worker(url, ids: List[int], count: int, offset: int, latencies: List[float]):
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    for i in range(offset, offset + count):
+        path = f"/todo/{CLIENT_ID}/{ids[i % len(ids)]}" if i % 2 else "/todo?limit=20"
+        start = time.perf_counter()
+        connection.request("GET", path)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200, path
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def run(url, ids: List[int], requests: int, concurrency: int):
+    latencies: List[float] = []
+    per_worker = requests // concurrency
+    threads = [
+        threading.Thread(target=worker, args=(url, ids, per_worker, i * per_worker, latencies))
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(
+        f"{concurrency:>11} {len(latencies) / elapsed:>12,.0f} "
+        f"{p50:>10.1f} {p99:>10.1f}"
+    )
+
+
+def main():
+    url = urlsplit(sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000")
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    max_concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+
+    ids = create_todos(url)
+    try:
+        run(url, ids, min(requests, 200), 1)  # Warm up
+        print(f"{'concurrency':>11} {'requests/s':>12} {'p50 ms':>10} {'p99 ms':>10}")
+        concurrency = 1
+        while concurrency <= max_concurrency:
+            run(url, ids, requests, concurrency)
+            concurrency *= 2
+    finally:
+        delete_todos(url, ids)
+
+
+if __name__ == "__main__":
+    main()
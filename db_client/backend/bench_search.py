@@ -0,0 +1,169 @@
+"""Benchmark of the todo indexes, before and after the full-text search.
+
+Fills a scratch table per index layout with the same random todos and measures the
+bulk inserts, single-row updates in their own transactions and, for the client, the
+search of a word in the titles and descriptions. Before, the only way to search was a
+substring filter, which no btree serves. After, the search matches the GIN index of
+GET /todo/search. The server layouts are the indexes of server/init.sql before and
+after, the sink only writes. The scratch tables are dropped at the end.
+
+Usage: python bench_search.py [todos] [updates] [searches]
+"""
+import itertools
+import random
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+from engine import engine
+from models.todos import SEARCH_DOCUMENT
+from sqlalchemy import text
+
+TABLE = "bench_search_todos"
+
+LAYOUTS: Dict[str, List[str]] = {
+    "client before": [
+        "CREATE INDEX ON {table}(client_id, id)",
+        "CREATE INDEX ON {table}(title text_pattern_ops)",
+        "CREATE INDEX ON {table}(description)",
+        "CREATE INDEX ON {table}(completed, client_id, id)",
+    ],
+    "client after": [
+        "CREATE INDEX ON {table}(client_id, id)",
+        "CREATE INDEX ON {table}(title text_pattern_ops)",
+        "CREATE INDEX ON {table}(completed, client_id, id)",
+        "CREATE INDEX ON {table} USING GIN (" + SEARCH_DOCUMENT + ")",
+    ],
+    "server before": [
+        "CREATE INDEX ON {table}(client_id)",
+        "CREATE INDEX ON {table}(title)",
+        "CREATE INDEX ON {table}(description)",
+        "CREATE INDEX ON {table}(completed)",
+    ],
+    "server after": [],
+}
+
+SEARCHES = {
+    "client before": (
+        f"SELECT id FROM {TABLE} WHERE title ILIKE :pattern OR description ILIKE :pattern "
+        "LIMIT 20"
+    ),
+    "client after": (
+        f"SELECT id FROM {TABLE} "
+        f"WHERE {SEARCH_DOCUMENT} @@ websearch_to_tsquery('simple', :q) "
+        f"ORDER BY ts_rank({SEARCH_DOCUMENT}, websearch_to_tsquery('simple', :q)) DESC "
+        "LIMIT 20"
+    ),
+}
+
+# Word frequencies follow Zipf's law like in natural text, so most words searched for
+# are rare and a few are in most todos
+WORDS = [f"word{i}" for i in range(50000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
+
+
+def random_text(words: int) -> str:
+    return " ".join(random.choices(WORDS, cum_weights=CUM_WEIGHTS, k=words))
+
+
+def create_table(connection, layout: str):
+    connection.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    connection.execute(
+        text(
+            f"CREATE TABLE {TABLE} (id SERIAL, client_id VARCHAR NOT NULL, title VARCHAR, "
+            "description VARCHAR, completed BOOLEAN, PRIMARY KEY (id, client_id))"
+        )
+    )
+    for index in LAYOUTS[layout]:
+        connection.execute(text(index.format(table=TABLE)))
+    connection.commit()
+
+
+def insert(connection, todos: List[dict]) -> float:
+    start = time.perf_counter()
+    for i in range(0, len(todos), 1000):
+        connection.execute(
+            text(
+                f"INSERT INTO {TABLE} (client_id, title, description, completed) "
+                "VALUES (:client_id, :title, :description, :completed)"
+            ),
+            todos[i : i + 1000],
+        )
+        connection.commit()
+    return len(todos) / (time.perf_counter() - start)
+
+
+def update(connection, count: int, todos: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        connection.execute(
+            text(
+                f"UPDATE {TABLE} SET title = :title, description = :description, "
+                "completed = NOT completed WHERE id = :id AND client_id = 'bench'"
+            ),
+            {
+                "id": random.randint(1, todos),
+                "title": random_text(4),
+                "description": random_text(40),
+            },
+        )
+        connection.commit()
+    return count / (time.perf_counter() - start)
+
+
+def search(connection, layout: str, count: int) -> List[float]:
+    connection.execute(text(f"ANALYZE {TABLE}"))
+    latencies = []
+    for _ in range(count):
+        word = random.choice(WORDS)
+        start = time.perf_counter()
+        connection.execute(text(SEARCHES[layout]), {"pattern": f"%{word}%", "q": word}).all()
+        latencies.append(time.perf_counter() - start)
+    connection.rollback()
+    return sorted(latencies)
+
+
+def main():
+    todos = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    searches = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    random.seed(0)
+    rows = [
+        {
+            "client_id": "bench",
+            "title": random_text(4),
+            "description": random_text(random.randint(20, 60)),
+            "completed": random.random() < 0.5,
+        }
+        for _ in range(todos)
+    ]
+
+    print(
+        f"{'layout':<14} {'inserts/s':>10} {'updates/s':>10} "
+        f"{'search p50 ms':>14} {'search p99 ms':>14}"
+    )
+    with engine.connect() as connection:
+        try:
+            for layout in LAYOUTS:
+                create_table(connection, layout)
+                inserts_per_second = insert(connection, rows)
+                updates_per_second = update(connection, updates, todos)
+                p50 = p99 = "-"
+                if layout in SEARCHES:
+                    latencies = search(connection, layout, searches)
+                    p50 = f"{statistics.median(latencies) * 1000:.2f}"
+                    p99 = f"{latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f}"
+                print(
+                    f"{layout:<14} {inserts_per_second:>10,.0f} {updates_per_second:>10,.0f} "
+                    f"{p50:>14} {p99:>14}"
+                )
+        finally:
+            connection.rollback()
+            connection.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+            connection.commit()
+
+
+if __name__ == "__main__":
+    main()
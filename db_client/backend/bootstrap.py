@@ -0,0 +1,108 @@
+import logging
+import os
+import tempfile
+from typing import Dict
+
+from confluent_kafka import Consumer, TopicPartition
+from crud import CRUDSyncOffset
+from engine import db_session
+from rows import ROW_FIELDS
+from sqlalchemy import create_engine, text
+
+server_pg_host = os.environ.get("SERVER_POSTGRES_HOST", "server-postgres")
+server_pg_port = os.environ.get("SERVER_POSTGRES_PORT", "5432")
+server_pg_user = os.environ.get("SERVER_POSTGRES_USER", "postgres")
+server_pg_password = os.environ.get("SERVER_POSTGRES_PASSWORD", "postgres")
+
+# The snapshot is buffered in memory up to this size, larger snapshots spill to disk
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+crud_sync_offset = CRUDSyncOffset()
+
+COLUMNS = ", ".join(ROW_FIELDS)
+
+
+def needs_bootstrap(server_topic: str) -> bool:
+    """A client that has never stored an offset of the server topic is new or was wiped."""
+    with db_session() as db:
+        return not crud_sync_offset.get_all(db, topic=server_topic)
+
+
+def get_high_watermarks(bootstrap_servers: str, server_topic: str) -> Dict[int, int]:
+    """Get the offset following the last message of every partition of the topic."""
+    consumer = Consumer(
+        {"bootstrap.servers": bootstrap_servers, "group.id": "bootstrap"}
+    )
+    try:
+        metadata = consumer.list_topics(server_topic, timeout=10)
+        partitions = metadata.topics[server_topic].partitions
+        return {
+            partition: consumer.get_watermark_offsets(
+                TopicPartition(server_topic, partition), timeout=10
+            )[1]
+            for partition in partitions
+        }
+    finally:
+        consumer.close()
+
+
+def bootstrap_from_snapshot(bootstrap_servers: str, server_topic: str, client_id: str):
+    """Loads the server's todos and starts the sync at the matching server topic offsets.
+
+    The high watermarks of the server topic are read before the snapshot is taken, so
+    every event before them is contained in the snapshot. Events after them may be
+    contained as well and are applied again by the sync, which the LWW strategy
+    tolerates. The snapshot is streamed with COPY from the server database into a
+    temporary table and merged into `todos` in the transaction that stores the offsets.
+    Rows that exist locally are kept, they are still to be synced through the topic.
+    """
+    offsets = get_high_watermarks(bootstrap_servers, server_topic)
+    logging.info(f"Bootstrapping from a snapshot at offsets {offsets}")
+
+    server_engine = create_engine(
+        f"postgresql://{server_pg_user}:{server_pg_password}@{server_pg_host}:{server_pg_port}"
+    )
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as snapshot:
+        server_conn = server_engine.raw_connection()
+        try:
+            with server_conn.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY (SELECT {COLUMNS} FROM todos) TO STDOUT", snapshot
+                )
+        finally:
+            server_conn.close()
+        server_engine.dispose()
+        snapshot.seek(0)
+
+        with db_session() as db:
+            db.execute(
+                text("CREATE TEMP TABLE todos_snapshot (LIKE todos) ON COMMIT DROP")
+            )
+            cursor = db.connection().connection.cursor()
+            cursor.copy_expert(f"COPY todos_snapshot ({COLUMNS}) FROM STDIN", snapshot)
+            loaded = db.execute(
+                text(
+                    f"INSERT INTO todos ({COLUMNS}) SELECT {COLUMNS} FROM todos_snapshot "
+                    "ON CONFLICT (id, client_id) DO NOTHING"
+                )
+            ).rowcount
+            # New todos of this client must not reuse the ids of its restored todos
+            db.execute(
+                text(
+                    "SELECT setval('todos_id_seq', "
+                    "GREATEST(max(id), (SELECT last_value FROM todos_id_seq))) "
+                    "FROM todos WHERE client_id = :client_id HAVING max(id) IS NOT NULL"
+                ),
+                {"client_id": client_id},
+            )
+            for partition, offset in offsets.items():
+                crud_sync_offset.store(
+                    db,
+                    topic=server_topic,
+                    partition=partition,
+                    offset=offset,
+                    commit=False,
+                )
+            db.commit()
+
+    logging.info(f"Bootstrapped {loaded} todos from the server snapshot")
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import select
+import threading
+from typing import AsyncIterator, Callable, List, Optional, Set, Tuple, Union
+
+from crud import CRUDTodo
+from engine import db_session, engine
+from models import TodoDeletionORM, TodoORM
+from schemas import Todo, TodoChange
+from starlette.concurrency import run_in_threadpool
+
+crud_todo = CRUDTodo(TodoORM)
+
+# Notified with the transaction id of every statement that writes todos, see init.sql
+CHANNEL = "todo_changes"
+
+# The changes following a cursor, and the cursor following them
+Batch = Tuple[Tuple, List[Tuple[Tuple, TodoChange]]]
+
+
+def todo_change(change: Union[TodoORM, TodoDeletionORM]) -> TodoChange:
+    if isinstance(change, TodoDeletionORM):
+        return TodoChange(id=change.id, client_id=change.client_id, deleted=True)
+    return TodoChange(id=change.id, client_id=change.client_id, todo=Todo.model_validate(change))
+
+
+def change_key(change: Union[TodoORM, TodoDeletionORM]) -> Tuple:
+    return change.change_seq, change.client_id, change.id
+
+
+def _order(cursor: Tuple) -> Tuple:
+    # A (change_seq,) horizon precedes every key with that change_seq
+    return (cursor[0], 0) if len(cursor) == 1 else (cursor[0], 1) + tuple(cursor[1:])
+
+
+def read_batches(after: Tuple, batch_size: int) -> List[Batch]:
+    """Reads the change feed from `after` up to the current horizon."""
+    batches = []
+    with db_session() as db:
+        has_more = True
+        while has_more:
+            changes, after, has_more = crud_todo.read_changes(db, after=after, limit=batch_size)
+            batches.append(
+                (after, [(change_key(change), todo_change(change)) for change in changes])
+            )
+            db.rollback()  # Ends the transaction, the next page reads a newer horizon
+    return batches
+
+
+class Subscription:
+    """The changes for one stream, handed over by the broadcaster on the event loop.
+
+    If the stream falls `max_queued` batches behind, the broadcaster drops its batches
+    and the stream reads the missed changes from the change feed instead.
+    """
+
+    def __init__(self, after: Optional[Tuple], max_queued: int, batch_size: int):
+        self.after = after
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        # Set while the changes following `after` must be read from the change feed
+        self.catch_up = after is not None
+
+    def put(self, batch: Batch):
+        try:
+            self.queue.put_nowait(batch)
+        except asyncio.QueueFull:
+            self.catch_up = True
+
+    async def changes(
+        self, keepalive: float
+    ) -> AsyncIterator[Optional[Tuple[Tuple, TodoChange]]]:
+        """Yields the changes with the cursor following them, None every `keepalive`
+        seconds without changes."""
+        while True:
+            if self.catch_up:
+                self.catch_up = False
+                for batch in await run_in_threadpool(read_batches, self.after, self.batch_size):
+                    for item in self._apply(batch):
+                        yield item
+            try:
+                batch = await asyncio.wait_for(self.queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            for item in self._apply(batch):
+                yield item
+
+    def _apply(self, batch: Batch) -> List[Tuple[Tuple, TodoChange]]:
+        # Skips the changes a catch-up has returned already
+        end, items = batch
+        items = [(key, change) for key, change in items if _order(key) > _order(self.after)]
+        if items:
+            self.after = items[-1][0]
+        if _order(end) > _order(self.after):
+            self.after = end
+        return items
+
+
+class ChangeBroadcaster:
+    """Pushes the changes of the todos to subscribers, the streams of GET /todo/events.
+
+    Every transaction that writes todos, local or from the sync worker, notifies CHANNEL
+    with its id when it commits. The broadcaster LISTENs on a dedicated connection and
+    reads the change feed once per notification for all subscribers. A change that is not
+    final yet, see CRUDTodo.change_horizon, is read again every `retry_interval` seconds.
+
+    Listeners get every read of the change feed on the broadcaster thread, before the
+    subscribers, see `add_listener`.
+    """
+
+    def __init__(
+        self, max_queued: int = 100, batch_size: int = 1000, retry_interval: float = 1.0
+    ):
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._subscriptions: Set[Tuple[Subscription, asyncio.AbstractEventLoop]] = set()
+        self._position: Optional[Tuple] = None
+        self._listeners: List[Callable[[List[Batch]], None]] = []
+        self._stop = threading.Event()
+        # Written to by `wake` to interrupt waiting for notifications
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, after: Optional[Tuple] = None):
+        """Starts broadcasting the changes following `after`, or the changes from now on."""
+        if after is None:
+            with db_session() as db:
+                after = (crud_todo.change_horizon(db),)
+        self._position = after
+        self._thread = threading.Thread(target=self._run, name="broadcast", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wake()
+        if self._thread is not None:
+            self._thread.join()
+
+    def add_listener(self, listener: Callable[[List[Batch]], None]):
+        """Calls `listener` on the broadcaster thread with the batches of every read of the
+        change feed. If it raises, the same changes are read and passed again."""
+        self._listeners.append(listener)
+
+    def wake(self):
+        """Reads the change feed once more, even without a notification."""
+        os.write(self._wake_write, b"\0")
+
+    def subscribe(self, after: Optional[Tuple] = None) -> Subscription:
+        """Subscribes the running event loop to the changes following `after`, or to the
+        changes from now on."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            subscription = Subscription(
+                after if after is not None else self._position, self.max_queued, self.batch_size
+            )
+            self._subscriptions.add((subscription, loop))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions = {
+                (s, loop) for s, loop in self._subscriptions if s is not subscription
+            }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logging.exception("Broadcasting todo changes failed, listening again")
+                self._stop.wait(self.retry_interval)
+
+    def _listen(self):
+        connection = engine.raw_connection()
+        connection.detach()  # LISTENs for as long as the broadcaster runs
+        try:
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            # Changes committed before LISTEN are read right away
+            pending: Optional[int] = -1
+            while not self._stop.is_set():
+                if pending is not None:
+                    self._broadcast()
+                    if self._position[0] > pending:
+                        pending = None
+                timeout = self.retry_interval if pending is not None else 5.0
+                readable = select.select([dbapi_connection, self._wake_read], [], [], timeout)[0]
+                if self._wake_read in readable:
+                    os.read(self._wake_read, 1024)
+                    pending = -1 if pending is None else pending
+                if dbapi_connection in readable:
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        txid = int(dbapi_connection.notifies.pop().payload)
+                        pending = txid if pending is None else max(pending, txid)
+        finally:
+            connection.close()
+
+    def _broadcast(self):
+        batches = read_batches(self._position, self.batch_size)
+        for listener in self._listeners:
+            listener(batches)
+        for batch in batches:
+            with self._lock:
+                self._position = batch[0]
+                subscriptions = list(self._subscriptions)
+            if not batch[1]:
+                continue
+            for subscription, loop in subscriptions:
+                try:
+                    loop.call_soon_threadsafe(subscription.put, batch)
+                except RuntimeError:  # The loop is closed
+                    self.unsubscribe(subscription)
+
+
+broadcaster = ChangeBroadcaster()
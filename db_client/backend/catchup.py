@@ -0,0 +1,149 @@
+import io
+import logging
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from confluent_kafka import Consumer, Message, TopicPartition
+from events import MsgType
+from metrics import CATCHUP_ACTIVE, CONFLICTS, EVENTS_APPLIED
+from rows import ROW_FIELDS, row_from_dict
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+Event = Tuple[MsgType, Tuple[Dict, Dict]]
+
+STAGING_TABLE = "todos_catchup"
+STAGING_COLUMNS = ("op",) + ROW_FIELDS
+_OPS = {MsgType.CREATE: "c", MsgType.UPDATE: "u", MsgType.DELETE: "d"}
+
+_COLUMNS = ", ".join(ROW_FIELDS)
+# Every column but the key, like the updates of LWWStrategy_Client with TodoSync
+_SET_COLUMNS = ", ".join(f"{field} = excluded.{field}" for field in ROW_FIELDS[2:])
+_CREATE_STAGING = (
+    f"CREATE TEMP TABLE {STAGING_TABLE} ON COMMIT DROP AS "
+    f"SELECT ''::text AS op, * FROM todos WITH NO DATA"
+)
+# The statements of `bulk_merge`. Every key is staged once. A delete stages the
+# `updated_at` of its before row, a local row changed after it blocks the delete.
+_MERGE_DELETES = (
+    f"DELETE FROM todos t USING {STAGING_TABLE} s WHERE s.op = 'd' "
+    "AND t.id = s.id AND t.client_id = s.client_id AND t.updated_at <= s.updated_at"
+)
+_MERGE_CREATES = (
+    f"INSERT INTO todos ({_COLUMNS}) SELECT {_COLUMNS} FROM {STAGING_TABLE} "
+    f"WHERE op = 'c' ON CONFLICT (id, client_id) DO UPDATE SET {_SET_COLUMNS} "
+    "WHERE excluded.updated_at > todos.updated_at"
+)
+_MERGE_UPDATES = (
+    f"INSERT INTO todos ({_COLUMNS}) SELECT {_COLUMNS} FROM {STAGING_TABLE} "
+    f"WHERE op = 'u' ON CONFLICT (id, client_id) DO UPDATE SET {_SET_COLUMNS}"
+)
+
+
+class CatchUp:
+    """Decides from the consumer lag whether the sync is catching up on a backlog.
+
+    The lag is the number of messages between the consumed messages and the high
+    watermarks of their partitions, as last reported by the brokers. Catch-up starts
+    once it reaches `lag_threshold` and ends when it falls below `lag_threshold / 10`.
+    Polls that return nothing, e.g. while partitions are paused, keep the mode.
+    """
+
+    def __init__(self, lag_threshold: int, batch_size: int = 1000):
+        self.lag_threshold = lag_threshold
+        self.batch_size = batch_size
+        self.active = False
+
+    def update(self, consumer: Consumer, msgs: List[Message]):
+        """Updates the mode after consuming `msgs`."""
+        if not msgs:
+            return
+        lag = consumer_lag(consumer, msgs)
+        if not self.active and lag >= self.lag_threshold:
+            logging.info(f"Consumer lag is {lag} messages. Catching up with bulk merges")
+            self.active = True
+        elif self.active and lag < self.lag_threshold / 10:
+            logging.info(f"Consumer lag is {lag} messages. Caught up")
+            self.active = False
+        CATCHUP_ACTIVE.set(int(self.active))
+
+
+def consumer_lag(consumer: Consumer, msgs: List[Message]) -> int:
+    """Get the messages behind the last consumed message of every partition of `msgs`."""
+    lag = 0
+    for (topic, partition), position in next_offsets(msgs).items():
+        _, high = consumer.get_watermark_offsets(TopicPartition(topic, partition), cached=True)
+        if high >= 0:
+            lag += max(high - position, 0)
+    return lag
+
+
+def next_offsets(msgs: List[Message]) -> Dict[Tuple[str, int], int]:
+    """Get the offset following the last message of every partition."""
+    return {(msg.topic(), msg.partition()): msg.offset() + 1 for msg in msgs}
+
+
+def staged_rows(events: List[Event]) -> List[Tuple]:
+    """Get one row per key in the order of STAGING_COLUMNS.
+
+    The server decided every event with LWW already, so the last event of a key is its
+    net effect. A delete stages its before row.
+    """
+    rows: Dict[Tuple[int, str], Tuple] = {}
+    for msg_type, msg in events:
+        payload = msg[1].get("payload", {})
+        obj = payload.get("before") if msg_type == MsgType.DELETE else payload.get("after")
+        row = row_from_dict(obj or {})
+        key_payload = msg[0].get("payload", {})
+        key = (key_payload.get("id"), key_payload.get("client_id"))
+        rows.pop(key, None)  # Keep the keys in the order of their last event
+        rows[key] = (_OPS[msg_type],) + key + row[2:]
+    return list(rows.values())
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def bulk_merge(db: Session, events: List[Event]):
+    """Applies the events of the server topic with set-based statements, without committing.
+
+    The rows are streamed into a temporary table with COPY and merged into `todos` with
+    one statement per op, with the decisions of LWWStrategy_Client: the server has
+    authority over updates, a create only overwrites an older local row and a delete is
+    blocked by local changes that are newer than the deleted row.
+    """
+    rows = staged_rows(events)
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row) + "\n")
+    buffer.seek(0)
+
+    db.execute(text(_CREATE_STAGING))
+    cursor = db.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {STAGING_TABLE} ({', '.join(STAGING_COLUMNS)}) FROM STDIN", buffer
+    )
+    deleted = db.execute(text(_MERGE_DELETES)).rowcount
+    db.execute(text(_MERGE_CREATES))
+    db.execute(text(_MERGE_UPDATES))
+
+    for msg_type in _OPS:
+        EVENTS_APPLIED.labels(op=msg_type.name.lower()).inc(
+            sum(1 for event_type, _ in events if event_type == msg_type)
+        )
+    CONFLICTS.labels(type="blocked_delete").inc(
+        sum(1 for row in rows if row[0] == "d") - deleted
+    )
@@ -1,11 +1,38 @@
-from typing import Generic, List, Optional, Type, TypeVar
+import os
+from datetime import datetime, timedelta
+from typing import (
+    Dict,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
-from models import TodoORM, User
+from models import (
+    DeadLetterORM,
+    SyncOffsetORM,
+    SyncStatusORM,
+    TodoDeletionORM,
+    TodoORM,
+    User,
+)
+from models.todos import SEARCH_DOCUMENT
 from pydantic import BaseModel
-from schemas.todos import TodoCreate, TodoUpdate
+from schemas.todos import TodoBulkUpdate, TodoCreate, TodoUpdate
 from schemas.users import UserCreate, UserUpdate
+from sqlalchemy import Select, String, delete, func, literal_column, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Row
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased
+
+CLIENT_ID = os.environ.get("CLIENT_ID")
 
 ModelType = TypeVar("ModelType")  # database model type
 CreateSchemaType = TypeVar(
@@ -32,10 +59,14 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
     ) -> List[ModelType]:
         return db.query(self.model).offset(skip).limit(limit).all()
 
-    def create(self, db: Session, *, obj_in: CreateSchemaType) -> ModelType:
+    def create(
+        self, db: Session, *, obj_in: CreateSchemaType, commit: bool = True
+    ) -> ModelType:
         obj_in_data = obj_in.dict()
         db_obj = self.model(**obj_in_data)
         db.add(db_obj)
+        if not commit:
+            return db_obj
         try:
             db.commit()
             db.refresh(db_obj)
@@ -45,12 +76,19 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             raise e
 
     def update(
-        self, db: Session, *, db_obj: ModelType, obj_in: UpdateSchemaType
+        self,
+        db: Session,
+        *,
+        db_obj: ModelType,
+        obj_in: UpdateSchemaType,
+        commit: bool = True,
     ) -> ModelType:
         obj_data = obj_in.dict()
         for attr, value in obj_data.items():
             if hasattr(db_obj, attr):
                 setattr(db_obj, attr, value)
+        if not commit:
+            return db_obj
         try:
             db.commit()
             return db_obj
@@ -72,13 +110,17 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             db.rollback()
             raise e
 
-    def delete(self, db: Session, *, id: int, client_id: str) -> ModelType:
+    def delete(
+        self, db: Session, *, id: int, client_id: str, commit: bool = True
+    ) -> ModelType:
         obj = (
             db.query(self.model)
             .filter(self.model.id == id, self.model.client_id == client_id)
             .first()
         )
         db.delete(obj)
+        if not commit:
+            return obj
         try:
             db.commit()
             return obj
@@ -92,4 +134,508 @@ class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
 
 
 class CRUDTodo(CRUDBase[TodoORM, TodoCreate, TodoUpdate]):
-    pass
+    """Todos created or changed through the API (TodoCreate, TodoUpdate) are stamped with
+    this client as their origin. The sync handler writes TodoSync objects, which keep the
+    origin of the event."""
+
+    def create(
+        self, db: Session, *, obj_in: TodoCreate, commit: bool = True
+    ) -> TodoORM:
+        db_obj = super().create(db, obj_in=obj_in, commit=False)
+        if isinstance(obj_in, TodoCreate):
+            db_obj.origin = CLIENT_ID
+        if not commit:
+            return db_obj
+        try:
+            db.commit()
+            db.refresh(db_obj)
+            return db_obj
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    def update(
+        self,
+        db: Session,
+        *,
+        db_obj: TodoORM,
+        obj_in: TodoUpdate,
+        commit: bool = True,
+    ) -> TodoORM:
+        if isinstance(obj_in, TodoUpdate):
+            db_obj.origin = CLIENT_ID
+        return super().update(db, db_obj=db_obj, obj_in=obj_in, commit=commit)
+
+    def patch(self, db: Session, *, db_obj: TodoORM, obj_in: TodoUpdate) -> TodoORM:
+        if isinstance(obj_in, TodoUpdate):
+            db_obj.origin = CLIENT_ID
+        return super().patch(db, db_obj=db_obj, obj_in=obj_in)
+
+    def _select_page(
+        self,
+        columns: Sequence,
+        *,
+        after: Optional[Tuple[str, int]] = None,
+        completed: Optional[bool] = None,
+        title_prefix: Optional[str] = None,
+    ) -> Select:
+        stmt = select(*columns)
+        if after is not None:
+            stmt = stmt.where(tuple_(self.model.client_id, self.model.id) > tuple_(*after))
+        if completed is not None:
+            stmt = stmt.where(self.model.completed == completed)
+        if title_prefix:
+            stmt = stmt.where(self.model.title.startswith(title_prefix, autoescape=True))
+        return stmt.order_by(self.model.client_id, self.model.id)
+
+    def get_page(
+        self,
+        db: Session,
+        *,
+        after: Optional[Tuple[str, int]] = None,
+        limit: int = 100,
+        completed: Optional[bool] = None,
+        title_prefix: Optional[str] = None,
+    ) -> List[TodoORM]:
+        """Get the todos following the (client_id, id) key `after` in key order.
+
+        Pages are read with an index range scan on (client_id, id), so every page costs
+        the same no matter how deep it is.
+        """
+        stmt = self._select_page(
+            [self.model], after=after, completed=completed, title_prefix=title_prefix
+        )
+        return list(db.scalars(stmt.limit(limit)))
+
+    def get_page_rows(
+        self,
+        db: Session,
+        *,
+        fields: Sequence[str],
+        after: Optional[Tuple[str, int]] = None,
+        limit: int = 100,
+        completed: Optional[bool] = None,
+        title_prefix: Optional[str] = None,
+    ) -> List[Row]:
+        """`get_page` reading only the columns `fields` as rows, without ORM objects."""
+        stmt = self._select_page(
+            [getattr(self.model, field) for field in fields],
+            after=after,
+            completed=completed,
+            title_prefix=title_prefix,
+        )
+        return list(db.execute(stmt.limit(limit)))
+
+    def stream_rows(
+        self,
+        db: Session,
+        *,
+        fields: Sequence[str],
+        completed: Optional[bool] = None,
+        title_prefix: Optional[str] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Sequence[Row]]:
+        """Get the columns `fields` of every todo in key order, in batches of `batch_size`
+        rows fetched from a server-side cursor."""
+        stmt = self._select_page(
+            [getattr(self.model, field) for field in fields],
+            completed=completed,
+            title_prefix=title_prefix,
+        )
+        result = db.execute(stmt, execution_options={"yield_per": batch_size})
+        yield from result.partitions()
+
+    def search_rows(
+        self, db: Session, *, fields: Sequence[str], q: str, limit: int = 20
+    ) -> List[Row]:
+        """Get the columns `fields` of the todos whose title or description match the web
+        search query `q`, best matches first.
+
+        The query matches SEARCH_DOCUMENT, the expression of the GIN index
+        idx_todos_search, so only the matching rows are read and ranked.
+        """
+        document = literal_column(SEARCH_DOCUMENT)
+        query = func.websearch_to_tsquery("simple", q)
+        stmt = (
+            select(*[getattr(self.model, field) for field in fields])
+            .where(document.bool_op("@@")(query))
+            .order_by(
+                func.ts_rank(document, query).desc(), self.model.client_id, self.model.id
+            )
+            .limit(limit)
+        )
+        return list(db.execute(stmt))
+
+    def get_many(
+        self, db: Session, *, keys: List[Tuple[int, str]]
+    ) -> Dict[Tuple[int, str], TodoORM]:
+        """Get the todos with the (id, client_id) keys, in one query."""
+        if not keys:
+            return {}
+        rows = (
+            db.query(self.model)
+            .filter(tuple_(self.model.id, self.model.client_id).in_(keys))
+            .all()
+        )
+        return {(row.id, row.client_id): row for row in rows}
+
+    def bulk_write(
+        self,
+        db: Session,
+        *,
+        create: List[TodoCreate],
+        update: List[TodoBulkUpdate],
+        delete_keys: List[Tuple[int, str]],
+    ) -> Tuple[List[TodoORM], List[Optional[TodoORM]], List[Optional[Row]]]:
+        """Creates, updates and deletes todos in one transaction and commits it.
+
+        The creates are inserted with one multi-row INSERT, the updates are flushed as one
+        executemany and the deletes are one DELETE, a key must not be both updated and
+        deleted. Returns the created todos, the updated ones and the rows of the deleted
+        ones, with None for keys that do not exist.
+        """
+        try:
+            created = [self.create(db, obj_in=obj_in, commit=False) for obj_in in create]
+            found = self.get_many(db, keys=[(obj_in.id, obj_in.client_id) for obj_in in update])
+            updated = []
+            for obj_in in update:
+                db_obj = found.get((obj_in.id, obj_in.client_id))
+                if db_obj is not None:
+                    fields = TodoUpdate(**obj_in.model_dump(exclude={"id", "client_id"}))
+                    self.update(db, db_obj=db_obj, obj_in=fields, commit=False)
+                updated.append(db_obj)
+            db.flush()
+            written = [(db_obj.id, db_obj.client_id) for db_obj in created + updated if db_obj]
+
+            deleted: Dict[Tuple[int, str], Row] = {}
+            if delete_keys:
+                rows = db.execute(
+                    delete(self.model)
+                    .where(tuple_(self.model.id, self.model.client_id).in_(delete_keys))
+                    .returning(*self.model.__table__.columns)
+                    .execution_options(synchronize_session=False)
+                )
+                deleted = {(row.id, row.client_id): row for row in rows}
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+        # Reloads the committed todos in one query instead of one per expired todo
+        self.get_many(db, keys=written)
+        return created, updated, [deleted.get(key) for key in delete_keys]
+
+    def snapshot(self, db: Session) -> str:
+        """Get the current transaction snapshot of the database.
+
+        It changes whenever a transaction gets an id or finishes, so no commit can happen
+        between two reads that see the same snapshot. Reading it touches no table.
+        """
+        return db.execute(select(func.txid_current_snapshot().cast(String))).scalar_one()
+
+    def change_horizon(self, db: Session) -> int:
+        """Get the oldest transaction id that may still be running.
+
+        Every transaction with a lower id has finished, so the changes stamped with them
+        are final, see init.sql.
+        """
+        return db.execute(
+            select(func.txid_snapshot_xmin(func.txid_current_snapshot()))
+        ).scalar_one()
+
+    def get_changes(
+        self,
+        db: Session,
+        *,
+        after: Tuple,
+        horizon: int,
+        limit: int = 100,
+    ) -> List[Union[TodoORM, TodoDeletionORM]]:
+        """Get the todos and deletions following `after` in (change_seq, client_id, id)
+        order, with a change_seq below `horizon`.
+
+        `after` is a full key, or `(change_seq,)` for every change from that change_seq on.
+        """
+        changes: List[Union[TodoORM, TodoDeletionORM]] = []
+        for model in (self.model, TodoDeletionORM):
+            query = db.query(model).filter(model.change_seq < horizon)
+            if len(after) == 1:
+                query = query.filter(model.change_seq >= after[0])
+            else:
+                query = query.filter(
+                    tuple_(model.change_seq, model.client_id, model.id) > tuple_(*after)
+                )
+            changes += (
+                query.order_by(model.change_seq, model.client_id, model.id)
+                .limit(limit)
+                .all()
+            )
+        changes.sort(key=lambda change: (change.change_seq, change.client_id, change.id))
+        return changes[:limit]
+
+    def read_changes(
+        self, db: Session, *, after: Tuple, limit: int = 100
+    ) -> Tuple[List[Union[TodoORM, TodoDeletionORM]], Tuple, bool]:
+        """Get up to `limit` final changes following `after`, the cursor following them and
+        whether more final changes follow.
+
+        If none follow, the cursor is the current horizon, see `change_horizon`.
+        """
+        horizon = self.change_horizon(db)
+        changes = self.get_changes(db, after=after, horizon=horizon, limit=limit + 1)
+        if len(changes) > limit:
+            last = changes[limit - 1]
+            return changes[:limit], (last.change_seq, last.client_id, last.id), True
+        return changes, (max(horizon, after[0]),), False
+
+    def get_recent_changes(
+        self, db: Session, *, since: int
+    ) -> List[Union[TodoORM, TodoDeletionORM]]:
+        """Get the todos and deletions with a change_seq from `since` on, also the ones
+        that are not final yet.
+
+        The deletions are read after the todos. A key can only be found in both if it was
+        deleted in between, so the deletion is the newer change of the two.
+        """
+        todos = db.query(self.model).filter(self.model.change_seq >= since).all()
+        deletions = (
+            db.query(TodoDeletionORM).filter(TodoDeletionORM.change_seq >= since).all()
+        )
+        return [*todos, *deletions]
+
+
+class CRUDSyncOffset:
+    def __init__(self, model: Type[SyncOffsetORM] = SyncOffsetORM):
+        self.model = model
+
+    def get_all(self, db: Session, *, topic: str) -> Dict[int, int]:
+        """Get the stored next offset of every partition of a topic."""
+        rows = db.query(self.model).filter(self.model.topic == topic).all()
+        return {row.partition: row.offset for row in rows}
+
+    def store(
+        self,
+        db: Session,
+        *,
+        topic: str,
+        partition: int,
+        offset: int,
+        commit: bool = True,
+    ):
+        """Stores the next offset to consume for a partition."""
+        stmt = insert(self.model).values(topic=topic, partition=partition, offset=offset)
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["topic", "partition"],
+                set_={"offset": stmt.excluded.offset},
+            )
+        )
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+
+class CRUDSyncStatus:
+    def __init__(self, model: Type[SyncStatusORM] = SyncStatusORM):
+        self.model = model
+
+    def get_all(self, db: Session) -> List[SyncStatusORM]:
+        return db.query(self.model).order_by(self.model.topic, self.model.partition).all()
+
+    def publish(
+        self,
+        db: Session,
+        *,
+        topic: str,
+        partition: int,
+        high_watermark: Optional[int],
+        applied_per_second: float,
+        last_applied_at: Optional[datetime],
+        last_event_at: Optional[datetime],
+        commit: bool = True,
+    ):
+        """Stores the status of a partition. Unknown values keep the previously stored ones."""
+        stmt = insert(self.model).values(
+            topic=topic,
+            partition=partition,
+            high_watermark=high_watermark,
+            applied_per_second=applied_per_second,
+            last_applied_at=last_applied_at,
+            last_event_at=last_event_at,
+            reported_at=func.now(),
+        )
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["topic", "partition"],
+                set_={
+                    "high_watermark": func.coalesce(
+                        stmt.excluded.high_watermark, self.model.high_watermark
+                    ),
+                    "applied_per_second": stmt.excluded.applied_per_second,
+                    "last_applied_at": func.coalesce(
+                        stmt.excluded.last_applied_at, self.model.last_applied_at
+                    ),
+                    "last_event_at": func.coalesce(
+                        stmt.excluded.last_event_at, self.model.last_event_at
+                    ),
+                    "reported_at": stmt.excluded.reported_at,
+                },
+            )
+        )
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+
+class CRUDDeadLetter:
+    def __init__(self, model: Type[DeadLetterORM] = DeadLetterORM):
+        self.model = model
+
+    def add(
+        self,
+        db: Session,
+        *,
+        topic: str,
+        partition: int,
+        offset: int,
+        todo_key: Optional[Tuple[int, str]],
+        key: Optional[bytes],
+        value: Optional[bytes],
+        error: str,
+        commit: bool = True,
+    ):
+        """Stores a message unless it is already stored, e.g. when it is consumed again."""
+        todo_id, todo_client_id = todo_key or (None, None)
+        db.execute(
+            insert(self.model)
+            .values(
+                topic=topic,
+                partition=partition,
+                offset=offset,
+                todo_id=todo_id,
+                todo_client_id=todo_client_id,
+                key=key,
+                value=value,
+                error=error,
+            )
+            .on_conflict_do_nothing(index_elements=["topic", "partition", "offset"])
+        )
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    def get_due(self, db: Session, *, limit: int = 100) -> List[DeadLetterORM]:
+        """Get the messages whose next attempt is due, in the order they were stored.
+
+        A message is only due once every earlier message of its todo is due as well or
+        has been given up, so the messages of a todo are always retried in order.
+        """
+        earlier = aliased(self.model)
+        earlier_not_due = (
+            select(earlier.id)
+            .where(
+                earlier.todo_id == self.model.todo_id,
+                earlier.todo_client_id == self.model.todo_client_id,
+                earlier.id < self.model.id,
+                earlier.given_up_at.is_(None),
+                earlier.next_attempt_at > func.now(),
+            )
+            .exists()
+        )
+        return (
+            db.query(self.model)
+            .filter(
+                self.model.given_up_at.is_(None),
+                self.model.next_attempt_at <= func.now(),
+                ~earlier_not_due,
+            )
+            .order_by(self.model.id)
+            .limit(limit)
+            .all()
+        )
+
+    def has_key(self, db: Session, *, todo_key: Tuple[int, str]) -> bool:
+        todo_id, todo_client_id = todo_key
+        return db.query(
+            db.query(self.model)
+            .filter(
+                self.model.todo_id == todo_id,
+                self.model.todo_client_id == todo_client_id,
+                self.model.given_up_at.is_(None),
+            )
+            .exists()
+        ).scalar()
+
+    def count(self, db: Session) -> int:
+        """Get the number of messages that are still retried."""
+        return db.query(self.model).filter(self.model.given_up_at.is_(None)).count()
+
+    def parked_keys(self, db: Session) -> Set[Tuple[int, str]]:
+        """Get the keys of the todos that have stored messages that are still retried."""
+        rows = (
+            db.query(self.model.todo_id, self.model.todo_client_id)
+            .filter(self.model.todo_id.isnot(None), self.model.given_up_at.is_(None))
+            .distinct()
+            .all()
+        )
+        return {(row.todo_id, row.todo_client_id) for row in rows}
+
+    def remove(self, db: Session, *, id: int, commit: bool = True):
+        db.query(self.model).filter(self.model.id == id).delete()
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    def reschedule(
+        self, db: Session, *, id: int, error: str, delay: float, commit: bool = True
+    ):
+        """Records a failed attempt and schedules the next one `delay` seconds later."""
+        db.query(self.model).filter(self.model.id == id).update(
+            {
+                "attempts": self.model.attempts + 1,
+                "error": error,
+                "next_attempt_at": func.now() + timedelta(seconds=delay),
+            },
+            synchronize_session=False,
+        )
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    def give_up(self, db: Session, *, id: int, error: str, commit: bool = True):
+        """Records the last failed attempt, the message is kept but not retried again."""
+        db.query(self.model).filter(self.model.id == id).update(
+            {
+                "attempts": self.model.attempts + 1,
+                "error": error,
+                "given_up_at": func.now(),
+            },
+            synchronize_session=False,
+        )
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
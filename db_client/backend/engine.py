@@ -11,7 +11,19 @@ pg_port = os.environ.get("POSTGRES_PORT", "5432")
 pg_user = os.environ.get("POSTGRES_USER", "postgres")
 pg_password = os.environ.get("POSTGRES_PASSWORD", "postgres")
 
-engine = create_engine(f"postgresql://{pg_user}:{pg_password}@{pg_host}:{pg_port}")
+# Connections per process. Every request of the API holds one while its route runs on
+# a worker thread, see API_THREADS in api.py. Threads beyond DB_POOL_SIZE +
+# DB_MAX_OVERFLOW wait up to DB_POOL_TIMEOUT seconds for a connection.
+pool_size = int(os.environ.get("DB_POOL_SIZE", "10"))
+max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+
+engine = create_engine(
+    f"postgresql://{pg_user}:{pg_password}@{pg_host}:{pg_port}",
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    pool_timeout=pool_timeout,
+)
 
 while True:
     try:
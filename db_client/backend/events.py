@@ -0,0 +1,41 @@
+import logging
+from enum import Enum, auto
+from typing import Dict
+
+
+class MsgType(Enum):
+    """The Message Type represents the database operation that was performed by the client."""
+
+    CREATE = auto()
+    UPDATE = auto()
+    DELETE = auto()
+
+
+def derive_msg_type(msg_value: Dict) -> MsgType:
+    """Get the Message Type based on the messages Value.
+
+    Args:
+        msg (Dict): A Debezium CDC Message
+
+    Returns:
+        MsgType: The Message Type
+
+    """
+
+    operation = msg_value.get("payload", {}).get("op")
+    if operation is None:
+        logging.error("Invalid message type, operation is None")
+        raise ValueError("Invalid message type, operation is None")
+    # "r" is a row read by a Debezium snapshot, it is applied like a create
+    if operation in ("c", "r"):
+        logging.debug("CREATE message received")
+        return MsgType.CREATE
+    elif operation == "u":
+        logging.debug("UPDATE message received")
+        return MsgType.UPDATE
+    elif operation == "d":
+        logging.debug("DELETE message received")
+        return MsgType.DELETE
+    else:
+        logging.error(f"Invalid message type, operation is {operation}")
+        raise ValueError(f"Invalid message type, operation is {operation}")
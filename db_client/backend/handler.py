@@ -1,61 +1,73 @@
-import json
 import logging
 from abc import ABC, abstractmethod
-from enum import Enum, auto
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 
+from catchup import bulk_merge, next_offsets
 from confluent_kafka import Message
-from crud import CRUDTodo
+from crud import CRUDSyncOffset, CRUDTodo
 from engine import db_session as get_db
+from envelope import EnvelopeDecoder
+from events import MsgType, derive_msg_type
+from metrics import COMMIT_DURATION, CONFLICTS, EVENTS_APPLIED, STAGE_LATENCY, event_log
 from models import TodoORM as TodoORM
-from schemas import Todo, TodoCreate, TodoSync, TodoUpdate
+from rows import UPDATED_AT, parse_timestamp, row_from_dict, row_from_orm
+from schemas import TodoSync
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 
 crud_todo = CRUDTodo(TodoORM)
+crud_sync_offset = CRUDSyncOffset()
 
 
 class AbstractStrategy(ABC):
+    """Strategies apply an event within the session they are given and must not commit it.
+
+    The Handler commits the changes together with the offset of the event.
+    """
+
     @abstractmethod
-    def handle_create(self, msg: Tuple[Dict, Dict]):
+    def handle_create(self, msg: Tuple[Dict, Dict], db: Session):
         pass
 
     @abstractmethod
-    def handle_update(self, msg: Tuple[Dict, Dict]):
+    def handle_update(self, msg: Tuple[Dict, Dict], db: Session):
         pass
 
     @abstractmethod
-    def handle_delete(self, msg: Tuple[Dict, Dict]):
+    def handle_delete(self, msg: Tuple[Dict, Dict], db: Session):
         pass
 
 
 class LWWStrategy_Client(AbstractStrategy):
     """LWWStrategy implements the Last-Write-Wins strategy for handling messages from the Kafka Consumer."""
 
-    def handle_create(self, msg: Tuple[Dict, Dict]):
-        logging.info("CREATE REQUEST")
+    def handle_create(self, msg: Tuple[Dict, Dict], db: Session):
+        event_log.info("CREATE REQUEST")
         todo_id = msg[0].get("payload", {}).get("id", {})
         client_id = msg[0].get("payload", {}).get("client_id", {})
 
         after_obj = msg[1].get("payload", {}).get("after", {})
-        logging.debug(f"after_obj: {after_obj}")
-
-        with get_db() as db:
-            db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
-
-            if db_todo is not None:
-                parsed_db_todo = Todo.model_validate(db_todo)
-                parsed_after_obj = Todo.model_validate(after_obj)
-                if parsed_after_obj == parsed_db_todo:
-                    logging.info("SYNC detected. Skipping...")
-                    return
-                elif parsed_after_obj.updated_at > parsed_db_todo.updated_at:
-                    logging.info("CREATE EXISTING ITEM. UPDATING INSTEAD...")
-                    return self.handle_update(msg)
-            else:
-                logging.info("CREATING...")
-                crud_todo.create(db, obj_in=TodoSync(**after_obj))
+        logging.debug("after_obj: %s", after_obj)
 
-    def handle_update(self, msg: Tuple[Dict, Dict]):
-        logging.info("UPDATE REQUEST")
+        db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
+
+        if db_todo is not None:
+            parsed_db_todo = row_from_orm(db_todo)
+            parsed_after_obj = row_from_dict(after_obj)
+            if parsed_after_obj == parsed_db_todo:
+                event_log.info("SYNC detected. Skipping...")
+                CONFLICTS.labels(type="sync_skip").inc()
+                return
+            elif parsed_after_obj[UPDATED_AT] > parsed_db_todo[UPDATED_AT]:
+                event_log.info("CREATE EXISTING ITEM. UPDATING INSTEAD...")
+                CONFLICTS.labels(type="lww_overwrite").inc()
+                return self.handle_update(msg, db)
+        else:
+            event_log.info("CREATING...")
+            crud_todo.create(db, obj_in=TodoSync(**after_obj), commit=False)
+
+    def handle_update(self, msg: Tuple[Dict, Dict], db: Session):
+        event_log.info("UPDATE REQUEST")
 
         todo_id = msg[0].get("payload", {}).get("id", {})
         client_id = msg[0].get("payload", {}).get("client_id", {})
@@ -63,121 +75,206 @@ class LWWStrategy_Client(AbstractStrategy):
         before_obj = msg[1].get("payload", {}).get("before", {})
         after_obj = msg[1].get("payload", {}).get("after", {})
 
-        logging.debug(f"before_obj: {before_obj}")
-        logging.debug(f"after_obj: {after_obj}")
-        with get_db() as db:
-            db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
-
-            parsed_db_todo = Todo.model_validate(db_todo)
-            parsed_before_obj = Todo.model_validate(before_obj)
-            parsed_after_obj = Todo.model_validate(after_obj)
-
-            if parsed_after_obj == parsed_db_todo:
-                logging.info("SYNC detected. Skipping...")
-                return
-            elif parsed_before_obj == parsed_db_todo:
-                logging.info("UPDATING...")
-                crud_todo.update(db, db_obj=db_todo, obj_in=TodoSync(**after_obj))
-            else:
-                # We used LWW on Server already.
-                # The client has to accept the server's decision.
-                # Loose of data is possible.
-                logging.warning("CONFLICT. Server has authority. UPDATING...")
-                crud_todo.update(db, db_obj=db_todo, obj_in=TodoSync(**after_obj))
-                return
-
-    def handle_delete(self, msg: Tuple[Dict, Dict]):
-        logging.info("DELETE REQUEST")
+        logging.debug("before_obj: %s", before_obj)
+        logging.debug("after_obj: %s", after_obj)
+        db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
+
+        parsed_db_todo = row_from_orm(db_todo)
+        parsed_before_obj = row_from_dict(before_obj)
+        parsed_after_obj = row_from_dict(after_obj)
+
+        if parsed_after_obj == parsed_db_todo:
+            event_log.info("SYNC detected. Skipping...")
+            CONFLICTS.labels(type="sync_skip").inc()
+            return
+        elif parsed_before_obj == parsed_db_todo:
+            event_log.info("UPDATING...")
+            crud_todo.update(
+                db, db_obj=db_todo, obj_in=TodoSync(**after_obj), commit=False
+            )
+        else:
+            # We used LWW on Server already.
+            # The client has to accept the server's decision.
+            # Loose of data is possible.
+            logging.warning("CONFLICT. Server has authority. UPDATING...")
+            CONFLICTS.labels(type="lww_overwrite").inc()
+            crud_todo.update(
+                db, db_obj=db_todo, obj_in=TodoSync(**after_obj), commit=False
+            )
+            return
+
+    def handle_delete(self, msg: Tuple[Dict, Dict], db: Session):
+        event_log.info("DELETE REQUEST")
         todo_id = msg[0].get("payload", {}).get("id", {})
         client_id = msg[0].get("payload", {}).get("client_id", {})
 
         before_obj = msg[1].get("payload", {}).get("before", {})
 
-        logging.debug(f"before_obj: {before_obj}")
-        with get_db() as db:
-            db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
-
-            if db_todo is None:
-                logging.info("SYNC detected. Skipping...")  # could also be a conflict
-                return
-
-            parsed_db_todo = Todo.model_validate(db_todo)
-            parsed_before_obj = Todo.model_validate(before_obj)
-
-            if parsed_before_obj == parsed_db_todo:
-                logging.info("DELETING ...")
-                crud_todo.delete(db, id=todo_id, client_id=client_id)
-            else:
-                logging.warning("CONFLICT. Before !== Client Item. BLOCKING delete.")
-                return
-
+        logging.debug("before_obj: %s", before_obj)
+        db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
 
-class MsgType(Enum):
-    """The Message Type represents the database operation that was performed by the client."""
+        if db_todo is None:
+            event_log.info("SYNC detected. Skipping...")  # could also be a conflict
+            CONFLICTS.labels(type="sync_skip").inc()
+            return
 
-    CREATE = auto()
-    UPDATE = auto()
-    DELETE = auto()
+        parsed_db_todo = row_from_orm(db_todo)
+        parsed_before_obj = row_from_dict(before_obj)
 
+        if parsed_before_obj == parsed_db_todo:
+            event_log.info("DELETING ...")
+            crud_todo.delete(db, id=todo_id, client_id=client_id, commit=False)
+        else:
+            logging.warning("CONFLICT. Before !== Client Item. BLOCKING delete.")
+            CONFLICTS.labels(type="blocked_delete").inc()
+            return
 
-def derive_msg_type(msg_value: Dict) -> MsgType:
-    """Get the Message Type based on the messages Value.
-
-    Args:
-        msg (Dict): A Debezium CDC Message
 
-    Returns:
-        MsgType: The Message Type
+class Handler:
+    """The Handler class is responsible for handling messages from the Kafka Consumer.
 
+    `client_id` is the origin this client stamps on the rows it writes through its API.
+    Creates and updates of the server topic carrying it are echoes of the client's own
+    writes. They are skipped if the local row still holds that write, see `is_echo`.
     """
 
-    operation = msg_value.get("payload", {}).get("op")
-    if operation is None:
-        logging.error("Invalid message type, operation is None")
-        raise ValueError("Invalid message type, operation is None")
-    if operation == "c":
-        logging.debug("CREATE message received")
-        return MsgType.CREATE
-    elif operation == "u":
-        logging.debug("UPDATE message received")
-        return MsgType.UPDATE
-    elif operation == "d":
-        logging.debug("DELETE message received")
-        return MsgType.DELETE
-    else:
-        logging.error(f"Invalid message type, operation is {operation}")
-        raise ValueError(f"Invalid message type, operation is {operation}")
-
-
-class Handler:
-    """The Handler class is responsible for handling messages from the Kafka Consumer."""
-
-    def __init__(self, strategy: AbstractStrategy):
+    def __init__(self, strategy: AbstractStrategy, client_id: Optional[str] = None):
         self.strategy = strategy
+        self.client_id = client_id
+        self.decoder = EnvelopeDecoder()
 
-    def handle_message(self, msg: Message):
+    def handle_message(self, msg: Message, store_offset: bool = True):
         """Processes a message from the Kafka Consumer by calling the appropriate strategy method.
 
+        The changes of the strategy and the offset following the message are committed in
+        one transaction, so every message is applied exactly once.
+
         Args:
             msg (Message): msg (Message): The Kafka (Confluent) Message
+            store_offset (bool): Whether to store the offset following the message.
+                Retried dead letters are behind the stored offset already.
 
 
         """
 
-        msk_key_str = msg.key().decode("utf-8")
-        msk_key_object = json.loads(msk_key_str)
-
-        msg_value_str = msg.value().decode("utf-8")
-        msg_value_object = json.loads(msg_value_str)
+        event_log.sample()
+        with STAGE_LATENCY.labels(stage="decode").time():
+            msk_key_object = self.decoder.decode_key(msg.key())
+            msg_value_object = self.decoder.decode_value(msg.value())
 
         msg_type = derive_msg_type(msg_value_object)
 
-        if msg_type == MsgType.CREATE:
-            self.strategy.handle_create((msk_key_object, msg_value_object))
-        elif msg_type == MsgType.UPDATE:
-            self.strategy.handle_update((msk_key_object, msg_value_object))
-        elif msg_type == MsgType.DELETE:
-            self.strategy.handle_delete((msk_key_object, msg_value_object))
-        else:
-            logging.error(f"Invalid message type received: {msg_type}")
-            raise ValueError(f"Invalid message type: {msg_type}")
+        with get_db() as db, STAGE_LATENCY.labels(stage="apply").time():
+            key = self.own_write_key(msg_type, msg_value_object)
+            if key is not None and self.is_echo(
+                msg_value_object, crud_todo.get(db, id=key[0], client_id=key[1])
+            ):
+                # The offset is stored with the next applied event. Until then the echo
+                # is skipped again after a restart.
+                event_log.info("ECHO of an own write. Skipping...")
+                CONFLICTS.labels(type="echo_skip").inc()
+                return
+
+            if msg_type == MsgType.CREATE:
+                self.strategy.handle_create((msk_key_object, msg_value_object), db)
+            elif msg_type == MsgType.UPDATE:
+                self.strategy.handle_update((msk_key_object, msg_value_object), db)
+            elif msg_type == MsgType.DELETE:
+                self.strategy.handle_delete((msk_key_object, msg_value_object), db)
+            else:
+                logging.error(f"Invalid message type received: {msg_type}")
+                raise ValueError(f"Invalid message type: {msg_type}")
+            EVENTS_APPLIED.labels(op=msg_type.name.lower()).inc()
+
+            if store_offset:
+                crud_sync_offset.store(
+                    db,
+                    topic=msg.topic(),
+                    partition=msg.partition(),
+                    offset=msg.offset() + 1,
+                    commit=False,
+                )
+            try:
+                with COMMIT_DURATION.time():
+                    db.commit()
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise e
+
+    def handle_bulk(self, msgs: List[Message]):
+        """Processes a large batch of messages, e.g. a backlog, with set-based statements.
+
+        The merged changes and the offsets following the messages are committed in one
+        transaction, like in `handle_message`.
+
+        Args:
+            msgs (List[Message]): The Kafka (Confluent) Messages in the order they were consumed
+        """
+
+        events = []
+        with STAGE_LATENCY.labels(stage="decode").time():
+            for msg in msgs:
+                msg_key_object = self.decoder.decode_key(msg.key())
+                msg_value_object = self.decoder.decode_value(msg.value())
+                msg_type = derive_msg_type(msg_value_object)
+                events.append((msg_type, (msg_key_object, msg_value_object)))
+
+        with get_db() as db, STAGE_LATENCY.labels(stage="merge").time():
+            events = self._drop_echoes(db, events)
+            if events:
+                bulk_merge(db, events)
+            for (topic, partition), offset in next_offsets(msgs).items():
+                crud_sync_offset.store(
+                    db, topic=topic, partition=partition, offset=offset, commit=False
+                )
+            try:
+                with COMMIT_DURATION.time():
+                    db.commit()
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise e
+
+    def own_write_key(self, msg_type: MsgType, msg_value: Dict) -> Optional[Tuple[int, str]]:
+        """The (id, client_id) key of a create or update carrying the origin of this
+        client, None for other events. Deletes carry no origin."""
+        if self.client_id is None or msg_type == MsgType.DELETE:
+            return None
+        after_obj = msg_value.get("payload", {}).get("after") or {}
+        if after_obj.get("origin") != self.client_id:
+            return None
+        return after_obj.get("id"), after_obj.get("client_id")
+
+    def is_echo(self, msg_value: Dict, db_todo: Optional[TodoORM]) -> bool:
+        """Whether the local row `db_todo` still holds the own write the server applied.
+
+        The origin alone is not enough: if the server published an older write of
+        another client before the own write won there, the client has taken that write
+        and has to apply its own one again.
+        """
+        if db_todo is None:
+            return False
+        after_obj = msg_value.get("payload", {}).get("after") or {}
+        return (db_todo.updated_at, db_todo.origin) == (
+            parse_timestamp(after_obj.get("updated_at")),
+            after_obj.get("origin"),
+        )
+
+    def _drop_echoes(
+        self, db: Session, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]
+    ) -> List[Tuple[MsgType, Tuple[Dict, Dict]]]:
+        # The local rows are read before the merge, so only the first event of a key in
+        # the batch can be compared with them
+        keys = [self.own_write_key(msg_type, msg[1]) for msg_type, msg in events]
+        db_todos = crud_todo.get_many(db, keys=[key for key in keys if key is not None])
+        seen = set()
+        kept = []
+        for (msg_type, msg), key in zip(events, keys):
+            payload = msg[0].get("payload", {})
+            event_key = (payload.get("id"), payload.get("client_id"))
+            first = event_key not in seen
+            seen.add(event_key)
+            if key is not None and first and self.is_echo(msg[1], db_todos.get(key)):
+                CONFLICTS.labels(type="echo_skip").inc()
+                continue
+            kept.append((msg_type, msg))
+        return kept
@@ -1,3 +1,15 @@
+# trunk-ignore(ruff/F401)
+from .dead_letters import DeadLetterORM
+
+# trunk-ignore(ruff/F401)
+from .offsets import SyncOffsetORM
+
+# trunk-ignore(ruff/F401)
+from .sync_status import SyncStatusORM
+
+# trunk-ignore(ruff/F401)
+from .todo_deletions import TodoDeletionORM
+
 # trunk-ignore(ruff/F401)
 from .todos import TodoORM
 
@@ -0,0 +1,19 @@
+from sqlalchemy import BigInteger, Column, Integer, PrimaryKeyConstraint, String
+
+from .base import Base
+
+
+class SyncOffsetORM(Base):
+    """The next offset to consume per partition of the server topic.
+
+    It is written in the same transaction as the change an event caused, so the local
+    database always knows exactly which events it has applied.
+    """
+
+    __tablename__ = "sync_offsets"
+
+    topic = Column(String, primary_key=True)
+    partition = Column(Integer, primary_key=True)
+    offset = Column(BigInteger, nullable=False)
+
+    __table_args__ = (PrimaryKeyConstraint("topic", "partition"),)
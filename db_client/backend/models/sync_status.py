@@ -0,0 +1,25 @@
+from sqlalchemy import BigInteger, Column, DateTime, Float, Integer, PrimaryKeyConstraint, String
+from sqlalchemy.sql import func
+
+from .base import Base
+
+
+class SyncStatusORM(Base):
+    """The progress of the sync per partition of the server topic, as last reported by
+    the sync worker.
+
+    The applied offset is not part of it, it is read from `sync_offsets`, which is
+    written with every applied change.
+    """
+
+    __tablename__ = "sync_status"
+
+    topic = Column(String, primary_key=True)
+    partition = Column(Integer, primary_key=True)
+    high_watermark = Column(BigInteger)
+    applied_per_second = Column(Float, nullable=False, default=0.0)
+    last_applied_at = Column(DateTime(timezone=True))
+    last_event_at = Column(DateTime(timezone=True))
+    reported_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (PrimaryKeyConstraint("topic", "partition"),)
@@ -0,0 +1,20 @@
+from sqlalchemy import BigInteger, Column, DateTime, Integer, PrimaryKeyConstraint, String
+from sqlalchemy.sql import func
+
+from .base import Base
+
+
+class TodoDeletionORM(Base):
+    """The key of a deleted todo, written by the `todos_track_deletion` trigger.
+
+    It lets GET /todo/changes report deletions. Creating the todo again removes it.
+    """
+
+    __tablename__ = "todo_deletions"
+
+    id = Column(Integer, primary_key=True)
+    client_id = Column(String, primary_key=True)
+    change_seq = Column(BigInteger, nullable=False)
+    deleted_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (PrimaryKeyConstraint("id", "client_id"),)
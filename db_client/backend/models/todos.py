@@ -1,30 +1,47 @@
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     DateTime,
+    Index,
     Integer,
     PrimaryKeyConstraint,
     Sequence,
     String,
 )
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 
 from .base import Base
 
+# The text searched by GET /todo/search, idx_todos_search indexes exactly this expression
+SEARCH_DOCUMENT = (
+    "to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(description, ''))"
+)
+
 
 class TodoORM(Base):
     __tablename__ = "todos"
 
     id = Column(Integer, Sequence("todos_id_seq"), primary_key=True, autoincrement=True)
-    client_id = Column(
-        String, primary_key=True, index=True
-    )  # added client_id as a primary key
-    title = Column(String, index=True)
-    description = Column(String, index=True)
-    completed = Column(Boolean, index=True)
+    client_id = Column(String, primary_key=True)  # added client_id as a primary key
+    title = Column(String)
+    description = Column(String)
+    completed = Column(Boolean)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(
         DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
     )
+    # Client whose write produced the current state of the row, see CRUDTodo
+    origin = Column(String)
+    # Id of the transaction that last wrote the row, set by a trigger, see init.sql
+    change_seq = Column(BigInteger)
 
-    __table_args__ = (PrimaryKeyConstraint("id", "client_id"),)  # Composite primary key
+    # The indexes of init.sql. Every index is used by a query, see the comments there.
+    __table_args__ = (
+        PrimaryKeyConstraint("id", "client_id"),  # Composite primary key
+        Index("idx_todos_client_id_id", "client_id", "id"),
+        Index("idx_todos_title", "title", postgresql_ops={"title": "text_pattern_ops"}),
+        Index("idx_todos_completed", "completed", "client_id", "id"),
+        Index("idx_todos_change_seq", "change_seq", "client_id", "id"),
+        Index("idx_todos_search", text(SEARCH_DOCUMENT), postgresql_using="gin"),
+    )
@@ -14,7 +14,7 @@ crud_user = CRUDUser(UserORM)
 
 
 @router.get("/user", tags=["users"], response_model=List[User])
-async def get_all_users(db: Session = Depends(get_db)) -> List[User]:
+def get_all_users(db: Session = Depends(get_db)) -> List[User]:
     users = crud_user.get_multi(db=db)
     if users is None:
         raise HTTPException(status_code=404, detail="Users not found")
@@ -22,7 +22,7 @@ async def get_all_users(db: Session = Depends(get_db)) -> List[User]:
 
 
 @router.get("/user/{user_id}", tags=["users"], response_model=User)
-async def get_user_by_id(user_id: int, db: Session = Depends(get_db)) -> User:
+def get_user_by_id(user_id: int, db: Session = Depends(get_db)) -> User:
     db_user = crud_user.get(db, id=user_id)
 
     if not db_user:
@@ -31,7 +31,7 @@ async def get_user_by_id(user_id: int, db: Session = Depends(get_db)) -> User:
 
 
 @router.post("/user", tags=["users"], response_model=User)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)) -> User:
+def create_user(user: UserCreate, db: Session = Depends(get_db)) -> User:
     db_user = crud_user.create(db, obj_in=user)
     if not db_user:
         raise HTTPException(status_code=404, detail="Error creating user")
@@ -39,7 +39,7 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)) -> User:
 
 
 @router.post("/user/{user_id}", tags=["users"], response_model=User)
-async def update_user(
+def update_user(
     user_id: int,
     user: UserUpdate,
     db: Session = Depends(get_db),
@@ -51,7 +51,7 @@ async def update_user(
 
 
 @router.delete("/user/{user_id}", tags=["users"], response_model=User)
-async def delete_user(user_id: int, db: Session = Depends(get_db)) -> User:
+def delete_user(user_id: int, db: Session = Depends(get_db)) -> User:
     db_user = crud_user.get(db, id=user_id)
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -0,0 +1,73 @@
+import os
+from typing import Optional
+
+from crud import CRUDSyncOffset, CRUDSyncStatus
+from engine import get_db
+from fastapi import APIRouter, Depends, Response, status
+from schemas import PartitionSyncStatus, SyncStatus
+from sqlalchemy.orm import Session
+
+router = APIRouter()
+
+crud_sync_offset = CRUDSyncOffset()
+crud_sync_status = CRUDSyncStatus()
+
+CLIENT_ID = os.environ.get("CLIENT_ID")
+
+
+@router.get("/sync/status", tags=["sync"], response_model=SyncStatus)
+def get_sync_status(
+    response: Response,
+    max_lag: Optional[int] = None,
+    # trunk-ignore(ruff/B008)
+    db: Session = Depends(get_db),
+) -> SyncStatus:
+    """How far the sync of this client is behind the server.
+
+    The high watermarks and the throughput are reported by the sync worker every few
+    seconds, the applied offsets are exact. With `max_lag` the status is 503 if the lag
+    is larger or unknown, so load balancers can take stale clients out of rotation.
+    """
+    rows = crud_sync_status.get_all(db)
+    applied_offsets = {
+        topic: crud_sync_offset.get_all(db, topic=topic)
+        for topic in {row.topic for row in rows}
+    }
+
+    partitions = []
+    for row in rows:
+        applied_offset = applied_offsets[row.topic].get(row.partition)
+        lag = None
+        if row.high_watermark is not None:
+            lag = max(row.high_watermark - (applied_offset or 0), 0)
+        partitions.append(
+            PartitionSyncStatus(
+                topic=row.topic,
+                partition=row.partition,
+                applied_offset=applied_offset,
+                high_watermark=row.high_watermark,
+                lag=lag,
+                applied_per_second=row.applied_per_second,
+                last_applied_at=row.last_applied_at,
+                last_event_at=row.last_event_at,
+                reported_at=row.reported_at,
+            )
+        )
+
+    lags = [p.lag for p in partitions]
+    applied_at = [p.last_applied_at for p in partitions if p.last_applied_at]
+    event_at = [p.last_event_at for p in partitions if p.last_event_at]
+    reported_at = [p.reported_at for p in partitions if p.reported_at]
+    sync_status = SyncStatus(
+        client_id=CLIENT_ID,
+        # Unknown until every partition has reported its high watermark
+        lag=sum(lags) if lags and None not in lags else None,
+        applied_per_second=sum(p.applied_per_second for p in partitions),
+        last_applied_at=max(applied_at, default=None),
+        last_event_at=max(event_at, default=None),
+        reported_at=min(reported_at, default=None),
+        partitions=partitions,
+    )
+    if max_lag is not None and (sync_status.lag is None or sync_status.lag > max_lag):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return sync_status
@@ -1,62 +1,344 @@
 # profiles/routes.py
-from typing import List
+import base64
+import hashlib
+import json
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
 
+from broadcast import Subscription, broadcaster, todo_change
 from crud import CRUDTodo
-from engine import get_db
-from fastapi import APIRouter, Depends, HTTPException
+from engine import db_session, get_db
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from models import TodoORM as TodoORM
-from schemas import Todo, TodoCreate, TodoUpdate
+from schemas import (
+    TODO_FIELDS,
+    Todo,
+    TodoBulk,
+    TodoBulkResult,
+    TodoBulkResults,
+    TodoChanges,
+    TodoCreate,
+    TodoUpdate,
+)
+from serialize import dumps
 from sqlalchemy.orm import Session
+from view import todo_view
 
 router = APIRouter()
 
 crud_todo = CRUDTodo(TodoORM)
 
 
+def encode_cursor(client_id: str, todo_id: int) -> str:
+    """Encodes the (client_id, id) key of the last todo of a page."""
+    return base64.urlsafe_b64encode(json.dumps([client_id, todo_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        client_id, todo_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(client_id), int(todo_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def encode_change_cursor(key: Tuple) -> str:
+    """Encodes a (change_seq, client_id, id) key, or a (change_seq,) horizon."""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def decode_change_cursor(cursor: str) -> Tuple:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(key) == 1:
+            return (int(key[0]),)
+        change_seq, client_id, todo_id = key
+        return int(change_seq), str(client_id), int(todo_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Compares the ETags of an If-None-Match header weakly with `etag`."""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
 #     return graph_data
 @router.get("/todo", tags=["todos"], response_model=List[Todo])
-# trunk-ignore(ruff/B008)
-async def get_all_todos(db: Session = Depends(get_db)) -> List[Todo]:
-    todos = crud_todo.get_multi(db=db)
-    if todos is None:
-        raise HTTPException(status_code=404, detail="No Todos Found")
-    return todos
+def get_all_todos(
+    cursor: Optional[str] = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    completed: Optional[bool] = None,
+    title_prefix: Optional[str] = None,
+    if_none_match: Optional[str] = Header(default=None),
+    # trunk-ignore(ruff/B008)
+    db: Session = Depends(get_db),
+) -> List[Todo]:
+    """Get a page of todos ordered by (client_id, id).
+
+    If there are more todos, the `X-Next-Cursor` header holds the cursor of the next page.
+
+    The ETag is derived from the transaction snapshot, which is read before the page, so
+    a request with a matching If-None-Match is answered with a 304 without reading todos.
+    Any commit changes it, also of other tables, which only costs a full response.
+
+    The `X-Change-Cursor` header is the horizon of that snapshot. The changes following it
+    from /todo/changes or /todo/events include every change the page may be missing.
+
+    The page is read as plain rows and encoded directly to JSON, it skips the ORM objects
+    and the validation of `response_model`, which only documents the response.
+
+    With TODO_VIEW=on the page is read from the in-memory copy of the todos instead, its
+    ETag changes with the todos only, see view.py.
+    """
+    if todo_view.ready:
+        etag, position = todo_view.version()
+        headers = {"ETag": etag, "X-Change-Cursor": encode_change_cursor(position)}
+    else:
+        snapshot = crud_todo.snapshot(db)
+        headers = {
+            "ETag": '"' + hashlib.sha1(snapshot.encode()).hexdigest() + '"',
+            "X-Change-Cursor": encode_change_cursor((int(snapshot.split(":")[0]),)),
+        }
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    after = decode_cursor(cursor) if cursor is not None else None
+    # One more than requested tells whether there is a next page
+    if todo_view.ready:
+        page = todo_view.page(
+            after=after, limit=limit + 1, completed=completed, title_prefix=title_prefix
+        )
+    else:
+        rows = crud_todo.get_page_rows(
+            db,
+            fields=TODO_FIELDS,
+            after=after,
+            limit=limit + 1,
+            completed=completed,
+            title_prefix=title_prefix,
+        )
+        page = [row._asdict() for row in rows]
+    if len(page) > limit:
+        page = page[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(page[-1]["client_id"], page[-1]["id"])
+    return Response(dumps(page), media_type="application/json", headers=headers)
+
+
+def _export_lines(completed: Optional[bool], title_prefix: Optional[str]) -> Iterator[bytes]:
+    # The stream outlives the request, so it reads with a session of its own
+    with db_session() as db:
+        for rows in crud_todo.stream_rows(
+            db, fields=TODO_FIELDS, completed=completed, title_prefix=title_prefix
+        ):
+            yield b"".join(dumps(row._asdict()) + b"\n" for row in rows)
+
+
+@router.get("/todo/export", tags=["todos"], response_class=StreamingResponse)
+def export_todos(
+    completed: Optional[bool] = None, title_prefix: Optional[str] = None
+) -> StreamingResponse:
+    """Export the todos as NDJSON, one Todo per line in (client_id, id) order.
+
+    The rows are fetched from a server-side cursor in batches and written as they come,
+    so the memory of an export does not grow with the number of todos.
+    """
+    return StreamingResponse(
+        _export_lines(completed, title_prefix),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="todos.ndjson"'},
+    )
+
+
+@router.get("/todo/search", tags=["todos"], response_model=List[Todo])
+def search_todos(
+    q: str = Query(min_length=1, max_length=256),
+    limit: int = Query(default=20, ge=1, le=100),
+    # trunk-ignore(ruff/B008)
+    db: Session = Depends(get_db),
+) -> List[Todo]:
+    """Search the titles and descriptions of the todos for the words of `q`, best matches
+    first.
+
+    `q` is a web search query: words match whole words in any order, "quoted text"
+    matches a phrase, `or` matches either side and a leading `-` excludes a word. The
+    search uses the full-text index idx_todos_search, see init.sql.
+    """
+    rows = crud_todo.search_rows(db, fields=TODO_FIELDS, q=q, limit=limit)
+    return Response(dumps([row._asdict() for row in rows]), media_type="application/json")
+
+
+@router.get("/todo/changes", tags=["todos"], response_model=TodoChanges)
+def get_todo_changes(
+    cursor: Optional[str] = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    # trunk-ignore(ruff/B008)
+    db: Session = Depends(get_db),
+) -> TodoChanges:
+    """Get the todos created, updated or deleted since `cursor`, every todo without one.
+
+    Pass the returned cursor to the next call, `has_more` tells whether more changes can
+    be read right away. A change is returned once every transaction that started before
+    it has finished, so the cursor never skips a change that commits late. A long
+    running transaction holds the feed back until it ends.
+    """
+    after = decode_change_cursor(cursor) if cursor is not None else (0,)
+    changes, next_cursor, has_more = crud_todo.read_changes(db, after=after, limit=limit)
+    return TodoChanges(
+        changes=[todo_change(change) for change in changes],
+        cursor=encode_change_cursor(next_cursor),
+        has_more=has_more,
+    )
+
+
+async def _event_stream(subscription: Subscription, keepalive: float) -> AsyncIterator[str]:
+    try:
+        async for item in subscription.changes(keepalive):
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            key, change = item
+            yield (
+                f"id: {encode_change_cursor(key)}\n"
+                f"event: change\ndata: {change.model_dump_json()}\n\n"
+            )
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+@router.get("/todo/events", tags=["todos"])
+async def stream_todo_events(
+    cursor: Optional[str] = None,
+    keepalive: float = Query(default=15.0, ge=1.0, le=60.0),
+    last_event_id: Optional[str] = Header(default=None),
+) -> StreamingResponse:
+    """Stream the changes of the todos as server-sent events.
+
+    Every `change` event holds a TodoChange, its id is the cursor following it. The stream
+    starts after `cursor`, or after the Last-Event-ID of a reconnecting EventSource, and
+    from now on without either. A comment is sent every `keepalive` seconds without
+    changes.
+    """
+    start = last_event_id or cursor
+    after = decode_change_cursor(start) if start is not None else None
+    subscription = broadcaster.subscribe(after)
+    return StreamingResponse(
+        _event_stream(subscription, keepalive),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.get("/todo/{client_id}/{todo_id}", tags=["todos"], response_model=Todo)
-async def get_todo_by_id(
-    client_id: str, todo_id: int, db: Session = Depends(get_db)
+def get_todo_by_id(
+    client_id: str,
+    todo_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(default=None),
+    # trunk-ignore(ruff/B008)
+    db: Session = Depends(get_db),
 ) -> Todo:
+    """Get a todo. Its ETag is the id of the transaction that last wrote it."""
+    if todo_view.ready:
+        entry = todo_view.get(client_id, todo_id)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Todo not found")
+        change_seq, fields = entry
+        headers = {}
+        if change_seq is not None:
+            headers["ETag"] = f'"{change_seq}"'
+            if etag_matches(if_none_match, headers["ETag"]):
+                return Response(status_code=304, headers=headers)
+        return Response(dumps(fields), media_type="application/json", headers=headers)
+
     db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
 
     if not db_todo:
         raise HTTPException(status_code=404, detail="Todo not found")
+    if db_todo.change_seq is not None:
+        etag = f'"{db_todo.change_seq}"'
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
     return db_todo
 
 
 @router.post("/todo", tags=["todos"], response_model=Todo)
-async def create_todo(todo: TodoCreate, db: Session = Depends(get_db)) -> Todo:
+def create_todo(todo: TodoCreate, db: Session = Depends(get_db)) -> Todo:
     db_todo = crud_todo.create(db, obj_in=todo)
     if not db_todo:
         raise HTTPException(status_code=404, detail="Error creating todo")
-    return db_todo
+    # Read before waiting, other writers may change the todo meanwhile
+    result = Todo.model_validate(db_todo)
+    todo_view.wait_for_update()
+    return result
+
+
+@router.post("/todo/bulk", tags=["todos"], response_model=TodoBulkResults)
+def bulk_write_todos(
+    bulk: TodoBulk,
+    # trunk-ignore(ruff/B008)
+    db: Session = Depends(get_db),
+) -> TodoBulkResults:
+    """Create, update and delete todos in one transaction, which is also one transaction
+    of the CDC stream.
+
+    The results are in the order of the items, with status 404 for updates and deletes
+    of todos that do not exist. A todo can only be updated or deleted once per request.
+    """
+    keys = [(item.id, item.client_id) for item in bulk.update + bulk.delete]
+    if len(set(keys)) < len(keys):
+        raise HTTPException(
+            status_code=422, detail="A todo is updated or deleted more than once"
+        )
+    created, updated, deleted = crud_todo.bulk_write(
+        db,
+        create=bulk.create,
+        update=bulk.update,
+        delete_keys=[(item.id, item.client_id) for item in bulk.delete],
+    )
+    if created or any(updated) or any(deleted):
+        todo_view.wait_for_update()
+
+    def result(item, db_todo) -> TodoBulkResult:
+        if db_todo is None:
+            return TodoBulkResult(id=item.id, client_id=item.client_id, status=404)
+        return TodoBulkResult(
+            id=db_todo.id,
+            client_id=db_todo.client_id,
+            status=200,
+            todo=Todo.model_validate(db_todo),
+        )
+
+    return TodoBulkResults(
+        create=[result(item, db_todo) for item, db_todo in zip(bulk.create, created)],
+        update=[result(item, db_todo) for item, db_todo in zip(bulk.update, updated)],
+        delete=[result(item, row) for item, row in zip(bulk.delete, deleted)],
+    )
 
 
 @router.post("/todo/{client_id}/{todo_id}", tags=["todos"], response_model=Todo)
-async def update_todo(
+def update_todo(
     client_id: str, todo_id: int, todo: TodoUpdate, db: Session = Depends(get_db)
 ) -> Todo:
     db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
     if not db_todo:
         raise HTTPException(status_code=404, detail="Todo not found")
-    return crud_todo.update(db, db_obj=db_todo, obj_in=todo)
+    result = Todo.model_validate(crud_todo.update(db, db_obj=db_todo, obj_in=todo))
+    todo_view.wait_for_update()
+    return result
 
 
 @router.delete("/todo/{client_id}/{todo_id}", tags=["todos"], response_model=Todo)
-async def delete_todo(
+def delete_todo(
     client_id: str, todo_id: int, db: Session = Depends(get_db)
 ) -> Todo:
     db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
     if not db_todo:
         raise HTTPException(status_code=404, detail="Todo not found")
-    return crud_todo.delete(db, id=todo_id, client_id=client_id)
+    db_todo = crud_todo.delete(db, id=todo_id, client_id=client_id)
+    todo_view.wait_for_update()
+    return db_todo
@@ -1,5 +1,21 @@
 # trunk-ignore(ruff/F401)
-from .todos import Todo, TodoCreate, TodoUpdate, TodoSync
+from .sync import PartitionSyncStatus, SyncStatus
+
+# trunk-ignore(ruff/F401)
+from .todos import (
+    TODO_FIELDS,
+    Todo,
+    TodoBulk,
+    TodoBulkResult,
+    TodoBulkResults,
+    TodoBulkUpdate,
+    TodoChange,
+    TodoChanges,
+    TodoCreate,
+    TodoKey,
+    TodoSync,
+    TodoUpdate,
+)
 
 # trunk-ignore(ruff/F401)
 from .users import User, UserCreate, UserUpdate
@@ -0,0 +1,38 @@
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+
+class PartitionSyncStatus(BaseModel):
+    topic: str
+    partition: int
+    applied_offset: Optional[int] = Field(
+        default=None, description="Next offset to apply, every offset before it is applied"
+    )
+    high_watermark: Optional[int] = Field(
+        default=None, description="Offset following the last message of the partition"
+    )
+    lag: Optional[int] = Field(default=None, description="Messages not applied yet")
+    applied_per_second: float = Field(
+        default=0.0, description="Messages applied per second since the previous report"
+    )
+    last_applied_at: Optional[datetime] = Field(
+        default=None, description="When the sync last applied a message"
+    )
+    last_event_at: Optional[datetime] = Field(
+        default=None, description="When the last applied message was published"
+    )
+    reported_at: Optional[datetime] = None
+
+
+class SyncStatus(BaseModel):
+    client_id: Optional[str]
+    lag: Optional[int] = Field(
+        default=None, description="Messages not applied yet, summed over all partitions"
+    )
+    applied_per_second: float = 0.0
+    last_applied_at: Optional[datetime] = None
+    last_event_at: Optional[datetime] = None
+    reported_at: Optional[datetime] = None
+    partitions: List[PartitionSyncStatus] = []
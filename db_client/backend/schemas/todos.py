@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import List, Optional
 
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -27,6 +28,7 @@ class TodoSync(TodoBase):
     client_id: str
     created_at: datetime
     updated_at: datetime
+    origin: Optional[str] = None
 
 
 class Todo(TodoBase):
@@ -36,3 +38,56 @@ class Todo(TodoBase):
     client_id: str
     created_at: datetime
     updated_at: datetime
+
+
+# The columns of a Todo, in the order Pydantic serializes them
+TODO_FIELDS = tuple(Todo.model_fields)
+
+
+class TodoChange(BaseModel):
+    id: int
+    client_id: str
+    deleted: bool = Field(default=False, description="Whether the todo was deleted")
+    todo: Optional[Todo] = Field(
+        default=None, description="The current state of the todo, unless it was deleted"
+    )
+
+
+class TodoChanges(BaseModel):
+    changes: List[TodoChange] = []
+    cursor: str = Field(..., description="Cursor to read the following changes with")
+    has_more: bool = Field(
+        default=False, description="Whether more changes can be read right away"
+    )
+
+
+class TodoKey(BaseModel):
+    id: int
+    client_id: str
+
+
+class TodoBulkUpdate(TodoUpdate):
+    id: int
+    client_id: str
+
+
+class TodoBulk(BaseModel):
+    create: List[TodoCreate] = Field(default=[], max_length=1000)
+    update: List[TodoBulkUpdate] = Field(default=[], max_length=1000)
+    delete: List[TodoKey] = Field(default=[], max_length=1000)
+
+
+class TodoBulkResult(BaseModel):
+    id: Optional[int] = None
+    client_id: str
+    status: int = Field(..., description="HTTP status of the item, 200 or 404")
+    todo: Optional[Todo] = Field(
+        default=None, description="The todo after the write, the deleted todo for deletes"
+    )
+
+
+class TodoBulkResults(BaseModel):
+    create: List[TodoBulkResult] = []
+    update: List[TodoBulkResult] = []
+    delete: List[TodoBulkResult] = []
+
@@ -0,0 +1,21 @@
+import json
+from datetime import datetime
+from typing import Any
+
+try:
+    import orjson
+
+    def dumps(obj: Any) -> bytes:
+        """Encodes `obj` as compact JSON, datetimes as ISO 8601 like Pydantic does."""
+        return orjson.dumps(obj, option=orjson.OPT_UTC_Z)
+
+except ImportError:  # pragma: no cover - orjson is optional
+
+    def _default(value: Any) -> str:
+        if isinstance(value, datetime):
+            return value.isoformat().replace("+00:00", "Z")
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+    def dumps(obj: Any) -> bytes:
+        """Encodes `obj` as compact JSON, datetimes as ISO 8601 like Pydantic does."""
+        return json.dumps(obj, default=_default, separators=(",", ":")).encode()
@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from confluent_kafka import TIMESTAMP_NOT_AVAILABLE, Consumer, Message
+from crud import CRUDSyncStatus
+from engine import db_session
+
+crud_sync_status = CRUDSyncStatus()
+
+
+class _PartitionStatus:
+    def __init__(self):
+        self.applied = 0
+        self.last_applied_at: Optional[datetime] = None
+        self.last_event_at: Optional[datetime] = None
+
+
+class SyncStatusReporter:
+    """Collects the progress of the sync and publishes it to the `sync_status` table.
+
+    The apply thread reports the applied messages, which only updates counters. The
+    poll loop calls `publish` after every poll, which writes the status of the assigned
+    partitions at most every `interval` seconds, so the status costs one small
+    transaction per interval. While the sync is idle and the status does not change it is
+    only written every `heartbeat` seconds, as every commit changes the ETag of GET /todo.
+    """
+
+    def __init__(self, interval: float = 5.0, heartbeat: float = 60.0):
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self._lock = threading.Lock()
+        self._partitions: Dict[Tuple[str, int], _PartitionStatus] = {}
+        self._published_at = time.monotonic()
+        self._written_at = self._published_at
+        # The high watermarks of the last write, None after a write with applied messages
+        self._written_highs: Optional[Dict[Tuple[str, int], int]] = None
+
+    def applied(self, msgs: List[Message]):
+        """Records messages that have been applied and whose offsets are stored."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            for msg in msgs:
+                status = self._partitions.setdefault(
+                    (msg.topic(), msg.partition()), _PartitionStatus()
+                )
+                status.applied += 1
+                status.last_applied_at = now
+                timestamp_type, timestamp = msg.timestamp()
+                if timestamp_type != TIMESTAMP_NOT_AVAILABLE:
+                    status.last_event_at = datetime.fromtimestamp(
+                        timestamp / 1000, timezone.utc
+                    )
+
+    def publish(self, consumer: Consumer, force: bool = False):
+        """Writes the status of the assigned partitions if the interval has passed."""
+        now = time.monotonic()
+        elapsed = now - self._published_at
+        if elapsed < self.interval and not force:
+            return
+        self._published_at = now
+
+        assignment = consumer.assignment()
+        with self._lock:
+            statuses = {
+                (p.topic, p.partition): self._partitions.pop(
+                    (p.topic, p.partition), _PartitionStatus()
+                )
+                for p in assignment
+            }
+            self._partitions.clear()  # Drops partitions that are no longer assigned
+
+        try:
+            highs = {
+                (p.topic, p.partition): consumer.get_watermark_offsets(p, cached=True)[1]
+                for p in assignment
+            }
+            idle = not any(status.applied for status in statuses.values())
+            if (
+                idle
+                and highs == self._written_highs
+                and now - self._written_at < self.heartbeat
+                and not force
+            ):
+                return
+
+            with db_session() as db:
+                for p in assignment:
+                    status = statuses[(p.topic, p.partition)]
+                    high = highs[(p.topic, p.partition)]
+                    crud_sync_status.publish(
+                        db,
+                        topic=p.topic,
+                        partition=p.partition,
+                        high_watermark=high if high >= 0 else None,
+                        applied_per_second=status.applied / max(elapsed, 1e-3),
+                        last_applied_at=status.last_applied_at,
+                        last_event_at=status.last_event_at,
+                        commit=False,
+                    )
+                db.commit()
+            self._written_at = now
+            self._written_highs = highs if idle else None
+        except Exception:
+            # The status is informational, it must not stop the sync
+            logging.exception("Publishing the sync status failed")
@@ -1,20 +1,56 @@
 import logging
 import os
 import socket
+import threading
 import time
-from typing import Protocol
+from typing import List, Optional, Protocol
 
-from confluent_kafka import Consumer, KafkaError, KafkaException
+from bootstrap import bootstrap_from_snapshot, needs_bootstrap
+from catchup import CatchUp, next_offsets
+from confluent_kafka import Consumer, KafkaError, KafkaException, TopicPartition
+from crud import CRUDSyncOffset
+from deadletter import DeadLetterHandler, DeadLetterQueue
+from engine import db_session
 from handler import Handler, LWWStrategy_Client
+from metrics import event_log, record_consumer_lag
+from prefetch import PrefetchQueue
+from prometheus_client import start_http_server
+from status import SyncStatusReporter
 
 CLIENT_ID = os.environ.get("CLIENT_ID")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+# Only every n-th event is logged on the hot path, conflicts are always logged
+LOG_SAMPLE_RATE = int(os.environ.get("LOG_SAMPLE_RATE", "100"))
+# Consumed messages waiting to be applied before the server topic is paused
+PREFETCH_MAX_MESSAGES = int(os.environ.get("PREFETCH_MAX_MESSAGES", "1000"))
+PREFETCH_MAX_BYTES = int(os.environ.get("PREFETCH_MAX_BYTES", str(16 * 1024 * 1024)))
+# "auto" loads a snapshot of the server's todos when the client has no stored offsets
+# instead of replaying the whole server topic, "off" always replays the topic
+BOOTSTRAP = os.environ.get("BOOTSTRAP", "auto")
+# Seconds between the retries of dead-lettered messages, the retries of a message
+# back off exponentially up to DLQ_MAX_BACKOFF seconds
+DLQ_RETRY_INTERVAL = float(os.environ.get("DLQ_RETRY_INTERVAL", "5"))
+DLQ_MAX_BACKOFF = float(os.environ.get("DLQ_MAX_BACKOFF", "600"))
+# Failed attempts after which a dead-lettered message is kept but no longer retried
+DLQ_MAX_ATTEMPTS = int(os.environ.get("DLQ_MAX_ATTEMPTS", "10"))
+# Consumer lag from which the prefetched messages are merged in bulks of up to
+# CATCHUP_BATCH_SIZE messages instead of one by one, 0 disables catching up
+CATCHUP_LAG_THRESHOLD = int(os.environ.get("CATCHUP_LAG_THRESHOLD", "5000"))
+CATCHUP_BATCH_SIZE = int(os.environ.get("CATCHUP_BATCH_SIZE", "1000"))
+# Seconds between the updates of the status reported by /sync/status
+STATUS_INTERVAL = float(os.environ.get("STATUS_INTERVAL", "5"))
 logging.basicConfig(level=logging.INFO)
 
+crud_sync_offset = CRUDSyncOffset()
+
 
 class MessageHandler(Protocol):
     def handle_message(self, msg):
         pass
 
+    def handle_bulk(self, msgs):
+        pass
+
 
 def wait_for_kafka(bootstrap_servers: str, max_retries=10, delay=5) -> bool:
     """Wait for Kafka to be ready."""
@@ -38,47 +74,184 @@ def wait_for_kafka(bootstrap_servers: str, max_retries=10, delay=5) -> bool:
     raise Exception("Kafka is not ready after waiting for a while.")
 
 
-def sync_consumer(bootstrap_servers: str, server_topic: str, handler: MessageHandler):
+def seek_to_stored_offsets(consumer: Consumer, partitions: List[TopicPartition]):
+    """Start every assigned partition at the offset stored in the local database.
+
+    The stored offsets are committed together with the applied changes, so they are
+    exact even if the offsets committed to Kafka are behind.
+    """
+    with db_session() as db:
+        stored_offsets = {
+            topic: crud_sync_offset.get_all(db, topic=topic)
+            for topic in {p.topic for p in partitions}
+        }
+    for p in partitions:
+        offset = stored_offsets[p.topic].get(p.partition)
+        if offset is not None:
+            p.offset = offset
+    logging.info(f"Assigned partitions: {[(p.topic, p.partition, p.offset) for p in partitions]}")
+    consumer.assign(partitions)
+
+
+class ApplyThread(threading.Thread):
+    """Applies the prefetched messages in order while the consumer keeps polling.
+
+    After a failed message nothing is applied until `reset` is called, the messages
+    are read again from the offsets stored in the local database.
+
+    While `catchup` is active the prefetched messages are merged in bulks. The applied
+    messages are reported to the `status` reporter.
+    """
+
+    def __init__(
+        self,
+        consumer: Consumer,
+        prefetch: PrefetchQueue,
+        handler: MessageHandler,
+        catchup: Optional[CatchUp] = None,
+        status: Optional[SyncStatusReporter] = None,
+    ):
+        super().__init__(name="apply", daemon=True)
+        self.consumer = consumer
+        self.prefetch = prefetch
+        self.handler = handler
+        self.catchup = catchup
+        self.status = status
+        self.error: Optional[BaseException] = None
+
+    def run(self):
+        while True:
+            msgs = [self.prefetch.get()]
+            if self.catchup is not None and self.catchup.active:
+                msgs += self.prefetch.get_many(self.catchup.batch_size - 1)
+            try:
+                if self.error is None and len(msgs) == 1:
+                    self.handler.handle_message(msgs[0])
+                    self.consumer.store_offsets(message=msgs[0])
+                elif self.error is None:
+                    self.handler.handle_bulk(msgs)
+                    self.consumer.store_offsets(
+                        offsets=[
+                            TopicPartition(topic, partition, offset)
+                            for (topic, partition), offset in next_offsets(msgs).items()
+                        ]
+                    )
+                if self.error is None and self.status is not None:
+                    self.status.applied(msgs)
+            except Exception as e:
+                logging.exception("Applying message failed")
+                self.error = e
+            finally:
+                for msg in msgs:
+                    self.prefetch.task_done(msg)
+
+    def reset(self):
+        """Drops the prefetched messages and waits for the current one."""
+        self.prefetch.clear()
+        self.prefetch.join()
+        self.error = None
+
+
+def sync_consumer(
+    bootstrap_servers: str,
+    server_topic: str,
+    handler: MessageHandler,
+    catchup: Optional[CatchUp] = None,
+    status: Optional[SyncStatusReporter] = None,
+):
     wait_for_kafka(bootstrap_servers)
     conf = {
         "bootstrap.servers": bootstrap_servers,
         "group.id": str(CLIENT_ID),
-        "auto.offset.reset": "earliest",  # Start from the beginning if no offset is committed
-        "enable.auto.commit": True,  # Commit offsets automatically
+        "auto.offset.reset": "earliest",  # Start from the beginning if no offset is stored
+        # The local database is the source of truth for the offsets. They are committed
+        # to Kafka as well, but only after the handler committed them, for monitoring.
+        "enable.auto.commit": True,
+        "enable.auto.offset.store": False,
+        # Reports reaching the end of a partition, see the poll loop
+        "enable.partition.eof": True,
+        # Publishes the consumer lag per partition, see metrics.py
+        "statistics.interval.ms": 5000,
+        "stats_cb": record_consumer_lag,
     }
 
     consumer = Consumer(conf)
+    prefetch = PrefetchQueue(PREFETCH_MAX_MESSAGES, PREFETCH_MAX_BYTES)
+    apply_thread = ApplyThread(consumer, prefetch, handler, catchup, status)
+    apply_thread.start()
+
+    def on_revoke(consumer: Consumer, partitions: List[TopicPartition]):
+        # The dropped messages are consumed again after the seek of the next assignment
+        apply_thread.reset()
+        prefetch.forget(partitions)
 
     while True:
         try:
-            consumer.subscribe([server_topic])
+            consumer.subscribe(
+                [server_topic], on_assign=seek_to_stored_offsets, on_revoke=on_revoke
+            )
 
             while True:
+                if apply_thread.error is not None:
+                    raise apply_thread.error
+                prefetch.update(consumer)
                 msg = consumer.poll(1.0)
+                if status is not None:
+                    status.publish(consumer)
                 if msg is None:
                     continue
                 if msg.error():
                     if msg.error().code() == KafkaError._PARTITION_EOF:
-                        logging.info("Reached end of topic. Client is Up2Date")
-                    if msg.error():
-                        raise KafkaException(msg.error())
+                        logging.info(
+                            f"Reached end of partition {msg.partition()}. Client is Up2Date"
+                        )
+                        continue
+                    raise KafkaException(msg.error())
                 if msg.value() is None:
                     continue  # Tombstone message for key that was deleted
                 else:
-                    handler.handle_message(msg)
+                    prefetch.put(msg)
+                if catchup is not None:
+                    catchup.update(consumer, [msg])
 
         except Exception as e:
             print("Error:", e)
             print("Trying to reconnect...")
+            # The prefetched messages are dropped. Unsubscribing revokes the partitions,
+            # the next assignment seeks back to the last applied offsets
+            apply_thread.reset()
+            consumer.unsubscribe()
             time.sleep(5)  # Wait for 5 seconds before trying to reconnect
 
 
 if __name__ == "__main__":
+    event_log.every = max(LOG_SAMPLE_RATE, 1)
+    start_http_server(METRICS_PORT)
+
     lww_strategy_client = LWWStrategy_Client()
-    lww_handler_client = Handler(lww_strategy_client)
+    lww_handler_client = Handler(lww_strategy_client, client_id=CLIENT_ID)
+    dlq = DeadLetterQueue(
+        lww_handler_client,
+        retry_interval=DLQ_RETRY_INTERVAL,
+        max_backoff=DLQ_MAX_BACKOFF,
+        max_attempts=DLQ_MAX_ATTEMPTS,
+    )
+    dlq.start()
+
+    bootstrap_servers = "kafka:9092"
+    server_topic = "server-topic.public.todos"
+    if BOOTSTRAP == "auto" and needs_bootstrap(server_topic):
+        wait_for_kafka(bootstrap_servers)
+        bootstrap_from_snapshot(bootstrap_servers, server_topic, CLIENT_ID)
+
+    catchup = None
+    if CATCHUP_LAG_THRESHOLD > 0:
+        catchup = CatchUp(CATCHUP_LAG_THRESHOLD, batch_size=CATCHUP_BATCH_SIZE)
 
     sync_consumer(
-        bootstrap_servers="kafka:9092",
-        server_topic="server-topic.public.todos",
-        handler=lww_handler_client,
+        bootstrap_servers=bootstrap_servers,
+        server_topic=server_topic,
+        handler=DeadLetterHandler(lww_handler_client, dlq),
+        catchup=catchup,
+        status=SyncStatusReporter(STATUS_INTERVAL),
     )
@@ -0,0 +1,150 @@
+import os
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Optional, Tuple
+
+from broadcast import Batch, ChangeBroadcaster, broadcaster, crud_todo, todo_change
+from engine import db_session
+from schemas import TODO_FIELDS, TodoChange
+
+# The change_seq and the fields of a todo
+Entry = Tuple[Optional[int], dict]
+
+
+class TodoView:
+    """An in-memory copy of the todos that serves GET /todo and GET /todo/{client_id}/{id}.
+
+    It is loaded once and then updated by the broadcaster thread only. Every read of the
+    change feed is followed by a read of the changes that are not final yet, so the copy
+    follows the writes of the API and of the sync worker as soon as they are notified.
+    As all reads are made one after another on that thread, the newest read always wins
+    and no change can overwrite a newer one.
+
+    The write routes call `wait_for_update`, so a client reads its own writes.
+    """
+
+    def __init__(self, broadcaster: ChangeBroadcaster, wait_timeout: float = 1.0):
+        self.broadcaster = broadcaster
+        self.wait_timeout = wait_timeout
+        self.ready = False
+        self._lock = threading.Lock()
+        self._todos: Dict[Tuple[str, int], Entry] = {}
+        # The keys of `_todos` in (client_id, id) order
+        self._keys: List[Tuple[str, int]] = []
+        # The change feed has been applied up to this cursor, see the ETag of GET /todo
+        self._position: Tuple = (0,)
+        self._version = 0
+        # Distinguishes the ETags of the copies of different processes and restarts
+        self._instance = os.urandom(4).hex()
+        self._updated = threading.Condition()
+        self._updates_started = 0
+        # The number of the last update that has been applied
+        self._updates_applied = 0
+
+    def load(self) -> Tuple:
+        """Loads the todos and returns the cursor of the change feed the broadcaster has to
+        start from."""
+        with db_session() as db:
+            # Changes that commit while the todos are read have a change_seq of at least
+            # the horizon, they are read again from the change feed
+            horizon = crud_todo.change_horizon(db)
+            todos: Dict[Tuple[str, int], Entry] = {}
+            for rows in crud_todo.stream_rows(db, fields=TODO_FIELDS + ("change_seq",)):
+                for row in rows:
+                    fields = row._asdict()
+                    todos[(row.client_id, row.id)] = (fields.pop("change_seq"), fields)
+        with self._lock:
+            self._todos = todos
+            # Python orders the client_ids by code point, the pages of GET /todo from
+            # the copy are consistent, but may differ from the collation of the database
+            self._keys = sorted(todos)
+            self._position = (horizon,)
+        self.broadcaster.add_listener(self.update)
+        self.ready = True
+        return self._position
+
+    def version(self) -> Tuple[str, Tuple]:
+        """Get the ETag of the current todos and the cursor of the change feed they
+        include."""
+        with self._lock:
+            return f'"{self._instance}-{self._version}"', self._position
+
+    def get(self, client_id: str, todo_id: int) -> Optional[Entry]:
+        return self._todos.get((client_id, todo_id))
+
+    def page(
+        self,
+        *,
+        after: Optional[Tuple[str, int]] = None,
+        limit: int = 100,
+        completed: Optional[bool] = None,
+        title_prefix: Optional[str] = None,
+    ) -> List[dict]:
+        """Get the fields of the todos following the (client_id, id) key `after` in key
+        order, like CRUDTodo.get_page_rows. The dicts must not be modified."""
+        page = []
+        with self._lock:
+            start = bisect_right(self._keys, after) if after is not None else 0
+            for i in range(start, len(self._keys)):
+                fields = self._todos[self._keys[i]][1]
+                if completed is not None and fields["completed"] != completed:
+                    continue
+                if title_prefix and not (fields["title"] or "").startswith(title_prefix):
+                    continue
+                page.append(fields)
+                if len(page) == limit:
+                    break
+        return page
+
+    def wait_for_update(self):
+        """Waits until the changes committed before the call are in the copy, at most
+        `wait_timeout` seconds."""
+        if not self.ready:
+            return
+        with self._updated:
+            # Only an update that starts after this call reads these changes
+            target = self._updates_started + 1
+            self.broadcaster.wake()
+            self._updated.wait_for(
+                lambda: self._updates_applied >= target, self.wait_timeout
+            )
+
+    def update(self, batches: List[Batch]):
+        """Applies the batches read from the change feed and the changes following them,
+        called on the broadcaster thread."""
+        with self._updated:
+            self._updates_started += 1
+            number = self._updates_started
+        position = batches[-1][0]
+        with db_session() as db:
+            recent = crud_todo.get_recent_changes(db, since=position[0])
+        changes = [(key[0], change) for _, items in batches for key, change in items] + [
+            (change.change_seq, todo_change(change)) for change in recent
+        ]
+        with self._lock:
+            changed = [self._apply(change_seq, change) for change_seq, change in changes]
+            self._position = position
+            if any(changed):
+                self._version += 1
+        with self._updated:
+            self._updates_applied = number
+            self._updated.notify_all()
+
+    def _apply(self, change_seq: Optional[int], change: TodoChange) -> bool:
+        key = (change.client_id, change.id)
+        if change.deleted:
+            if self._todos.pop(key, None) is None:
+                return False
+            del self._keys[bisect_left(self._keys, key)]
+            return True
+        entry = (change_seq, change.todo.model_dump())
+        current = self._todos.get(key)
+        if current == entry:
+            return False
+        if current is None:
+            insort(self._keys, key)
+        self._todos[key] = entry
+        return True
+
+
+todo_view = TodoView(broadcaster)
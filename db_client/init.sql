@@ -6,12 +6,122 @@ CREATE TABLE todos (
     completed BOOLEAN,
     created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    -- Client whose write produced the current state of the row
+    origin VARCHAR,
+    -- Id of the transaction that last wrote the row, set by todos_track_change
+    change_seq BIGINT,
     PRIMARY KEY (id, client_id)
 );
 
-CREATE INDEX idx_todos_client_id ON todos(client_id);
-CREATE INDEX idx_todos_title ON todos(title);
-CREATE INDEX idx_todos_description ON todos(description);
-CREATE INDEX idx_todos_completed ON todos(completed);
+-- The key order of the pages of GET /todo, also serves lookups by client_id
+CREATE INDEX idx_todos_client_id_id ON todos(client_id, id);
+-- text_pattern_ops lets the title prefix filter of GET /todo use the index
+CREATE INDEX idx_todos_title ON todos(title text_pattern_ops);
+-- Pages filtered by completed are read in key order from this index
+CREATE INDEX idx_todos_completed ON todos(completed, client_id, id);
+-- Full-text index of GET /todo/search. GIN does not limit the length of descriptions
+-- like a btree does and collects new entries in its pending list, see fastupdate.
+CREATE INDEX idx_todos_search ON todos USING GIN (
+    to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(description, ''))
+);
 
 ALTER TABLE todos REPLICA IDENTITY FULL;
+
+-- Keys of deleted todos for GET /todo/changes, a todo created again drops its key
+CREATE TABLE todo_deletions (
+    id INTEGER,
+    client_id VARCHAR,
+    change_seq BIGINT NOT NULL,
+    deleted_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, client_id)
+);
+
+-- The change feed reads the changes in (change_seq, client_id, id) order
+CREATE INDEX idx_todos_change_seq ON todos(change_seq, client_id, id);
+CREATE INDEX idx_todo_deletions_change_seq ON todo_deletions(change_seq, client_id, id);
+
+-- Every write stamps the row with the id of its transaction. Unlike a sequence value,
+-- the ids of all transactions below the xmin of a snapshot are final, which lets the
+-- feed hand out cursors that never skip a change committed late.
+CREATE FUNCTION todos_track_change() RETURNS trigger AS $$
+BEGIN
+    NEW.change_seq := txid_current();
+    IF TG_OP = 'INSERT' THEN
+        DELETE FROM todo_deletions WHERE id = NEW.id AND client_id = NEW.client_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER todos_track_change BEFORE INSERT OR UPDATE ON todos
+    FOR EACH ROW EXECUTE FUNCTION todos_track_change();
+
+CREATE FUNCTION todos_track_deletion() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO todo_deletions (id, client_id, change_seq)
+    VALUES (OLD.id, OLD.client_id, txid_current())
+    ON CONFLICT (id, client_id) DO UPDATE
+    SET change_seq = excluded.change_seq, deleted_at = excluded.deleted_at;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER todos_track_deletion AFTER DELETE ON todos
+    FOR EACH ROW EXECUTE FUNCTION todos_track_deletion();
+
+-- Wakes up the change broadcaster of the API, see broadcast.py. The notification is
+-- delivered on commit, once per transaction.
+CREATE FUNCTION todos_notify_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('todo_changes', txid_current()::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER todos_notify_change AFTER INSERT OR UPDATE OR DELETE ON todos
+    FOR EACH STATEMENT EXECUTE FUNCTION todos_notify_change();
+
+-- Next offset to consume per partition of the server topic, written in the same
+-- transaction as the changes of the applied events
+CREATE TABLE sync_offsets (
+    topic VARCHAR,
+    partition INTEGER,
+    "offset" BIGINT NOT NULL,
+    PRIMARY KEY (topic, partition)
+);
+
+-- Progress of the sync per partition of the server topic, reported periodically by
+-- the sync worker for the /sync/status route
+CREATE TABLE sync_status (
+    topic VARCHAR,
+    partition INTEGER,
+    high_watermark BIGINT,
+    applied_per_second DOUBLE PRECISION NOT NULL DEFAULT 0,
+    last_applied_at TIMESTAMPTZ,
+    last_event_at TIMESTAMPTZ,
+    reported_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (topic, partition)
+);
+
+-- Messages that could not be applied, retried with backoff. Later messages of a todo
+-- with a dead letter are parked here as well to keep the order of its changes.
+CREATE TABLE dead_letters (
+    id SERIAL PRIMARY KEY,
+    topic VARCHAR NOT NULL,
+    partition INTEGER NOT NULL,
+    "offset" BIGINT NOT NULL,
+    todo_id INTEGER,
+    todo_client_id VARCHAR,
+    key BYTEA,
+    value BYTEA,
+    error VARCHAR,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    next_attempt_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    -- Set once the message failed DLQ_MAX_ATTEMPTS times, it is no longer retried
+    given_up_at TIMESTAMPTZ,
+    UNIQUE (topic, partition, "offset")
+);
+
+CREATE INDEX idx_dead_letters_next_attempt_at ON dead_letters(next_attempt_at);
+CREATE INDEX idx_dead_letters_todo ON dead_letters(todo_id, todo_client_id);
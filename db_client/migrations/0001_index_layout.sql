@@ -0,0 +1,24 @@
+-- Moves the indexes of a client database to the layout of init.sql: drops the indexes
+-- no query uses and adds the index of GET /todo/search. Only the indexes are changed,
+-- the tables, columns and triggers of init.sql must exist already.
+-- Run it with psql outside of a transaction, CONCURRENTLY keeps the todos writable:
+--   psql -U postgres -f 0001_index_layout.sql
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_todos_description;
+-- The original init.sql created indexes with these names on the single columns, they
+-- are created again below with the columns and operator classes the queries need
+DROP INDEX CONCURRENTLY IF EXISTS idx_todos_client_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_todos_title;
+DROP INDEX CONCURRENTLY IF EXISTS idx_todos_completed;
+-- Created by SQLAlchemy for the `index=True` columns if it created the table
+DROP INDEX CONCURRENTLY IF EXISTS ix_todos_client_id;
+DROP INDEX CONCURRENTLY IF EXISTS ix_todos_title;
+DROP INDEX CONCURRENTLY IF EXISTS ix_todos_description;
+DROP INDEX CONCURRENTLY IF EXISTS ix_todos_completed;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_todos_client_id_id ON todos(client_id, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_todos_title ON todos(title text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_todos_completed ON todos(completed, client_id, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_todos_search ON todos USING GIN (
+    to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(description, ''))
+);
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from async_handler import AsyncHandler
+from catchup import CatchUp
+from confluent_kafka import Consumer, KafkaException, Message, TopicPartition
+from consumer import log_assign, log_revoke, next_offsets, store_tracked_offsets
+from metrics import record_consumer_lag
+from prefetch import Backpressure
+from workers import OffsetTracker, shard_key
+
+
+async def wait_for_kafka_async(
+    bootstrap_servers: str, max_retries=10, delay=5
+) -> bool:
+    """Wait for Kafka to be ready without blocking the event loop."""
+    host, port = bootstrap_servers.split(":")
+
+    for _ in range(max_retries):
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, int(port)), timeout=1
+            )
+            writer.close()
+            await writer.wait_closed()
+            logging.info("Kafka is ready!")
+            return True
+        except (OSError, asyncio.TimeoutError):
+            logging.info(f"Kafka is not ready yet. Retrying in {delay} seconds.")
+            await asyncio.sleep(delay)
+
+    logging.error("Kafka is not ready after waiting for a while.")
+    raise Exception("Kafka is not ready after waiting for a while.")
+
+
+class AsyncApplier:
+    """Applies messages as asyncio tasks, at most `max_in_flight` at once.
+
+    The messages of a consumed batch are grouped by their (id, client_id) key and every
+    group becomes one task. A task waits for the previous task of the same key, so all
+    changes of a todo are applied in the order they were consumed, while unrelated todos
+    of all client topics are applied concurrently.
+
+    Submitting never blocks the consumer loop. The scheduled messages are bounded by the
+    Backpressure, which pauses the partitions of the consumer while the tasks fall behind.
+    """
+
+    def __init__(
+        self,
+        handler: AsyncHandler,
+        max_in_flight: int,
+        tracker: OffsetTracker,
+        backpressure: Backpressure,
+    ):
+        self.handler = handler
+        self.tracker = tracker
+        self.backpressure = backpressure
+        self._error: Optional[BaseException] = None
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tails: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._tasks: set = set()
+
+    def submit(self, msgs: List[Message]):
+        """Schedules the messages as tasks."""
+        groups: Dict[Tuple[int, str], List[Message]] = {}
+        for msg in msgs:
+            self.tracker.track(msg)
+            self.backpressure.reserve(msg)
+            groups.setdefault(shard_key(msg), []).append(msg)
+
+        for key, group in groups.items():
+            task = asyncio.create_task(self._apply(group, self._tails.get(key)))
+            self._tails[key] = task
+            self._tasks.add(task)
+            task.add_done_callback(lambda t, key=key: self._done(key, t))
+
+    async def drain(self):
+        """Waits until every submitted message has been processed."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def raise_if_failed(self):
+        """Re-raises the first error of a task in the consumer loop."""
+        if self._error is not None:
+            raise self._error
+
+    async def _apply(self, msgs: List[Message], previous: Optional[asyncio.Task]):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            if self._error is not None:
+                return  # Do not apply anything past a failed message
+            # Acquired only after the previous task of the key is done, so a waiting
+            # task never holds a slot
+            async with self._slots:
+                if len(msgs) == 1:
+                    await self.handler.handle_message(msgs[0])
+                else:
+                    await self.handler.handle_batch(msgs)
+            for msg in msgs:
+                self.tracker.ack(msg)
+        except Exception as e:
+            logging.exception("Applying messages failed")
+            self._error = e
+        finally:
+            for msg in msgs:
+                self.backpressure.release(msg)
+
+    def _done(self, key: Tuple[int, str], task: asyncio.Task):
+        self._tasks.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+
+async def consume_kafka_messages_async(
+    bootstrap_servers: str,
+    topic_pattern: str,
+    handler: AsyncHandler,
+    batch_size: int = 500,
+    batch_timeout: float = 0.1,
+    metadata_refresh_ms: int = 5000,
+    max_in_flight: int = 16,
+    max_buffered_messages: int = 10000,
+    max_buffered_bytes: int = 64 * 1024 * 1024,
+    catchup: Optional[CatchUp] = None,
+):
+    """Consume all client topics and apply the messages concurrently on the event loop.
+
+    confluent-kafka has no asyncio API, so `consume` runs on a dedicated thread while
+    the loop keeps applying the previous messages. Offsets are stored once every message
+    before them has been applied, like with the worker threads of `consume_kafka_messages`.
+    While catching up on a backlog, the tasks are drained and every consumed batch is
+    merged at once.
+
+    Args:
+        bootstrap_servers (str): The Kafka bootstrap servers
+        topic_pattern (str): Regex matching the client topics
+        handler (AsyncHandler): The handler that applies the messages
+        batch_size (int): Maximum number of messages consumed at once
+        batch_timeout (float): Maximum time in seconds to wait for a batch to fill up
+        metadata_refresh_ms (int): Interval in which new client topics are discovered
+        max_in_flight (int): Maximum number of message groups applied at once
+        max_buffered_messages (int): Messages scheduled on the loop before the partitions
+            are paused
+        max_buffered_bytes (int): Bytes scheduled on the loop before the partitions are
+            paused
+        catchup (CatchUp): Decides when to catch up with bulk merges, None disables them
+    """
+    await wait_for_kafka_async(bootstrap_servers)
+
+    loop = asyncio.get_running_loop()
+    poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kafka-poll")
+    tracker = OffsetTracker()
+    backpressure = Backpressure(max_buffered_messages, max_buffered_bytes)
+    applier = AsyncApplier(handler, max_in_flight, tracker, backpressure)
+
+    c = Consumer(
+        {
+            "bootstrap.servers": bootstrap_servers,
+            "group.id": "server-consumer-group",
+            "auto.offset.reset": "earliest",
+            "enable.auto.offset.store": False,
+            "topic.metadata.refresh.interval.ms": metadata_refresh_ms,
+            "partition.assignment.strategy": "cooperative-sticky",
+            # Publishes the consumer lag per partition, see metrics.py
+            "statistics.interval.ms": 5000,
+            "stats_cb": record_consumer_lag,
+        }
+    )
+
+    def on_revoke(c: Consumer, partitions: List[TopicPartition]):
+        # Called on the poll thread from within `consume`
+        log_revoke(c, partitions)
+        asyncio.run_coroutine_threadsafe(applier.drain(), loop).result()
+        store_tracked_offsets(c, tracker)
+        tracker.forget(partitions)
+        backpressure.forget(partitions)
+
+    def poll(num_messages: int, timeout: float) -> List[Message]:
+        # Pausing and resuming happens on the poll thread as well
+        backpressure.update(c)
+        return c.consume(num_messages=num_messages, timeout=timeout)
+
+    c.subscribe([topic_pattern], on_assign=log_assign, on_revoke=on_revoke)
+    logging.info(f"Subscribed to topic pattern: {topic_pattern}")
+
+    try:
+        while True:
+            applier.raise_if_failed()
+            if catchup is not None and catchup.active:
+                await applier.drain()
+                store_tracked_offsets(c, tracker)
+                msgs = await loop.run_in_executor(
+                    poll_executor, poll, catchup.batch_size, catchup.batch_timeout
+                )
+                batch = []
+                for msg in msgs:
+                    if msg.error():
+                        raise KafkaException(msg.error())
+                    if msg.value() is not None:  # None is a tombstone message
+                        batch.append(msg)
+                if batch:
+                    await handler.handle_bulk(batch)
+                if msgs:
+                    c.store_offsets(offsets=next_offsets(msgs))
+                catchup.update(c, msgs)
+                continue
+
+            msgs = await loop.run_in_executor(poll_executor, poll, batch_size, batch_timeout)
+
+            batch = []
+            for msg in msgs:
+                if msg.error():
+                    raise KafkaException(msg.error())
+                if msg.value() is None:
+                    # Tombstone message for key that was deleted
+                    tracker.track(msg)
+                    tracker.ack(msg)
+                    continue
+                batch.append(msg)
+
+            if batch:
+                applier.submit(batch)
+            store_tracked_offsets(c, tracker)
+            if catchup is not None:
+                catchup.update(c, msgs)
+    finally:
+        await applier.drain()
+        store_tracked_offsets(c, tracker)
+        await loop.run_in_executor(poll_executor, c.close)
+        poll_executor.shutdown()
@@ -0,0 +1,27 @@
+import os
+from contextlib import asynccontextmanager
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+pg_host = os.environ.get("POSTGRES_HOST")
+pg_port = os.environ.get("POSTGRES_PORT")
+pg_user = os.environ.get("POSTGRES_USER")
+pg_password = os.environ.get("POSTGRES_PASSWORD")
+# Bounds the DB operations that are in flight at once, see MAX_IN_FLIGHT in main.py
+pool_size = int(os.environ.get("DB_POOL_SIZE", "5"))
+
+async_engine = create_async_engine(
+    f"postgresql+asyncpg://{pg_user}:{pg_password}@{pg_host}:{pg_port}",
+    pool_size=pool_size,
+)
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
+
+@asynccontextmanager
+async def get_async_db():
+    """Create a new async database session for each message or batch."""
+    async with AsyncSessionLocal() as db:
+        yield db
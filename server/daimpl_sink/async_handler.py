@@ -0,0 +1,261 @@
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Set, Tuple
+
+from async_engine import get_async_db
+from cache import RowCache
+from catchup import bulk_merge_async
+from confluent_kafka import Message
+from handler import Handler, LWWStrategy_Server, MsgType, crud_todo, row_key
+from metrics import COMMIT_DURATION, CONFLICTS, EVENTS_APPLIED, STAGE_LATENCY, event_log
+from rows import Row, row_from_orm, row_to_dict
+from schemas import TodoCreate
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class AsyncAbstractStrategy(ABC):
+    """Async equivalent of AbstractStrategy, the methods are awaited by the AsyncHandler."""
+
+    @abstractmethod
+    async def handle_create(self, msg: Tuple[Dict, Dict]):
+        pass
+
+    @abstractmethod
+    async def handle_update(self, msg: Tuple[Dict, Dict]):
+        pass
+
+    @abstractmethod
+    async def handle_delete(self, msg: Tuple[Dict, Dict]):
+        pass
+
+    async def handle_batch(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        """Handles a batch of decoded events in order. Strategies can override this to
+        apply the whole batch at once."""
+        for msg_type, msg in events:
+            if msg_type == MsgType.CREATE:
+                await self.handle_create(msg)
+            elif msg_type == MsgType.UPDATE:
+                await self.handle_update(msg)
+            elif msg_type == MsgType.DELETE:
+                await self.handle_delete(msg)
+
+    async def handle_bulk(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        """Async equivalent of AbstractStrategy.handle_bulk."""
+        async with get_async_db() as db:
+            with STAGE_LATENCY.labels(stage="merge").time():
+                await bulk_merge_async(db, events)
+            try:
+                with COMMIT_DURATION.time():
+                    await db.commit()
+            except SQLAlchemyError as e:
+                await db.rollback()
+                raise e
+
+
+class AsyncLWWStrategy_Server(AsyncAbstractStrategy):
+    """Last-Write-Wins strategy on an AsyncSession.
+
+    The LWW decisions are the ones of LWWStrategy_Server, only loading and writing the
+    rows is awaited.
+    """
+
+    def __init__(self, cache: Optional[RowCache] = None):
+        self.cache = cache
+        self.resolver = LWWStrategy_Server(cache=cache)
+
+    async def handle_create(self, msg: Tuple[Dict, Dict]):
+        await self.handle_batch([(MsgType.CREATE, msg)])
+
+    async def handle_update(self, msg: Tuple[Dict, Dict]):
+        await self.handle_batch([(MsgType.UPDATE, msg)])
+
+    async def handle_delete(self, msg: Tuple[Dict, Dict]):
+        await self.handle_batch([(MsgType.DELETE, msg)])
+
+    async def handle_batch(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        keys = {row_key(msg) for _, msg in events}
+
+        async with get_async_db() as db:
+            with STAGE_LATENCY.labels(stage="load").time():
+                rows = await self.load_rows(db, keys)
+            loaded_rows = dict(rows)
+
+            with STAGE_LATENCY.labels(stage="resolve").time():
+                self.resolver.resolve_batch(events, rows)
+
+            try:
+                with STAGE_LATENCY.labels(stage="write").time():
+                    await self.write_rows(db, loaded_rows, rows)
+            except SQLAlchemyError as e:
+                if self.cache is not None:
+                    self.cache.invalidate(keys)
+                raise e
+
+        if self.cache is not None:
+            self.cache.put_many(rows)
+
+    async def handle_bulk(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        try:
+            await super().handle_bulk(events)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate({row_key(msg) for _, msg in events})
+
+    async def load_rows(
+        self, db: AsyncSession, keys: Set[Tuple[int, str]]
+    ) -> Dict[Tuple[int, str], Optional[Row]]:
+        """Get the current state of the rows, from the cache where possible. Missing rows are None."""
+        rows: Dict[Tuple[int, str], Optional[Row]] = {}
+        missing = list(keys)
+        if self.cache is not None:
+            rows, missing = self.cache.get_many(keys)
+
+        rows.update({key: None for key in missing})
+        if missing:
+            result = await db.execute(crud_todo.get_many_stmt(missing))
+            rows.update(
+                {
+                    (db_todo.id, db_todo.client_id): row_from_orm(db_todo)
+                    for db_todo in result.scalars()
+                }
+            )
+        return rows
+
+    async def write_rows(
+        self,
+        db: AsyncSession,
+        loaded_rows: Dict[Tuple[int, str], Optional[Row]],
+        rows: Dict[Tuple[int, str], Optional[Row]],
+    ):
+        """Writes the resolved row states that differ from the loaded rows and commits once."""
+        for (todo_id, client_id), row in rows.items():
+            loaded_row = loaded_rows[(todo_id, client_id)]
+            if row == loaded_row:
+                continue
+            if row is None:
+                stmt = crud_todo.delete_by_key_stmt(id=todo_id, client_id=client_id)
+            elif loaded_row is None:
+                stmt = crud_todo.create_stmt(TodoCreate(**row_to_dict(row)))
+            else:
+                stmt = crud_todo.update_by_key_stmt(
+                    id=todo_id, client_id=client_id, obj_in=TodoCreate(**row_to_dict(row))
+                )
+            await db.execute(stmt)
+
+        try:
+            with COMMIT_DURATION.time():
+                await db.commit()
+        except SQLAlchemyError as e:
+            await db.rollback()
+            raise e
+
+
+class AsyncUpsertLWWStrategy_Server(AsyncAbstractStrategy):
+    """Async equivalent of UpsertLWWStrategy_Server, every event is a single statement."""
+
+    async def handle_create(self, msg: Tuple[Dict, Dict]):
+        await self.handle_batch([(MsgType.CREATE, msg)])
+
+    async def handle_update(self, msg: Tuple[Dict, Dict]):
+        await self.handle_batch([(MsgType.UPDATE, msg)])
+
+    async def handle_delete(self, msg: Tuple[Dict, Dict]):
+        await self.handle_batch([(MsgType.DELETE, msg)])
+
+    async def handle_batch(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        async with get_async_db() as db:
+            with STAGE_LATENCY.labels(stage="write").time():
+                for msg_type, msg in events:
+                    event_log.sample()
+                    if msg_type == MsgType.CREATE:
+                        await self.apply_create(db, msg)
+                    elif msg_type == MsgType.UPDATE:
+                        await self.apply_update(db, msg)
+                    elif msg_type == MsgType.DELETE:
+                        await self.apply_delete(db, msg)
+                    EVENTS_APPLIED.labels(op=msg_type.name.lower()).inc()
+
+            try:
+                with COMMIT_DURATION.time():
+                    await db.commit()
+            except SQLAlchemyError as e:
+                await db.rollback()
+                raise e
+
+    async def apply_create(self, db: AsyncSession, msg: Tuple[Dict, Dict]):
+        event_log.info("CREATE REQUEST")
+        after_obj = msg[1].get("payload", {}).get("after", {})
+
+        logging.debug("after_obj: %s", after_obj)
+        result = await db.execute(crud_todo.insert_if_absent_stmt(TodoCreate(**after_obj)))
+        if result.first() is not None:
+            event_log.info("CREATED")
+        else:
+            event_log.info("Item exists. Skipping create...")
+            CONFLICTS.labels(type="blocked_create").inc()
+
+    async def apply_update(self, db: AsyncSession, msg: Tuple[Dict, Dict]):
+        event_log.info("UPDATE REQUEST")
+        after_obj = msg[1].get("payload", {}).get("after", {})
+
+        logging.debug("after_obj: %s", after_obj)
+        result = await db.execute(crud_todo.upsert_if_newer_stmt(TodoCreate(**after_obj)))
+        if result.first() is not None:
+            event_log.info("UPDATED")
+        else:
+            event_log.info("After is not newer than the server instance. Skipping update.")
+            CONFLICTS.labels(type="stale_skip").inc()
+
+    async def apply_delete(self, db: AsyncSession, msg: Tuple[Dict, Dict]):
+        event_log.info("DELETE REQUEST")
+        todo_id, client_id = row_key(msg)
+        result = await db.execute(crud_todo.delete_by_key_stmt(id=todo_id, client_id=client_id))
+        if result.rowcount:
+            event_log.info("DELETED")
+        else:
+            event_log.info("SYNC detected. Skipping...")
+            CONFLICTS.labels(type="sync_skip").inc()
+
+
+class AsyncHandler(Handler):
+    """Handler that awaits an AsyncAbstractStrategy. Decoding is shared with the Handler."""
+
+    async def handle_message(self, msg: Message):
+        """Processes a message from the Kafka Consumer by awaiting the appropriate strategy method.
+
+        Args:
+            msg (Message): The Kafka (Confluent) Message
+        """
+
+        msg_type, event = self.decode_message(msg)
+
+        if self.is_echo(msg, msg_type, event[1]):
+            return
+        if msg_type == MsgType.CREATE:
+            await self.strategy.handle_create(event)
+        elif msg_type == MsgType.UPDATE:
+            await self.strategy.handle_update(event)
+        elif msg_type == MsgType.DELETE:
+            await self.strategy.handle_delete(event)
+        else:
+            logging.error(f"Invalid message type received: {msg_type}")
+            raise ValueError(f"Invalid message type: {msg_type}")
+
+    async def handle_batch(self, msgs: List[Message]):
+        """Processes a batch of messages from the Kafka Consumer with a single strategy call.
+
+        Args:
+            msgs (List[Message]): The Kafka (Confluent) Messages in the order they were consumed
+        """
+
+        events = self.decode_batch(msgs)
+        if events:
+            await self.strategy.handle_batch(events)
+
+    async def handle_bulk(self, msgs: List[Message]):
+        """Async equivalent of Handler.handle_bulk."""
+
+        events = self.decode_batch(msgs, coalesce=True)
+        if events:
+            await self.strategy.handle_bulk(events)
@@ -0,0 +1,83 @@
+"""Benchmark of the LWW comparison of an update event.
+
+Compares the previous path, which validates the stored row and the event's before and
+after objects as Pydantic Todos, with the Row tuples of rows.py. No database is needed.
+
+Usage: python bench_compare.py [events]
+"""
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from rows import UPDATED_AT, row_from_dict, row_from_orm
+from schemas import Todo
+
+START = datetime(2023, 8, 29, 21, 30, 45, 571164, tzinfo=timezone.utc)
+
+
+def timestamp(i: int) -> str:
+    return (START + timedelta(seconds=i)).isoformat().replace("+00:00", "Z")
+
+
+def make_event(i: int):
+    """An update of a todo whose stored row equals the event's before object."""
+    before = {
+        "id": i,
+        "client_id": "client-1",
+        "title": f"todo {i}",
+        "description": "some description",
+        "completed": False,
+        "created_at": timestamp(0),
+        "updated_at": timestamp(i),
+        "origin": "client-1",
+    }
+    after = {**before, "completed": True, "updated_at": timestamp(i + 1)}
+    db_todo = SimpleNamespace(
+        **{
+            **before,
+            "created_at": START,
+            "updated_at": START + timedelta(seconds=i),
+        }
+    )
+    return db_todo, before, after
+
+
+def pydantic_path(db_todo, before_obj, after_obj):
+    parsed_db_todo = Todo.model_validate(db_todo)
+    parsed_before_obj = Todo.model_validate(before_obj)
+    parsed_after_obj = Todo.model_validate(after_obj)
+    if parsed_after_obj == parsed_db_todo:
+        return False
+    parsed_before_obj == parsed_db_todo
+    return parsed_after_obj.updated_at > parsed_db_todo.updated_at
+
+
+def row_path(db_todo, before_obj, after_obj):
+    parsed_db_todo = row_from_orm(db_todo)
+    parsed_before_obj = row_from_dict(before_obj)
+    parsed_after_obj = row_from_dict(after_obj)
+    if parsed_after_obj == parsed_db_todo:
+        return False
+    parsed_before_obj == parsed_db_todo
+    return parsed_after_obj[UPDATED_AT] > parsed_db_todo[UPDATED_AT]
+
+
+def run(name: str, compare, events):
+    start = time.perf_counter()
+    for event in events:
+        assert compare(*event)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {len(events) / elapsed:>12,.0f} events/s")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    events = [make_event(i) for i in range(count)]
+
+    run("Pydantic Todo (before)", pydantic_path, events)
+    run("Row tuples (after)", row_path, events)
+
+
+if __name__ == "__main__":
+    main()
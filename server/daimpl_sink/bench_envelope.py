@@ -0,0 +1,150 @@
+"""Microbenchmark of the Debezium envelope decoding.
+
+Compares the previous path (decode to str, json.loads of key and value) with the
+EnvelopeDecoder, with and without orjson.
+
+Usage: python bench_envelope.py [iterations]
+"""
+import json
+import sys
+import time
+
+import envelope
+from envelope import EnvelopeDecoder
+
+ZONED_TIMESTAMP = {
+    "type": "string",
+    "optional": True,
+    "name": "io.debezium.time.ZonedTimestamp",
+    "version": 1,
+    "default": "1970-01-01T00:00:00.000000Z",
+}
+ROW_FIELDS = [
+    {"type": "int32", "optional": False, "default": 0, "field": "id"},
+    {"type": "string", "optional": False, "field": "client_id"},
+    {"type": "string", "optional": True, "field": "title"},
+    {"type": "string", "optional": True, "field": "description"},
+    {"type": "boolean", "optional": True, "field": "completed"},
+    {**ZONED_TIMESTAMP, "field": "created_at"},
+    {**ZONED_TIMESTAMP, "field": "updated_at"},
+]
+ROW_SCHEMA = {
+    "type": "struct",
+    "fields": ROW_FIELDS,
+    "optional": True,
+    "name": "client-1-topic.public.todos.Value",
+}
+SOURCE_SCHEMA = {
+    "type": "struct",
+    "fields": [
+        {"type": "string", "optional": False, "field": field}
+        for field in ("version", "connector", "name", "db", "sequence", "schema", "table")
+    ]
+    + [
+        {"type": "int64", "optional": False, "field": field}
+        for field in ("ts_ms", "txId", "lsn", "xmin")
+    ],
+    "optional": False,
+    "name": "io.debezium.connector.postgresql.Source",
+    "field": "source",
+}
+
+
+def make_message(i: int):
+    row = {
+        "id": i,
+        "client_id": "client-1",
+        "title": f"todo {i}",
+        "description": "some description",
+        "completed": False,
+        "created_at": "2023-08-29T21:30:45.571164Z",
+        "updated_at": "2023-08-29T21:31:45.571164Z",
+    }
+    key = {
+        "schema": {
+            "type": "struct",
+            "fields": ROW_FIELDS[:2],
+            "optional": False,
+            "name": "client-1-topic.public.todos.Key",
+        },
+        "payload": {"id": i, "client_id": "client-1"},
+    }
+    value = {
+        "schema": {
+            "type": "struct",
+            "fields": [
+                {**ROW_SCHEMA, "field": "before"},
+                {**ROW_SCHEMA, "field": "after"},
+                SOURCE_SCHEMA,
+                {"type": "string", "optional": False, "field": "op"},
+                {"type": "int64", "optional": True, "field": "ts_ms"},
+            ],
+            "optional": False,
+            "name": "client-1-topic.public.todos.Envelope",
+        },
+        "payload": {
+            "before": row,
+            "after": {**row, "title": "changed"},
+            "source": {
+                "version": "2.3.2.Final",
+                "connector": "postgresql",
+                "name": "client-1-topic",
+                "ts_ms": 1693344645573,
+                "db": "postgres",
+                "sequence": '[null,"23958144"]',
+                "schema": "public",
+                "table": "todos",
+                "txId": 489,
+                "lsn": 23958144,
+                "xmin": None,
+            },
+            "op": "u",
+            "ts_ms": 1693344646076,
+            "transaction": None,
+        },
+    }
+    # The JSON converter writes compact JSON
+    return (
+        json.dumps(key, separators=(",", ":")).encode(),
+        json.dumps(value, separators=(",", ":")).encode(),
+    )
+
+
+def current_path(key: bytes, value: bytes):
+    return json.loads(key.decode("utf-8")), json.loads(value.decode("utf-8"))
+
+
+def run(name: str, decode, messages):
+    start = time.perf_counter()
+    for key, value in messages:
+        decode(key, value)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<32} {len(messages) / elapsed:>12,.0f} msg/s")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    messages = [make_message(i) for i in range(iterations)]
+    print(f"value size: {len(messages[0][1])} bytes")
+
+    run("json.loads (current)", current_path, messages)
+
+    decoder = EnvelopeDecoder()
+    run(
+        f"EnvelopeDecoder ({envelope.loads.__module__})",
+        lambda k, v: (decoder.decode_key(k), decoder.decode_value(v)),
+        messages,
+    )
+
+    if envelope.loads is not json.loads:
+        envelope.loads = json.loads
+        decoder = EnvelopeDecoder()
+        run(
+            "EnvelopeDecoder (json)",
+            lambda k, v: (decoder.decode_key(k), decoder.decode_value(v)),
+            messages,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Generic, Hashable, Iterable, List, Optional, Tuple, TypeVar
+
+RowType = TypeVar("RowType")
+
+
+class RowCache(Generic[RowType]):
+    """Size-bounded LRU cache of the current server rows keyed by (id, client_id).
+
+    Rows that are known not to exist are cached as None, so creates of new todos can be
+    decided without a lookup as well. The cache is only correct as long as the sink is
+    the only writer of the server database and updates it with every write it commits.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._rows: "OrderedDict[Hashable, Optional[RowType]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(
+        self, keys: Iterable[Hashable]
+    ) -> Tuple[Dict[Hashable, Optional[RowType]], List[Hashable]]:
+        """Looks up several keys at once.
+
+        Returns:
+            Tuple[Dict, List]: The cached rows and the keys that are not cached
+        """
+        cached = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in self._rows:
+                    self._rows.move_to_end(key)
+                    cached[key] = self._rows[key]
+                else:
+                    missing.append(key)
+            self.hits += len(cached)
+            self.misses += len(missing)
+        return cached, missing
+
+    def put_many(self, rows: Dict[Hashable, Optional[RowType]]):
+        """Stores the current state of rows, evicting the least recently used ones."""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            for key, row in rows.items():
+                self._rows[key] = row
+                self._rows.move_to_end(key)
+            while len(self._rows) > self.capacity:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, keys: Iterable[Hashable]):
+        with self._lock:
+            for key in keys:
+                self._rows.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._rows), "hits": self.hits, "misses": self.misses}
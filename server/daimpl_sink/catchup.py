@@ -0,0 +1,164 @@
+import io
+import logging
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from confluent_kafka import Consumer, Message, TopicPartition
+from events import MsgType, row_key
+from metrics import CATCHUP_ACTIVE, CONFLICTS, EVENTS_APPLIED
+from rows import ROW_FIELDS, UPDATE_FIELDS, row_from_dict
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+Event = Tuple[MsgType, Tuple[Dict, Dict]]
+
+STAGING_TABLE = "todos_catchup"
+STAGING_COLUMNS = ("op",) + ROW_FIELDS
+_OPS = {MsgType.CREATE: "c", MsgType.UPDATE: "u", MsgType.DELETE: "d"}
+
+_COLUMNS = ", ".join(ROW_FIELDS)
+_CREATE_STAGING = (
+    f"CREATE TEMP TABLE {STAGING_TABLE} ON COMMIT DROP AS "
+    f"SELECT ''::text AS op, * FROM todos WITH NO DATA"
+)
+# The statements of `bulk_merge`, executed in this order. Coalesced events contain every
+# key at most once per op and a delete of a key always precedes its create or update.
+_MERGE_DELETES = (
+    f"DELETE FROM todos t USING {STAGING_TABLE} s "
+    "WHERE s.op = 'd' AND t.id = s.id AND t.client_id = s.client_id"
+)
+_MERGE_CREATES = (
+    f"INSERT INTO todos ({_COLUMNS}) SELECT {_COLUMNS} FROM {STAGING_TABLE} "
+    "WHERE op = 'c' ON CONFLICT (id, client_id) DO NOTHING"
+)
+_MERGE_UPDATES = (
+    f"INSERT INTO todos ({_COLUMNS}) SELECT {_COLUMNS} FROM {STAGING_TABLE} "
+    "WHERE op = 'u' ON CONFLICT (id, client_id) DO UPDATE SET "
+    + ", ".join(f"{ROW_FIELDS[f]} = excluded.{ROW_FIELDS[f]}" for f in UPDATE_FIELDS)
+    + " WHERE excluded.updated_at > todos.updated_at"
+)
+
+
+class CatchUp:
+    """Decides from the consumer lag whether the consumer is catching up on a backlog.
+
+    The lag is the number of messages between the consumed messages and the high
+    watermarks of their partitions, as last reported by the brokers. Catch-up starts
+    once it reaches `lag_threshold` and ends when it falls below `lag_threshold / 10`.
+    Polls that return nothing, e.g. while partitions are paused, keep the mode.
+    """
+
+    def __init__(self, lag_threshold: int, batch_size: int = 10000, batch_timeout: float = 1.0):
+        self.lag_threshold = lag_threshold
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.active = False
+
+    def update(self, consumer: Consumer, msgs: List[Message]):
+        """Updates the mode after consuming `msgs`."""
+        if not msgs:
+            return
+        lag = consumer_lag(consumer, msgs)
+        if not self.active and lag >= self.lag_threshold:
+            logging.info(f"Consumer lag is {lag} messages. Catching up with bulk merges")
+            self.active = True
+        elif self.active and lag < self.lag_threshold / 10:
+            logging.info(f"Consumer lag is {lag} messages. Caught up")
+            self.active = False
+        CATCHUP_ACTIVE.set(int(self.active))
+
+
+def consumer_lag(consumer: Consumer, msgs: List[Message]) -> int:
+    """Get the messages behind the last consumed message of every partition of `msgs`."""
+    positions: Dict[Tuple[str, int], int] = {}
+    for msg in msgs:
+        if not msg.error():
+            positions[(msg.topic(), msg.partition())] = msg.offset() + 1
+    lag = 0
+    for (topic, partition), position in positions.items():
+        _, high = consumer.get_watermark_offsets(TopicPartition(topic, partition), cached=True)
+        if high >= 0:
+            lag += max(high - position, 0)
+    return lag
+
+
+def staged_rows(events: List[Event]) -> List[Tuple]:
+    """Get the rows of coalesced events in the order of STAGING_COLUMNS.
+
+    A delete stages the key of its row only.
+    """
+    rows = []
+    for msg_type, msg in events:
+        if msg_type == MsgType.DELETE:
+            todo_id, client_id = row_key(msg)
+            rows.append(("d", todo_id, client_id) + (None,) * (len(ROW_FIELDS) - 2))
+        else:
+            after_obj = msg[1].get("payload", {}).get("after", {})
+            rows.append((_OPS[msg_type],) + row_from_dict(after_obj))
+    return rows
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _count(events: List[Event], msg_type: MsgType) -> int:
+    return sum(1 for event_type, _ in events if event_type == msg_type)
+
+
+def _record(events: List[Event], created: int, updated: int):
+    for msg_type in _OPS:
+        EVENTS_APPLIED.labels(op=msg_type.name.lower()).inc(_count(events, msg_type))
+    CONFLICTS.labels(type="blocked_create").inc(_count(events, MsgType.CREATE) - created)
+    CONFLICTS.labels(type="stale_skip").inc(_count(events, MsgType.UPDATE) - updated)
+
+
+def bulk_merge(db: Session, events: List[Event]):
+    """Applies coalesced events with set-based LWW statements, without committing.
+
+    The rows are streamed into a temporary table with COPY and merged into `todos` with
+    one statement per op, with the decisions of UpsertLWWStrategy_Server: a delete always
+    deletes, a create never overwrites an existing row and an update creates the row or
+    overwrites it if it is newer.
+    """
+    buffer = io.StringIO()
+    for row in staged_rows(events):
+        buffer.write("\t".join(_copy_value(value) for value in row) + "\n")
+    buffer.seek(0)
+
+    db.execute(text(_CREATE_STAGING))
+    cursor = db.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {STAGING_TABLE} ({', '.join(STAGING_COLUMNS)}) FROM STDIN", buffer
+    )
+    db.execute(text(_MERGE_DELETES))
+    created = db.execute(text(_MERGE_CREATES)).rowcount
+    updated = db.execute(text(_MERGE_UPDATES)).rowcount
+    _record(events, created, updated)
+
+
+async def bulk_merge_async(db: AsyncSession, events: List[Event]):
+    """`bulk_merge` on an AsyncSession, the rows are copied with asyncpg."""
+    await db.execute(text(_CREATE_STAGING))
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        STAGING_TABLE, records=staged_rows(events), columns=list(STAGING_COLUMNS)
+    )
+    await db.execute(text(_MERGE_DELETES))
+    created = (await db.execute(text(_MERGE_CREATES))).rowcount
+    updated = (await db.execute(text(_MERGE_UPDATES))).rowcount
+    _record(events, created, updated)
@@ -0,0 +1,86 @@
+from typing import Dict, List, Tuple
+
+from events import MsgType, row_key
+from rows import parse_timestamp
+
+Event = Tuple[MsgType, Tuple[Dict, Dict]]
+
+_OPS = {MsgType.CREATE: "c", MsgType.UPDATE: "u", MsgType.DELETE: "d"}
+
+
+def coalesce_events(events: List[Event]) -> List[Event]:
+    """Folds the events of every (id, client_id) key into their net effect under LWW.
+
+    The events of a key are applied in order, so only the following matters:
+    - a delete removes the row whatever happened before it, everything up to the
+      last delete of a key collapses into that delete
+    - of the creates and updates after it, the row with the latest `updated_at` wins.
+      They collapse into a single event carrying that row, with the row the chain
+      started from as `before`. It is a create if the row is known to be deleted,
+      otherwise an update, which the strategies turn into a create for missing rows.
+
+    A key results in at most a delete followed by a create. Keys keep the order in
+    which they first appeared.
+    """
+    chains: Dict[Tuple[int, str], List[Event]] = {}
+    for event in events:
+        chains.setdefault(row_key(event[1]), []).append(event)
+
+    if len(chains) == len(events):
+        return events  # Every key occurs once, nothing to fold
+
+    coalesced = []
+    for chain in chains.values():
+        coalesced.extend(coalesce_chain(chain))
+    return coalesced
+
+
+def coalesce_chain(chain: List[Event]) -> List[Event]:
+    """Folds the events of a single key, see `coalesce_events`."""
+    last_delete = None
+    for i, (msg_type, _) in enumerate(chain):
+        if msg_type == MsgType.DELETE:
+            last_delete = i
+
+    if last_delete is None:
+        result, tail = [], chain
+    else:
+        result, tail = [chain[last_delete]], chain[last_delete + 1 :]
+
+    if len(tail) == 1:
+        result.append(tail[0])
+    elif tail:
+        newest = max(tail, key=lambda event: _updated_at(event))
+        msg_type = MsgType.CREATE if last_delete is not None else MsgType.UPDATE
+        key, value = newest[1]
+        payload = value.get("payload", {})
+        first_type, (_, first_value) = tail[0]
+        first_payload = first_value.get("payload", {})
+        # The row the chain starts from. A create starts from its own row, which is
+        # what the updates following it were based on
+        before = (
+            first_payload.get("after")
+            if first_type == MsgType.CREATE
+            else first_payload.get("before")
+        )
+        result.append(
+            (
+                msg_type,
+                (
+                    key,
+                    {
+                        "payload": {
+                            **payload,
+                            "op": _OPS[msg_type],
+                            "before": before,
+                        }
+                    },
+                ),
+            )
+        )
+    return result
+
+
+def _updated_at(event: Event):
+    after = event[1][1].get("payload", {}).get("after") or {}
+    return parse_timestamp(after.get("updated_at"))
@@ -1,22 +1,24 @@
 import logging
 import socket
 import time
-from typing import List, Protocol, Set
+from typing import List, Optional, Protocol
 
-from confluent_kafka import Consumer, KafkaException, Producer
+from catchup import CatchUp
+from confluent_kafka import Consumer, KafkaException, Message, TopicPartition
+from metrics import record_consumer_lag
+from prefetch import Backpressure
+from workers import OffsetTracker, ShardedApplier
 
 
 class MessageHandler(Protocol):
     def handle_message(self, msg):
         pass
 
+    def handle_batch(self, msgs):
+        pass
 
-def get_existing_topics(bootstrap_servers: str) -> Set[str]:
-    """Fetch all existing topics."""
-    conf = {"bootstrap.servers": bootstrap_servers}
-    p = Producer(conf)
-    metadata = p.list_topics(timeout=5)
-    return set(metadata.topics.keys())
+    def handle_bulk(self, msgs):
+        pass
 
 
 def wait_for_kafka(bootstrap_servers: str, max_retries=10, delay=5) -> bool:
@@ -41,9 +43,57 @@ def wait_for_kafka(bootstrap_servers: str, max_retries=10, delay=5) -> bool:
     raise Exception("Kafka is not ready after waiting for a while.")
 
 
+def log_assign(c: Consumer, partitions: List[TopicPartition]):
+    if partitions:
+        logging.info(f"Assigned partitions: {[(p.topic, p.partition) for p in partitions]}")
+
+
+def log_revoke(c: Consumer, partitions: List[TopicPartition]):
+    if partitions:
+        logging.info(f"Revoked partitions: {[(p.topic, p.partition) for p in partitions]}")
+
+
 def consume_kafka_messages(
-    bootstrap_servers: str, client_topics: List[str], handler: MessageHandler
+    bootstrap_servers: str,
+    topic_pattern: str,
+    handler: MessageHandler,
+    batch_size: int = 1,
+    batch_timeout: float = 1.0,
+    metadata_refresh_ms: int = 5000,
+    num_workers: int = 0,
+    max_buffered_messages: int = 10000,
+    max_buffered_bytes: int = 64 * 1024 * 1024,
+    catchup: Optional[CatchUp] = None,
 ):
+    """Consume all client topics and pass the messages to the handler.
+
+    The consumer subscribes to a topic pattern. librdkafka matches it against its cached
+    cluster metadata, which is refreshed in the background every `metadata_refresh_ms`.
+    Topics of new clients are picked up by an incremental (cooperative) rebalance,
+    so the partitions that are already assigned keep being consumed.
+
+    Offsets are stored for the periodic auto commit only after the messages before them
+    have been applied.
+
+    With `catchup` the consumer switches to bulk merges on the consumer thread while the
+    consumer lag is high, e.g. after the connectors were disconnected for a while.
+
+    Args:
+        bootstrap_servers (str): The Kafka bootstrap servers
+        topic_pattern (str): Regex matching the client topics, e.g. `^client-.*-topic\\.public\\.todos$`
+        handler (MessageHandler): The handler that applies the messages
+        batch_size (int): Maximum number of messages handed to the handler at once.
+            With a batch size of 1 every message is handled on its own.
+        batch_timeout (float): Maximum time in seconds to wait for a batch to fill up
+        metadata_refresh_ms (int): Interval in which new client topics are discovered
+        num_workers (int): Number of worker threads applying the messages in parallel.
+            With 0 workers the messages are applied on the consumer thread.
+        max_buffered_messages (int): Messages queued for the workers before the
+            partitions are paused
+        max_buffered_bytes (int): Bytes queued for the workers before the partitions
+            are paused
+        catchup (CatchUp): Decides when to catch up with bulk merges, None disables them
+    """
     wait_for_kafka(bootstrap_servers)
 
     c = Consumer(
@@ -51,38 +101,139 @@ def consume_kafka_messages(
             "bootstrap.servers": bootstrap_servers,
             "group.id": "server-consumer-group",
             "auto.offset.reset": "earliest",
+            "enable.auto.offset.store": False,
+            "topic.metadata.refresh.interval.ms": metadata_refresh_ms,
+            "partition.assignment.strategy": "cooperative-sticky",
+            # Publishes the consumer lag per partition, see metrics.py
+            "statistics.interval.ms": 5000,
+            "stats_cb": record_consumer_lag,
         }
     )
 
-    subscribed_topics = set()
+    applier = None
+    tracker = None
+    if num_workers > 0:
+        tracker = OffsetTracker()
+        backpressure = Backpressure(max_buffered_messages, max_buffered_bytes)
+        applier = ShardedApplier(handler, num_workers, tracker, backpressure)
+
+    def on_revoke(c: Consumer, partitions: List[TopicPartition]):
+        log_revoke(c, partitions)
+        if applier is not None:
+            # Finish the in-flight messages so their offsets are committed before
+            # another consumer takes over the partitions
+            applier.drain()
+            store_tracked_offsets(c, tracker)
+            tracker.forget(partitions)
+            backpressure.forget(partitions)
+
+    c.subscribe([topic_pattern], on_assign=log_assign, on_revoke=on_revoke)
+    logging.info(f"Subscribed to topic pattern: {topic_pattern}")
 
     while True:
-        existing_topics = get_existing_topics(bootstrap_servers)
-        new_topics = [
-            topic
-            for topic in client_topics
-            if topic in existing_topics and topic not in subscribed_topics
-        ]
-        if new_topics:
-            all_topics_to_subscribe = list(subscribed_topics) + new_topics
-            c.subscribe(all_topics_to_subscribe)
-            subscribed_topics.update(new_topics)
-            logging.info(f"Subscribed to new topics: {new_topics}")
-
         try:
-            msg = c.poll(1.0)  # Wait for up to 1.0 seconds for a message
-
-            if msg is None:
-                continue
-            if msg.error():
-                raise KafkaException(msg.error())
-            if msg.value() is None:
-                continue  # Tombstone message for key that was deleted
+            if catchup is not None and catchup.active:
+                if applier is not None:
+                    # The workers are idle while catching up
+                    applier.drain()
+                    store_tracked_offsets(c, tracker)
+                    backpressure.update(c)
+                msgs = consume_batch(
+                    c, handler, catchup.batch_size, catchup.batch_timeout, bulk=True
+                )
+            elif applier is not None:
+                msgs = consume_sharded(c, applier, batch_size, batch_timeout)
+            elif batch_size > 1:
+                msgs = consume_batch(c, handler, batch_size, batch_timeout)
             else:
-                # Process message
-                handler.handle_message(msg)
+                msg = c.poll(1.0)  # Wait for up to 1.0 seconds for a message
+                msgs = [msg] if msg is not None else []
+
+                if msg is not None:
+                    if msg.error():
+                        raise KafkaException(msg.error())
+                    if msg.value() is not None:  # None is a tombstone message for a deleted key
+                        # Process message
+                        handler.handle_message(msg)
+                    c.store_offsets(message=msg)
+
+            if catchup is not None:
+                catchup.update(c, msgs)
 
         except KeyboardInterrupt:
             break
 
+    if applier is not None:
+        applier.close()
+        store_tracked_offsets(c, tracker)
     c.close()
+
+
+def consume_batch(
+    c: Consumer,
+    handler: MessageHandler,
+    batch_size: int,
+    batch_timeout: float,
+    bulk: bool = False,
+) -> List[Message]:
+    """Consume up to `batch_size` messages or wait `batch_timeout` seconds and handle them at once.
+
+    With `bulk` the messages are merged with set-based statements, see catchup.py.
+    """
+    msgs = c.consume(num_messages=batch_size, timeout=batch_timeout)
+
+    batch = []
+    for msg in msgs:
+        if msg.error():
+            raise KafkaException(msg.error())
+        if msg.value() is None:
+            continue  # Tombstone message for key that was deleted
+        batch.append(msg)
+
+    if batch and bulk:
+        handler.handle_bulk(batch)
+    elif batch:
+        handler.handle_batch(batch)
+    if msgs:
+        c.store_offsets(offsets=next_offsets(msgs))
+    return msgs
+
+
+def consume_sharded(
+    c: Consumer, applier: ShardedApplier, batch_size: int, batch_timeout: float
+) -> List[Message]:
+    """Consume up to `batch_size` messages and hand them to the apply workers."""
+    applier.raise_if_failed()
+    msgs = c.consume(num_messages=batch_size, timeout=batch_timeout)
+
+    for msg in msgs:
+        if msg.error():
+            raise KafkaException(msg.error())
+        if msg.value() is None:
+            # Tombstone message for key that was deleted
+            applier.tracker.track(msg)
+            applier.tracker.ack(msg)
+            continue
+        applier.submit(msg)
+
+    store_tracked_offsets(c, applier.tracker)
+    applier.backpressure.update(c)
+    return msgs
+
+
+def store_tracked_offsets(c: Consumer, tracker: OffsetTracker):
+    """Store the offsets up to which every message has been applied."""
+    offsets = tracker.committable()
+    if offsets:
+        c.store_offsets(offsets=offsets)
+
+
+def next_offsets(msgs: List[Message]) -> List[TopicPartition]:
+    """Get the offset following the last message of every partition."""
+    offsets = {}
+    for msg in msgs:
+        offsets[(msg.topic(), msg.partition())] = msg.offset() + 1
+    return [
+        TopicPartition(topic, partition, offset)
+        for (topic, partition), offset in offsets.items()
+    ]
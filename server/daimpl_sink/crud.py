@@ -1,11 +1,14 @@
-from typing import Generic, List, Optional, Type, TypeVar
+from datetime import timedelta
+from typing import Generic, Iterable, List, Optional, Set, Tuple, Type, TypeVar
 
-from models import TodoORM, User
+from models import DeadLetterORM, TodoORM, User
 from pydantic import BaseModel
 from schemas.todos import TodoCreate, TodoUpdate
 from schemas.users import UserCreate, UserUpdate
+from sqlalchemy import Delete, Select, Update, delete, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import Insert, insert
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased
 
 ModelType = TypeVar("ModelType")  # database model type
 CreateSchemaType = TypeVar(
@@ -27,15 +30,34 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             .first()
         )
 
+    def get_many(
+        self, db: Session, *, keys: Iterable[Tuple[int, str]]
+    ) -> List[ModelType]:
+        """Loads all rows for the given (id, client_id) keys with a single query."""
+        keys = list(keys)
+        if not keys:
+            return []
+        return list(db.execute(self.get_many_stmt(keys)).scalars())
+
+    def get_many_stmt(self, keys: List[Tuple[int, str]]) -> Select:
+        """SELECT of the rows for the given (id, client_id) keys."""
+        return select(self.model).where(
+            tuple_(self.model.id, self.model.client_id).in_(keys)
+        )
+
     def get_multi(
         self, db: Session, *, skip: int = 0, limit: int = 100
     ) -> List[ModelType]:
         return db.query(self.model).offset(skip).limit(limit).all()
 
-    def create(self, db: Session, *, obj_in: CreateSchemaType) -> ModelType:
+    def create(
+        self, db: Session, *, obj_in: CreateSchemaType, commit: bool = True
+    ) -> ModelType:
         obj_in_data = obj_in.dict()
         db_obj = self.model(**obj_in_data)
         db.add(db_obj)
+        if not commit:
+            return db_obj
         try:
             db.commit()
             db.refresh(db_obj)
@@ -45,12 +67,19 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             raise e
 
     def update(
-        self, db: Session, *, db_obj: ModelType, obj_in: UpdateSchemaType
+        self,
+        db: Session,
+        *,
+        db_obj: ModelType,
+        obj_in: UpdateSchemaType,
+        commit: bool = True,
     ) -> ModelType:
         obj_data = obj_in.dict()
         for attr, value in obj_data.items():
             if hasattr(db_obj, attr):
                 setattr(db_obj, attr, value)
+        if not commit:
+            return db_obj
         try:
             db.commit()
             return db_obj
@@ -86,10 +115,258 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             db.rollback()
             raise e
 
+    def update_by_key(
+        self,
+        db: Session,
+        *,
+        id: int,
+        client_id: str,
+        obj_in: UpdateSchemaType,
+        commit: bool = True,
+    ) -> int:
+        """Updates a row without loading it first. Returns the number of updated rows."""
+        count = db.execute(
+            self.update_by_key_stmt(id=id, client_id=client_id, obj_in=obj_in)
+        ).rowcount
+        if not commit:
+            return count
+        try:
+            db.commit()
+            return count
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    def delete_by_key(
+        self, db: Session, *, id: int, client_id: str, commit: bool = True
+    ) -> int:
+        """Deletes a row without loading it first. Returns the number of deleted rows."""
+        count = db.execute(self.delete_by_key_stmt(id=id, client_id=client_id)).rowcount
+        if not commit:
+            return count
+        try:
+            db.commit()
+            return count
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    # The statements below are shared with the AsyncSession based strategies, which
+    # cannot use the Query API
+
+    def create_stmt(self, obj_in: CreateSchemaType) -> Insert:
+        return insert(self.model).values(**obj_in.dict())
+
+    def update_by_key_stmt(
+        self, *, id: int, client_id: str, obj_in: UpdateSchemaType
+    ) -> Update:
+        return (
+            update(self.model)
+            .where(self.model.id == id, self.model.client_id == client_id)
+            .values(**obj_in.dict())
+            .execution_options(synchronize_session=False)
+        )
+
+    def delete_by_key_stmt(self, *, id: int, client_id: str) -> Delete:
+        return (
+            delete(self.model)
+            .where(self.model.id == id, self.model.client_id == client_id)
+            .execution_options(synchronize_session=False)
+        )
+
 
 class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
     pass
 
 
 class CRUDTodo(CRUDBase[TodoORM, TodoCreate, TodoUpdate]):
-    pass
+    def insert_if_absent_stmt(self, obj_in: TodoCreate) -> Insert:
+        """INSERT ... ON CONFLICT DO NOTHING RETURNING the key of the created row."""
+        return (
+            insert(self.model)
+            .values(**obj_in.dict())
+            .on_conflict_do_nothing(index_elements=["id", "client_id"])
+            .returning(self.model.id, self.model.client_id)
+        )
+
+    def upsert_if_newer_stmt(self, obj_in: TodoCreate) -> Insert:
+        """INSERT ... ON CONFLICT DO UPDATE that only overwrites an existing row if the new
+        row has a later `updated_at` (Last Writer Wins). RETURNING the key of the written row.
+        """
+        stmt = insert(self.model).values(**obj_in.dict())
+        return stmt.on_conflict_do_update(
+            index_elements=["id", "client_id"],
+            set_={
+                field: stmt.excluded[field] for field in TodoUpdate.model_fields
+            },
+            where=stmt.excluded.updated_at > self.model.updated_at,
+        ).returning(self.model.id, self.model.client_id)
+
+    def insert_if_absent(
+        self, db: Session, *, obj_in: TodoCreate, commit: bool = True
+    ) -> bool:
+        """Creates the row unless it already exists. Returns whether it was created."""
+        return self._execute_write(db, self.insert_if_absent_stmt(obj_in), commit)
+
+    def upsert_if_newer(
+        self, db: Session, *, obj_in: TodoCreate, commit: bool = True
+    ) -> bool:
+        """Creates the row or overwrites it if `obj_in` is newer. Returns whether it was written."""
+        return self._execute_write(db, self.upsert_if_newer_stmt(obj_in), commit)
+
+    def _execute_write(self, db: Session, stmt: Insert, commit: bool) -> bool:
+        written = db.execute(stmt).first() is not None
+        if not commit:
+            return written
+        try:
+            db.commit()
+            return written
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+
+class CRUDDeadLetter:
+    def __init__(self, model: Type[DeadLetterORM] = DeadLetterORM):
+        self.model = model
+
+    def add(
+        self,
+        db: Session,
+        *,
+        topic: str,
+        partition: int,
+        offset: int,
+        todo_key: Optional[Tuple[int, str]],
+        key: Optional[bytes],
+        value: Optional[bytes],
+        error: str,
+        commit: bool = True,
+    ):
+        """Stores a message unless it is already stored, e.g. when it is consumed again."""
+        todo_id, todo_client_id = todo_key or (None, None)
+        db.execute(
+            insert(self.model)
+            .values(
+                topic=topic,
+                partition=partition,
+                offset=offset,
+                todo_id=todo_id,
+                todo_client_id=todo_client_id,
+                key=key,
+                value=value,
+                error=error,
+            )
+            .on_conflict_do_nothing(index_elements=["topic", "partition", "offset"])
+        )
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    def get_due(self, db: Session, *, limit: int = 100) -> List[DeadLetterORM]:
+        """Get the messages whose next attempt is due, in the order they were stored.
+
+        A message is only due once every earlier message of its todo is due as well or
+        has been given up, so the messages of a todo are always retried in order.
+        """
+        earlier = aliased(self.model)
+        earlier_not_due = (
+            select(earlier.id)
+            .where(
+                earlier.todo_id == self.model.todo_id,
+                earlier.todo_client_id == self.model.todo_client_id,
+                earlier.id < self.model.id,
+                earlier.given_up_at.is_(None),
+                earlier.next_attempt_at > func.now(),
+            )
+            .exists()
+        )
+        return (
+            db.query(self.model)
+            .filter(
+                self.model.given_up_at.is_(None),
+                self.model.next_attempt_at <= func.now(),
+                ~earlier_not_due,
+            )
+            .order_by(self.model.id)
+            .limit(limit)
+            .all()
+        )
+
+    def has_key(self, db: Session, *, todo_key: Tuple[int, str]) -> bool:
+        todo_id, todo_client_id = todo_key
+        return db.query(
+            db.query(self.model)
+            .filter(
+                self.model.todo_id == todo_id,
+                self.model.todo_client_id == todo_client_id,
+                self.model.given_up_at.is_(None),
+            )
+            .exists()
+        ).scalar()
+
+    def count(self, db: Session) -> int:
+        """Get the number of messages that are still retried."""
+        return db.query(self.model).filter(self.model.given_up_at.is_(None)).count()
+
+    def parked_keys(self, db: Session) -> Set[Tuple[int, str]]:
+        """Get the keys of the todos that have stored messages that are still retried."""
+        rows = (
+            db.query(self.model.todo_id, self.model.todo_client_id)
+            .filter(self.model.todo_id.isnot(None), self.model.given_up_at.is_(None))
+            .distinct()
+            .all()
+        )
+        return {(row.todo_id, row.todo_client_id) for row in rows}
+
+    def remove(self, db: Session, *, id: int, commit: bool = True):
+        db.query(self.model).filter(self.model.id == id).delete()
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    def reschedule(
+        self, db: Session, *, id: int, error: str, delay: float, commit: bool = True
+    ):
+        """Records a failed attempt and schedules the next one `delay` seconds later."""
+        db.query(self.model).filter(self.model.id == id).update(
+            {
+                "attempts": self.model.attempts + 1,
+                "error": error,
+                "next_attempt_at": func.now() + timedelta(seconds=delay),
+            },
+            synchronize_session=False,
+        )
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+
+    def give_up(self, db: Session, *, id: int, error: str, commit: bool = True):
+        """Records the last failed attempt, the message is kept but not retried again."""
+        db.query(self.model).filter(self.model.id == id).update(
+            {
+                "attempts": self.model.attempts + 1,
+                "error": error,
+                "given_up_at": func.now(),
+            },
+            synchronize_session=False,
+        )
+        if not commit:
+            return
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import logging
+import threading
+from typing import List, Optional, Set, Tuple
+
+from confluent_kafka import Message
+from crud import CRUDDeadLetter
+from engine import get_db
+from metrics import DEAD_LETTER_RETRIES, DEAD_LETTERED, DEAD_LETTERS
+from models import DeadLetterORM
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+crud_dead_letter = CRUDDeadLetter()
+
+# Errors of the database connection and of waiting for a pooled connection, the message
+# itself is fine. They are raised to the consumer loop instead of dead-lettering every
+# message while the database is down or overloaded.
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError, OSError)
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether applying a message failed because of the database, not the message."""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+def message_key(msg: Message) -> Optional[Tuple[int, str]]:
+    """Get the (id, client_id) key of a message, or None if the key cannot be read."""
+    try:
+        key_payload = json.loads(msg.key()).get("payload", {})
+        return key_payload["id"], key_payload["client_id"]
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return None
+
+
+class DeadLetter:
+    """A stored message, with the interface of a consumed Message the handlers use."""
+
+    def __init__(self, row: DeadLetterORM):
+        self.row = row
+
+    def key(self) -> Optional[bytes]:
+        return self.row.key
+
+    def value(self) -> Optional[bytes]:
+        return self.row.value
+
+    def topic(self) -> str:
+        return self.row.topic
+
+    def partition(self) -> int:
+        return self.row.partition
+
+    def offset(self) -> int:
+        return self.row.offset
+
+    def error(self):
+        return None
+
+
+class DeadLetterQueue:
+    """Stores the messages that failed to apply and retries them off the consumer path.
+
+    Once a message of a todo is dead-lettered, the todo is parked: its later messages are
+    stored behind it instead of being applied, so its changes keep their order. Messages
+    of other todos are not held up.
+
+    A background thread retries the due messages every `retry_interval` seconds with the
+    `retry_handler`. The messages of a todo are retried in order and a retry round stops
+    at the first failure of a todo, whose next attempt is then delayed exponentially up
+    to `max_backoff` seconds. After `max_attempts` failed attempts a message is given up:
+    it stays in the store for inspection, but is not retried and no longer holds up the
+    later messages of its todo. The todo is unparked once all its messages are applied or
+    given up. Errors of the database itself stop a retry round without counting as an
+    attempt.
+    """
+
+    def __init__(
+        self,
+        retry_handler,
+        retry_interval: float = 5.0,
+        max_backoff: float = 600.0,
+        max_attempts: int = 10,
+        batch_size: int = 100,
+    ):
+        self.retry_handler = retry_handler
+        self.retry_interval = retry_interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._parked: Set[Tuple[int, str]] = set()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Loads the parked todos and starts the retry thread."""
+        with get_db() as db:
+            parked = crud_dead_letter.parked_keys(db)
+            DEAD_LETTERS.set(crud_dead_letter.count(db))
+        with self._lock:
+            self._parked = parked
+        if parked:
+            logging.info(f"{len(parked)} todos have dead-lettered messages")
+        self._thread = threading.Thread(target=self._run, name="dead-letters", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def is_parked(self, key: Optional[Tuple[int, str]]) -> bool:
+        with self._lock:
+            return key in self._parked
+
+    def park(self, msg: Message, error: str, reason: str = "error"):
+        """Stores a message and parks its todo."""
+        key = message_key(msg)
+        with get_db() as db:
+            crud_dead_letter.add(
+                db,
+                topic=msg.topic(),
+                partition=msg.partition(),
+                offset=msg.offset(),
+                todo_key=key,
+                key=msg.key(),
+                value=msg.value(),
+                error=error,
+            )
+        # Parked only after the message is stored, see `_unpark`
+        if key is not None:
+            with self._lock:
+                self._parked.add(key)
+        DEAD_LETTERS.inc()
+        DEAD_LETTERED.labels(reason=reason).inc()
+        logging.warning(
+            f"Dead-lettered message {msg.topic()}[{msg.partition()}]@{msg.offset()} "
+            f"of todo {key}: {error}"
+        )
+
+    def retry_due(self):
+        """Retries the due messages once."""
+        with get_db() as db:
+            letters = crud_dead_letter.get_due(db, limit=self.batch_size)
+
+        failed: Set[Optional[Tuple[int, str]]] = set()
+        keys = []
+        for letter in letters:
+            key = (letter.todo_id, letter.todo_client_id) if letter.todo_id is not None else None
+            if key is not None and key in failed:
+                continue  # Keep the order behind the failed message
+            try:
+                self.retry_handler.handle_message(DeadLetter(letter))
+            except Exception as e:
+                if is_transient(e):
+                    # Not an attempt of the message, the round is stopped until the
+                    # database is back
+                    logging.warning(f"Retrying dead letters failed, retrying later: {e!r}")
+                    break
+                if letter.attempts + 1 >= self.max_attempts:
+                    self._give_up(letter, e)
+                    if key is not None:
+                        keys.append(key)
+                    continue
+                DEAD_LETTER_RETRIES.labels(result="failure").inc()
+                delay = min(self.retry_interval * 2 ** (letter.attempts + 1), self.max_backoff)
+                logging.warning(
+                    f"Retrying dead letter {letter.id} failed, next attempt in {delay}s: {e!r}"
+                )
+                with get_db() as db:
+                    crud_dead_letter.reschedule(db, id=letter.id, error=repr(e), delay=delay)
+                if key is not None:
+                    failed.add(key)
+                continue
+            DEAD_LETTER_RETRIES.labels(result="success").inc()
+            with get_db() as db:
+                crud_dead_letter.remove(db, id=letter.id)
+            DEAD_LETTERS.dec()
+            if key is not None:
+                keys.append(key)
+
+        for key in set(keys) - failed:
+            self._unpark(key)
+
+    def _give_up(self, letter: DeadLetterORM, error: Exception):
+        DEAD_LETTER_RETRIES.labels(result="given_up").inc()
+        logging.error(
+            f"Giving up dead letter {letter.id} of todo "
+            f"({letter.todo_id}, {letter.todo_client_id}) after {letter.attempts + 1} "
+            f"attempts: {error!r}"
+        )
+        with get_db() as db:
+            crud_dead_letter.give_up(db, id=letter.id, error=repr(error))
+        DEAD_LETTERS.dec()
+
+    def _unpark(self, key: Tuple[int, str]):
+        # Checked under the lock: a message parked concurrently is stored before its
+        # key is added, so it is either seen here or re-parks the key afterwards
+        with self._lock, get_db() as db:
+            if not crud_dead_letter.has_key(db, todo_key=key):
+                self._parked.discard(key)
+                logging.info(f"Todo {key} has no dead-lettered messages left")
+
+    def _run(self):
+        while not self._stop.wait(self.retry_interval):
+            try:
+                self.retry_due()
+            except Exception:
+                logging.exception("Retrying dead letters failed")
+
+
+class DeadLetterHandler:
+    """Wraps a handler so that messages that fail to apply are dead-lettered instead of
+    stopping the consumer, see DeadLetterQueue.
+
+    A failed batch is applied again message by message to find the failing messages.
+    """
+
+    def __init__(self, handler, dlq: DeadLetterQueue):
+        self.handler = handler
+        self.dlq = dlq
+
+    def handle_message(self, msg: Message):
+        if self.dlq.is_parked(message_key(msg)):
+            self.dlq.park(msg, "An earlier message of the todo is dead-lettered", "parked")
+            return
+        try:
+            self.handler.handle_message(msg)
+        except Exception as e:
+            if is_transient(e):
+                raise
+            self.dlq.park(msg, repr(e))
+
+    def handle_batch(self, msgs: List[Message]):
+        if not any(self.dlq.is_parked(message_key(msg)) for msg in msgs):
+            try:
+                self.handler.handle_batch(msgs)
+                return
+            except Exception as e:
+                if is_transient(e):
+                    raise
+                logging.warning(
+                    f"Applying a batch failed, applying its messages one by one: {e!r}"
+                )
+        # Messages of parked todos are parked in order by the single message path
+        for msg in msgs:
+            self.handle_message(msg)
+
+    def handle_bulk(self, msgs: List[Message]):
+        # Chunks with parked todos take the batch path, which parks them in order
+        if not any(self.dlq.is_parked(message_key(msg)) for msg in msgs):
+            try:
+                self.handler.handle_bulk(msgs)
+                return
+            except Exception as e:
+                if is_transient(e):
+                    raise
+                logging.warning(f"Merging a bulk failed, applying it as a batch: {e!r}")
+        self.handle_batch(msgs)
+
+
+class AsyncDeadLetterHandler:
+    """DeadLetterHandler for an AsyncHandler. Storing a message is a blocking write and
+    runs on the default executor, the retries run with a sync handler."""
+
+    def __init__(self, handler, dlq: DeadLetterQueue):
+        self.handler = handler
+        self.dlq = dlq
+
+    async def handle_message(self, msg: Message):
+        if self.dlq.is_parked(message_key(msg)):
+            await self._park(msg, "An earlier message of the todo is dead-lettered", "parked")
+            return
+        try:
+            await self.handler.handle_message(msg)
+        except Exception as e:
+            if is_transient(e):
+                raise
+            await self._park(msg, repr(e))
+
+    async def handle_batch(self, msgs: List[Message]):
+        if not any(self.dlq.is_parked(message_key(msg)) for msg in msgs):
+            try:
+                await self.handler.handle_batch(msgs)
+                return
+            except Exception as e:
+                if is_transient(e):
+                    raise
+                logging.warning(
+                    f"Applying a batch failed, applying its messages one by one: {e!r}"
+                )
+        for msg in msgs:
+            await self.handle_message(msg)
+
+    async def handle_bulk(self, msgs: List[Message]):
+        if not any(self.dlq.is_parked(message_key(msg)) for msg in msgs):
+            try:
+                await self.handler.handle_bulk(msgs)
+                return
+            except Exception as e:
+                if is_transient(e):
+                    raise
+                logging.warning(f"Merging a bulk failed, applying it as a batch: {e!r}")
+        await self.handle_batch(msgs)
+
+    async def _park(self, msg: Message, error: str, reason: str = "error"):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.dlq.park, msg, error, reason)
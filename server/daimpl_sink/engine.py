@@ -9,9 +9,13 @@ pg_host = os.environ.get("POSTGRES_HOST")
 pg_port = os.environ.get("POSTGRES_PORT")
 pg_user = os.environ.get("POSTGRES_USER")
 pg_password = os.environ.get("POSTGRES_PASSWORD")
+# Every apply worker holds a connection while it applies a message
+pool_size = int(os.environ.get("DB_POOL_SIZE", "5"))
 
 Base = declarative_base()
-engine = create_engine(f"postgresql://{pg_user}:{pg_password}@{pg_host}:{pg_port}")
+engine = create_engine(
+    f"postgresql://{pg_user}:{pg_password}@{pg_host}:{pg_port}", pool_size=pool_size
+)
 
 while True:
     try:
@@ -0,0 +1,75 @@
+import json
+import re
+import zlib
+from typing import Dict, List
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:  # pragma: no cover - orjson is optional
+    loads = json.loads
+
+_SCHEMA_START = re.compile(r'\s*\{\s*"schema"\s*:\s*')
+_PAYLOAD_START = re.compile(r'\s*,\s*"payload"\s*:\s*')
+_json_decoder = json.JSONDecoder()
+
+PAYLOAD_FIELDS = ("op", "before", "after", "source")
+
+
+class EnvelopeDecoder:
+    """Decodes Debezium JSON envelopes without parsing their schema section every time.
+
+    With the JSON converter every message starts with the same `schema` block, followed
+    by the `payload`. The first message of a schema is parsed completely to find out where
+    its payload starts. The bytes up to there are remembered as the schema's prefix and the
+    parsed schema is cached by the prefix's fingerprint. Every following message that starts
+    with a known prefix only has its payload parsed.
+
+    orjson is used as JSON backend when it is installed.
+    """
+
+    def __init__(self, max_schemas: int = 64):
+        self.max_schemas = max_schemas
+        self.schemas: Dict[int, Dict] = {}
+        self._prefixes: List[bytes] = []
+
+    def decode_key(self, data: bytes) -> Dict:
+        """Decodes a message key to `{"payload": {...}}`."""
+        return {"payload": self._decode_payload(data)}
+
+    def decode_value(self, data: bytes) -> Dict:
+        """Decodes a message value to `{"payload": {...}}`, keeping only `op`, `before`, `after` and `source`."""
+        payload = self._decode_payload(data) or {}
+        return {"payload": {field: payload.get(field) for field in PAYLOAD_FIELDS}}
+
+    def _decode_payload(self, data: bytes):
+        for prefix in self._prefixes:
+            if data.startswith(prefix):
+                return loads(data[len(prefix) : data.rindex(b"}")])
+        return self._decode_new_schema(data)
+
+    def _decode_new_schema(self, data: bytes):
+        text = data.decode("utf-8")
+        schema_start = _SCHEMA_START.match(text)
+        if schema_start is None:
+            # Schemas are disabled in the converter, the message is the payload
+            value = loads(data)
+            return value.get("payload", value) if isinstance(value, dict) else value
+
+        schema, schema_end = _json_decoder.raw_decode(text, schema_start.end())
+        payload_start = _PAYLOAD_START.match(text, schema_end)
+        if payload_start is None:
+            return loads(data).get("payload")
+
+        prefix = text[: payload_start.end()].encode("utf-8")
+        fingerprint = zlib.crc32(prefix)
+        if fingerprint not in self.schemas:
+            if len(self.schemas) >= self.max_schemas:
+                self.schemas.clear()
+                self._prefixes = []
+            self.schemas[fingerprint] = schema
+            # Replace the list instead of mutating it, other threads may iterate it
+            self._prefixes = [prefix] + self._prefixes
+
+        return loads(text[payload_start.end() : text.rindex("}")])
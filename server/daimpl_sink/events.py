@@ -0,0 +1,52 @@
+import logging
+from enum import Enum, auto
+from typing import Dict, Tuple
+
+
+class MsgType(Enum):
+    """The Message Type represents the database operation that was performed by the client."""
+
+    CREATE = auto()
+    UPDATE = auto()
+    DELETE = auto()
+
+
+def derive_msg_type(msg_value: Dict) -> MsgType:
+    """Get the Message Type based on the messages Value.
+
+    Args:
+        msg (Dict): A Debezium CDC Message
+
+    Returns:
+        MsgType: The Message Type
+
+    """
+
+    operation = msg_value.get("payload", {}).get("op")
+    if operation is None:
+        logging.error("Invalid message type, operation is None")
+        raise ValueError("Invalid message type, operation is None")
+    # "r" is a row read by a Debezium snapshot, it is applied like a create
+    if operation in ("c", "r"):
+        logging.debug("CREATE message received")
+        return MsgType.CREATE
+    elif operation == "u":
+        logging.debug("UPDATE message received")
+        return MsgType.UPDATE
+    elif operation == "d":
+        logging.debug("DELETE message received")
+        return MsgType.DELETE
+    else:
+        logging.error(f"Invalid message type, operation is {operation}")
+        raise ValueError(f"Invalid message type, operation is {operation}")
+
+
+def topic_client_id(topic: str) -> str:
+    """Get the id of the client that publishes a topic, e.g. `client-1` for `client-1-topic.public.todos`."""
+    return topic.split("-topic.", 1)[0]
+
+
+def row_key(msg: Tuple[Dict, Dict]) -> Tuple[int, str]:
+    """Get the (id, client_id) primary key of the row a message refers to."""
+    key_payload = msg[0].get("payload", {})
+    return key_payload.get("id"), key_payload.get("client_id")
@@ -1,14 +1,28 @@
-import json
 import logging
 from abc import ABC, abstractmethod
-from enum import Enum, auto
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
+from cache import RowCache
+from catchup import bulk_merge
 from confluent_kafka import Message
 from crud import CRUDTodo
 from engine import get_db
+from envelope import EnvelopeDecoder
+from coalesce import coalesce_events
+from events import MsgType, derive_msg_type, row_key, topic_client_id
+from metrics import (
+    COMMIT_DURATION,
+    CONFLICTS,
+    EVENTS_APPLIED,
+    EVENTS_COALESCED,
+    STAGE_LATENCY,
+    event_log,
+)
 from models import TodoORM as TodoORM
-from schemas import Todo, TodoCreate, TodoUpdate
+from rows import UPDATED_AT, Row, apply_update, row_from_dict, row_from_orm, row_to_dict
+from schemas import TodoCreate
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 
 crud_todo = CRUDTodo(TodoORM)
 
@@ -26,139 +40,325 @@ class AbstractStrategy(ABC):
     def handle_delete(self, msg: Tuple[Dict, Dict]):
         pass
 
+    def handle_batch(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        """Handles a batch of decoded events in order. Strategies can override this to
+        apply the whole batch at once."""
+        for msg_type, msg in events:
+            if msg_type == MsgType.CREATE:
+                self.handle_create(msg)
+            elif msg_type == MsgType.UPDATE:
+                self.handle_update(msg)
+            elif msg_type == MsgType.DELETE:
+                self.handle_delete(msg)
+
+    def handle_bulk(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        """Applies a large batch of coalesced events with set-based statements in a single
+        transaction, see catchup.py."""
+        with get_db() as db:
+            with STAGE_LATENCY.labels(stage="merge").time():
+                bulk_merge(db, events)
+            try:
+                with COMMIT_DURATION.time():
+                    db.commit()
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise e
+
 
 class LWWStrategy_Server(AbstractStrategy):
-    """LWWStrategy implements the Last-Write-Wins strategy for handling messages from the Kafka Consumer."""
+    """LWWStrategy implements the Last-Write-Wins strategy for handling messages from the Kafka Consumer.
 
-    def handle_create(self, msg: Tuple[Dict, Dict]):
-        logging.info("CREATE REQUEST")
-        after_obj = msg[1].get("payload", {}).get("after", {})
+    Single events are applied as a batch of one. A batch loads every affected row with
+    one query, resolves the LWW decisions in memory in the order the events were received
+    and writes the resulting row states in a single transaction.
 
-        logging.debug(f"after_obj: {after_obj}")
-        id = after_obj.get("id")
-        client_id = after_obj.get("client_id")
-        with get_db() as db:
-            db_obj = crud_todo.get(db, id=id, client_id=client_id)
-            if db_obj is not None:
-                if Todo(**after_obj) == Todo.model_validate(db_obj):
-                    logging.info("SYNC detected. Skipping...")
-                    return
-                else:
-                    logging.warning("Unexpected conflict. Blocking create")
-                    return
-            else:
-                logging.info("CREATING...")
-                crud_todo.create(db, obj_in=TodoCreate(**after_obj))
+    With a RowCache the current rows are looked up in memory first, so most comparisons
+    need no database access.
+    """
 
-    def handle_update(self, msg: Tuple[Dict, Dict]):
-        logging.info("UPDATE REQUEST")
-        todo_id = msg[0].get("payload", {}).get("id", {})
-        client_id = msg[0].get("payload", {}).get("client_id", {})
+    def __init__(self, cache: Optional[RowCache] = None):
+        self.cache = cache
 
-        before_obj = msg[1].get("payload", {}).get("before", {})
-        after_obj = msg[1].get("payload", {}).get("after", {})
+    def handle_create(self, msg: Tuple[Dict, Dict]):
+        self.handle_batch([(MsgType.CREATE, msg)])
 
-        logging.debug(f"before_obj: {before_obj}")
-        logging.debug(f"after_obj: {after_obj}")
+    def handle_update(self, msg: Tuple[Dict, Dict]):
+        self.handle_batch([(MsgType.UPDATE, msg)])
 
-        with get_db() as db:
-            db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
+    def handle_delete(self, msg: Tuple[Dict, Dict]):
+        self.handle_batch([(MsgType.DELETE, msg)])
 
-            if db_todo is None:
-                logging.info("UPDATE TO NON-EXISTENT ITEM. CREATE INSTEAD ...")
-                return self.handle_create(msg)
+    def handle_batch(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        keys = {row_key(msg) for _, msg in events}
 
-            parsed_db_todo = Todo.model_validate(db_todo)
-            parsed_before_obj = Todo.model_validate(before_obj)
-            parsed_after_obj = Todo.model_validate(after_obj)
+        with get_db() as db:
+            with STAGE_LATENCY.labels(stage="load").time():
+                rows = self.load_rows(db, keys)
+            loaded_rows = dict(rows)
+
+            with STAGE_LATENCY.labels(stage="resolve").time():
+                self.resolve_batch(events, rows)
+
+            try:
+                with STAGE_LATENCY.labels(stage="write").time():
+                    self.write_rows(db, loaded_rows, rows)
+            except SQLAlchemyError as e:
+                if self.cache is not None:
+                    self.cache.invalidate(keys)
+                raise e
+
+        if self.cache is not None:
+            self.cache.put_many(rows)
+
+    def handle_bulk(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        # The merged rows are not known in Python, they are loaded again when needed
+        try:
+            super().handle_bulk(events)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate({row_key(msg) for _, msg in events})
+
+    def load_rows(
+        self, db: Session, keys: Set[Tuple[int, str]]
+    ) -> Dict[Tuple[int, str], Optional[Row]]:
+        """Get the current state of the rows, from the cache where possible. Missing rows are None."""
+        rows: Dict[Tuple[int, str], Optional[Row]] = {}
+        missing = keys
+        if self.cache is not None:
+            rows, missing = self.cache.get_many(keys)
+
+        rows.update({key: None for key in missing})
+        rows.update(
+            {
+                (db_todo.id, db_todo.client_id): row_from_orm(db_todo)
+                for db_todo in crud_todo.get_many(db, keys=missing)
+            }
+        )
+        return rows
+
+    def resolve_batch(
+        self,
+        events: List[Tuple[MsgType, Tuple[Dict, Dict]]],
+        rows: Dict[Tuple[int, str], Optional[Row]],
+    ):
+        """Applies the events in order to the row states in `rows`."""
+        for msg_type, msg in events:
+            event_log.sample()
+            key = row_key(msg)
+            if msg_type == MsgType.CREATE:
+                rows[key] = self.resolve_create(msg, rows[key])
+            elif msg_type == MsgType.UPDATE:
+                rows[key] = self.resolve_update(msg, rows[key])
+            elif msg_type == MsgType.DELETE:
+                rows[key] = self.resolve_delete(msg, rows[key])
+            EVENTS_APPLIED.labels(op=msg_type.name.lower()).inc()
+
+    def resolve_create(
+        self, msg: Tuple[Dict, Dict], db_todo: Optional[Row]
+    ) -> Optional[Row]:
+        """Returns the row state after applying a create event to `db_todo`."""
+        event_log.info("CREATE REQUEST")
+        after_obj = msg[1].get("payload", {}).get("after", {})
 
-            if parsed_after_obj == parsed_db_todo:
-                logging.info("SYNC detected. Skipping...")
-                return
-            elif parsed_before_obj == parsed_db_todo:
-                logging.info("UPDATING...")
+        logging.debug("after_obj: %s", after_obj)
+        parsed_after_obj = row_from_dict(after_obj)
+        if db_todo is not None:
+            if parsed_after_obj == db_todo:
+                event_log.info("SYNC detected. Skipping...")
+                CONFLICTS.labels(type="sync_skip").inc()
             else:
-                logging.warning(
-                    "CONFLICT. Before !== Server Item. UPDATING if after is newer..."
-                )
-                # ! We update anyways if the after item is new then the stored item (Last Writer Wins)
+                logging.warning("Unexpected conflict. Blocking create")
+                CONFLICTS.labels(type="blocked_create").inc()
+            return db_todo
+
+        event_log.info("CREATING...")
+        return parsed_after_obj
+
+    def resolve_update(
+        self, msg: Tuple[Dict, Dict], db_todo: Optional[Row]
+    ) -> Optional[Row]:
+        """Returns the row state after applying an update event to `db_todo`."""
+        event_log.info("UPDATE REQUEST")
+        before_obj = msg[1].get("payload", {}).get("before", {})
+        after_obj = msg[1].get("payload", {}).get("after", {})
 
-            if parsed_after_obj.updated_at > parsed_db_todo.updated_at:
-                crud_todo.update(db, db_obj=db_todo, obj_in=TodoUpdate(**after_obj))
-            else:
-                logging.info(
-                    "After is not newer than the server instance. Skipping update."
-                )
+        logging.debug("before_obj: %s", before_obj)
+        logging.debug("after_obj: %s", after_obj)
 
-    def handle_delete(self, msg: Tuple[Dict, Dict]):
-        logging.info("DELETE REQUEST")
-        todo_id = msg[0].get("payload", {}).get("id", {})
-        client_id = msg[0].get("payload", {}).get("client_id", {})
+        if db_todo is None:
+            event_log.info("UPDATE TO NON-EXISTENT ITEM. CREATE INSTEAD ...")
+            return self.resolve_create(msg, db_todo)
 
-        before_obj = msg[1].get("payload", {}).get("before", {})
+        parsed_before_obj = row_from_dict(before_obj)
+        parsed_after_obj = row_from_dict(after_obj)
 
-        logging.debug(f"before_obj: {before_obj}")
-        with get_db() as db:
-            db_todo = crud_todo.get(db, id=todo_id, client_id=client_id)
+        if parsed_after_obj == db_todo:
+            event_log.info("SYNC detected. Skipping...")
+            CONFLICTS.labels(type="sync_skip").inc()
+            return db_todo
+        elif parsed_before_obj == db_todo:
+            event_log.info("UPDATING...")
+            conflict = False
+        else:
+            logging.warning(
+                "CONFLICT. Before !== Server Item. UPDATING if after is newer..."
+            )
+            conflict = True
+            # ! We update anyways if the after item is new then the stored item (Last Writer Wins)
+
+        if parsed_after_obj[UPDATED_AT] > db_todo[UPDATED_AT]:
+            if conflict:
+                CONFLICTS.labels(type="lww_overwrite").inc()
+            return apply_update(db_todo, parsed_after_obj)
+
+        event_log.info("After is not newer than the server instance. Skipping update.")
+        CONFLICTS.labels(type="stale_skip").inc()
+        return db_todo
+
+    def resolve_delete(
+        self, msg: Tuple[Dict, Dict], db_todo: Optional[Row]
+    ) -> Optional[Row]:
+        """Returns the row state after applying a delete event to `db_todo`."""
+        event_log.info("DELETE REQUEST")
+        before_obj = msg[1].get("payload", {}).get("before", {})
 
-            if db_todo is None:
-                logging.info("SYNC detected. Skipping...")
-                return
+        logging.debug("before_obj: %s", before_obj)
+        if db_todo is None:
+            event_log.info("SYNC detected. Skipping...")
+            CONFLICTS.labels(type="sync_skip").inc()
+            return None
 
-            parsed_db_todo = Todo.model_validate(db_todo)
-            parsed_before_obj = Todo.model_validate(before_obj)
+        parsed_before_obj = row_from_dict(before_obj)
 
-            if parsed_before_obj == parsed_db_todo:
-                logging.info("DELETING ...")
-                crud_todo.delete(db, id=todo_id, client_id=client_id)
+        if parsed_before_obj == db_todo:
+            event_log.info("DELETING ...")
+        else:
+            logging.warning("CONFLICT. Before !== Server Item. Deleting ...")
+            CONFLICTS.labels(type="conflict_delete").inc()
+        return None
+
+    def write_rows(
+        self,
+        db: Session,
+        loaded_rows: Dict[Tuple[int, str], Optional[Row]],
+        rows: Dict[Tuple[int, str], Optional[Row]],
+    ):
+        """Writes the resolved row states that differ from the loaded rows and commits once.
+
+        This is the only place the rows are validated with Pydantic.
+        """
+        for (todo_id, client_id), row in rows.items():
+            loaded_row = loaded_rows[(todo_id, client_id)]
+            if row == loaded_row:
+                continue
+            if row is None:
+                crud_todo.delete_by_key(db, id=todo_id, client_id=client_id, commit=False)
+            elif loaded_row is None:
+                crud_todo.create(db, obj_in=TodoCreate(**row_to_dict(row)), commit=False)
             else:
-                logging.warning("CONFLICT. Before !== Server Item. Deleting ...")
-                crud_todo.delete(db, id=todo_id, client_id=client_id)
-                return
+                crud_todo.update_by_key(
+                    db,
+                    id=todo_id,
+                    client_id=client_id,
+                    obj_in=TodoCreate(**row_to_dict(row)),
+                    commit=False,
+                )
 
+        try:
+            with COMMIT_DURATION.time():
+                db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
 
-class MsgType(Enum):
-    """The Message Type represents the database operation that was performed by the client."""
 
-    CREATE = auto()
-    UPDATE = auto()
-    DELETE = auto()
+class UpsertLWWStrategy_Server(AbstractStrategy):
+    """Last-Write-Wins strategy that leaves the decision to Postgres.
+
+    Every event is a single statement without reading the row first:
+    - a create is an INSERT ... ON CONFLICT DO NOTHING, so an existing row blocks it
+    - an update is an INSERT ... ON CONFLICT DO UPDATE ... WHERE the new row is newer,
+      which also creates rows that do not exist
+    - a delete is a DELETE by key
+    The statements of a batch are executed in order in a single transaction.
+    """
+
+    def handle_create(self, msg: Tuple[Dict, Dict]):
+        self.handle_batch([(MsgType.CREATE, msg)])
 
+    def handle_update(self, msg: Tuple[Dict, Dict]):
+        self.handle_batch([(MsgType.UPDATE, msg)])
 
-def derive_msg_type(msg_value: Dict) -> MsgType:
-    """Get the Message Type based on the messages Value.
+    def handle_delete(self, msg: Tuple[Dict, Dict]):
+        self.handle_batch([(MsgType.DELETE, msg)])
 
-    Args:
-        msg (Dict): A Debezium CDC Message
+    def handle_batch(self, events: List[Tuple[MsgType, Tuple[Dict, Dict]]]):
+        with get_db() as db:
+            with STAGE_LATENCY.labels(stage="write").time():
+                for msg_type, msg in events:
+                    event_log.sample()
+                    if msg_type == MsgType.CREATE:
+                        self.apply_create(db, msg)
+                    elif msg_type == MsgType.UPDATE:
+                        self.apply_update(db, msg)
+                    elif msg_type == MsgType.DELETE:
+                        self.apply_delete(db, msg)
+                    EVENTS_APPLIED.labels(op=msg_type.name.lower()).inc()
+
+            try:
+                with COMMIT_DURATION.time():
+                    db.commit()
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise e
+
+    def apply_create(self, db: Session, msg: Tuple[Dict, Dict]):
+        event_log.info("CREATE REQUEST")
+        after_obj = msg[1].get("payload", {}).get("after", {})
 
-    Returns:
-        MsgType: The Message Type
+        logging.debug("after_obj: %s", after_obj)
+        if crud_todo.insert_if_absent(db, obj_in=TodoCreate(**after_obj), commit=False):
+            event_log.info("CREATED")
+        else:
+            event_log.info("Item exists. Skipping create...")
+            CONFLICTS.labels(type="blocked_create").inc()
 
-    """
+    def apply_update(self, db: Session, msg: Tuple[Dict, Dict]):
+        event_log.info("UPDATE REQUEST")
+        after_obj = msg[1].get("payload", {}).get("after", {})
 
-    operation = msg_value.get("payload", {}).get("op")
-    if operation is None:
-        logging.error("Invalid message type, operation is None")
-        raise ValueError("Invalid message type, operation is None")
-    if operation == "c":
-        logging.debug("CREATE message received")
-        return MsgType.CREATE
-    elif operation == "u":
-        logging.debug("UPDATE message received")
-        return MsgType.UPDATE
-    elif operation == "d":
-        logging.debug("DELETE message received")
-        return MsgType.DELETE
-    else:
-        logging.error(f"Invalid message type, operation is {operation}")
-        raise ValueError(f"Invalid message type, operation is {operation}")
+        logging.debug("after_obj: %s", after_obj)
+        if crud_todo.upsert_if_newer(db, obj_in=TodoCreate(**after_obj), commit=False):
+            event_log.info("UPDATED")
+        else:
+            event_log.info("After is not newer than the server instance. Skipping update.")
+            CONFLICTS.labels(type="stale_skip").inc()
+
+    def apply_delete(self, db: Session, msg: Tuple[Dict, Dict]):
+        event_log.info("DELETE REQUEST")
+        todo_id, client_id = row_key(msg)
+        if crud_todo.delete_by_key(db, id=todo_id, client_id=client_id, commit=False):
+            event_log.info("DELETED")
+        else:
+            event_log.info("SYNC detected. Skipping...")
+            CONFLICTS.labels(type="sync_skip").inc()
 
 
 class Handler:
-    """The Handler class is responsible for handling messages from the Kafka Consumer."""
+    """The Handler class is responsible for handling messages from the Kafka Consumer.
 
-    def __init__(self, strategy: AbstractStrategy):
+    Every row carries the client whose write produced it as its origin. Creates and
+    updates on a client topic whose origin is another client are echoes of the rows
+    the server replicated to that client and are skipped before they reach the strategy.
+
+    With `coalesce` the events of a batch are folded into their net effect per todo
+    before they reach the strategy, see coalesce.py.
+    """
+
+    def __init__(self, strategy: AbstractStrategy, coalesce: bool = True):
         self.strategy = strategy
+        self.coalesce = coalesce
+        self.decoder = EnvelopeDecoder()
 
     def handle_message(self, msg: Message):
         """Processes a message from the Kafka Consumer by calling the appropriate strategy method.
@@ -169,14 +369,10 @@ class Handler:
 
         """
 
-        msk_key_str = msg.key().decode("utf-8")
-        msk_key_object = json.loads(msk_key_str)
-
-        msg_value_str = msg.value().decode("utf-8")
-        msg_value_object = json.loads(msg_value_str)
-
-        msg_type = derive_msg_type(msg_value_object)
+        msg_type, (msk_key_object, msg_value_object) = self.decode_message(msg)
 
+        if self.is_echo(msg, msg_type, msg_value_object):
+            return
         if msg_type == MsgType.CREATE:
             self.strategy.handle_create((msk_key_object, msg_value_object))
         elif msg_type == MsgType.UPDATE:
@@ -186,3 +382,67 @@ class Handler:
         else:
             logging.error(f"Invalid message type received: {msg_type}")
             raise ValueError(f"Invalid message type: {msg_type}")
+
+    def handle_batch(self, msgs: List[Message]):
+        """Processes a batch of messages from the Kafka Consumer with a single strategy call.
+
+        Args:
+            msgs (List[Message]): The Kafka (Confluent) Messages in the order they were consumed
+        """
+
+        events = self.decode_batch(msgs)
+        if events:
+            self.strategy.handle_batch(events)
+
+    def handle_bulk(self, msgs: List[Message]):
+        """Processes a large batch of messages, e.g. a backlog, with set-based statements.
+
+        The events are always coalesced, the statements rely on every todo occurring once.
+
+        Args:
+            msgs (List[Message]): The Kafka (Confluent) Messages in the order they were consumed
+        """
+
+        events = self.decode_batch(msgs, coalesce=True)
+        if events:
+            self.strategy.handle_bulk(events)
+
+    def decode_batch(
+        self, msgs: List[Message], coalesce: Optional[bool] = None
+    ) -> List[Tuple[MsgType, Tuple[Dict, Dict]]]:
+        """Decodes a batch of messages, drops the echoes and coalesces the events if enabled."""
+
+        events = []
+        for msg in msgs:
+            msg_type, event = self.decode_message(msg)
+            if not self.is_echo(msg, msg_type, event[1]):
+                events.append((msg_type, event))
+        if not (self.coalesce if coalesce is None else coalesce):
+            return events
+        coalesced = coalesce_events(events)
+        EVENTS_COALESCED.inc(len(events) - len(coalesced))
+        return coalesced
+
+    def decode_message(self, msg: Message) -> Tuple[MsgType, Tuple[Dict, Dict]]:
+        """Decodes the key and value of a message and derives its Message Type."""
+
+        with STAGE_LATENCY.labels(stage="decode").time():
+            msk_key_object = self.decoder.decode_key(msg.key())
+            msg_value_object = self.decoder.decode_value(msg.value())
+
+        return derive_msg_type(msg_value_object), (msk_key_object, msg_value_object)
+
+    def is_echo(self, msg: Message, msg_type: MsgType, msg_value: Dict) -> bool:
+        """Whether an event is a client applying a row it received from the server.
+
+        Deletes carry no origin and always reach the strategy.
+        """
+        if msg_type == MsgType.DELETE:
+            return False
+        after_obj = msg_value.get("payload", {}).get("after") or {}
+        origin = after_obj.get("origin")
+        if origin is None or origin == topic_client_id(msg.topic()):
+            return False
+        event_log.info("ECHO of a replicated row. Skipping...")
+        CONFLICTS.labels(type="echo_skip").inc()
+        return True
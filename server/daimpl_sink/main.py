@@ -1,29 +1,129 @@
+import asyncio
 import logging
 
+from async_consumer import consume_kafka_messages_async
+from async_handler import AsyncHandler, AsyncLWWStrategy_Server, AsyncUpsertLWWStrategy_Server
+from cache import RowCache
+from catchup import CatchUp
 from consumer import consume_kafka_messages
-from handler import Handler, LWWStrategy_Server
+from deadletter import AsyncDeadLetterHandler, DeadLetterHandler, DeadLetterQueue
+from handler import Handler, LWWStrategy_Server, UpsertLWWStrategy_Server
+from metrics import event_log
+from prometheus_client import Gauge, start_http_server
 import os
 
 BOOTSTRAP_SERVERS = os.environ.get("BOOTSTRAP_SERVERS")
-NUM_CLIENTS = os.environ.get("NUM_CLIENTS")
+# Topics of clients that join later are discovered by the consumer
+CLIENT_TOPIC_PATTERN = os.environ.get(
+    "CLIENT_TOPIC_PATTERN", r"^client-.*-topic\.public\.todos$"
+)
+TOPIC_REFRESH_MS = int(os.environ.get("TOPIC_REFRESH_MS", "5000"))
+# A batch size of 1 handles every message on its own
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "1"))
+BATCH_TIMEOUT_MS = int(os.environ.get("BATCH_TIMEOUT_MS", "1000"))
+# With 0 workers the messages are applied on the consumer thread
+WORKERS = int(os.environ.get("WORKERS", "0"))
+# Number of server rows kept in memory for the LWW comparisons, 0 disables the cache
+ROW_CACHE_SIZE = int(os.environ.get("ROW_CACHE_SIZE", "10000"))
+# "lww" compares rows in Python, "upsert" leaves the LWW decision to Postgres
+STRATEGY = os.environ.get("STRATEGY", "lww")
+# "sync" applies the messages with blocking sessions on the consumer or worker threads,
+# "async" applies them as asyncio tasks on an asyncpg engine
+SINK_MODE = os.environ.get("SINK_MODE", "sync")
+# Message groups applied concurrently in the async mode
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "16"))
+# Consumed messages waiting to be applied by the workers or tasks before the
+# partitions are paused
+PREFETCH_MAX_MESSAGES = int(os.environ.get("PREFETCH_MAX_MESSAGES", "10000"))
+PREFETCH_MAX_BYTES = int(os.environ.get("PREFETCH_MAX_BYTES", str(64 * 1024 * 1024)))
+# Folds the events of a todo within a batch into their net effect
+COALESCE = os.environ.get("COALESCE", "true").lower() == "true"
+# Seconds between the retries of dead-lettered messages, the retries of a message
+# back off exponentially up to DLQ_MAX_BACKOFF seconds
+DLQ_RETRY_INTERVAL = float(os.environ.get("DLQ_RETRY_INTERVAL", "5"))
+DLQ_MAX_BACKOFF = float(os.environ.get("DLQ_MAX_BACKOFF", "600"))
+# Failed attempts after which a dead-lettered message is kept but no longer retried
+DLQ_MAX_ATTEMPTS = int(os.environ.get("DLQ_MAX_ATTEMPTS", "10"))
+# Consumer lag from which the backlog is merged in bulks of CATCHUP_BATCH_SIZE messages
+# instead of applying the messages one by one or in batches, 0 disables catching up
+CATCHUP_LAG_THRESHOLD = int(os.environ.get("CATCHUP_LAG_THRESHOLD", "10000"))
+CATCHUP_BATCH_SIZE = int(os.environ.get("CATCHUP_BATCH_SIZE", "10000"))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9000"))
+# Only every n-th event is logged on the hot path, conflicts are always logged
+LOG_SAMPLE_RATE = int(os.environ.get("LOG_SAMPLE_RATE", "100"))
 
-CLIENT_TOPICS = [f"client-{i}-topic.public.todos" for i in range(1, int(NUM_CLIENTS) + 1)]
+# Set loglevel to DEBUG and LOG_SAMPLE_RATE to 1 to see every event including the rows
+logging.basicConfig(level=logging.INFO)
+# logging.basicConfig(level=logging.DEBUG)
 
 
-# Set loglevel to INFO to see less logs
-logging.basicConfig(level=logging.DEBUG)
-# logging.basicConfig(level=logging.INFO)
+def main():
+    event_log.every = max(LOG_SAMPLE_RATE, 1)
+    start_http_server(METRICS_PORT)
 
+    row_cache = None
+    if STRATEGY != "upsert" and ROW_CACHE_SIZE > 0:
+        row_cache = RowCache(ROW_CACHE_SIZE)
+        Gauge("sink_row_cache_hits", "Row cache hits").set_function(
+            lambda: row_cache.hits
+        )
+        Gauge("sink_row_cache_misses", "Row cache misses").set_function(
+            lambda: row_cache.misses
+        )
 
-def main():
-    lww_strategy = LWWStrategy_Server()
-    lww_handler = Handler(lww_strategy)
+    if STRATEGY == "upsert":
+        lww_strategy = UpsertLWWStrategy_Server()
+    else:
+        lww_strategy = LWWStrategy_Server(cache=row_cache)
+
+    # Failed messages are retried on a thread of their own with a blocking handler,
+    # also in the async mode
+    dlq = DeadLetterQueue(
+        Handler(lww_strategy, coalesce=False),
+        retry_interval=DLQ_RETRY_INTERVAL,
+        max_backoff=DLQ_MAX_BACKOFF,
+        max_attempts=DLQ_MAX_ATTEMPTS,
+    )
+    dlq.start()
+
+    catchup = None
+    if CATCHUP_LAG_THRESHOLD > 0:
+        catchup = CatchUp(CATCHUP_LAG_THRESHOLD, batch_size=CATCHUP_BATCH_SIZE)
+
+    if SINK_MODE == "async":
+        if STRATEGY == "upsert":
+            async_strategy = AsyncUpsertLWWStrategy_Server()
+        else:
+            async_strategy = AsyncLWWStrategy_Server(cache=row_cache)
+        asyncio.run(
+            consume_kafka_messages_async(
+                BOOTSTRAP_SERVERS,
+                CLIENT_TOPIC_PATTERN,
+                AsyncDeadLetterHandler(AsyncHandler(async_strategy, coalesce=COALESCE), dlq),
+                batch_size=BATCH_SIZE,
+                batch_timeout=BATCH_TIMEOUT_MS / 1000,
+                metadata_refresh_ms=TOPIC_REFRESH_MS,
+                max_in_flight=MAX_IN_FLIGHT,
+                max_buffered_messages=PREFETCH_MAX_MESSAGES,
+                max_buffered_bytes=PREFETCH_MAX_BYTES,
+                catchup=catchup,
+            )
+        )
+        return
 
+    lww_handler = DeadLetterHandler(Handler(lww_strategy, coalesce=COALESCE), dlq)
 
     consume_kafka_messages(
         BOOTSTRAP_SERVERS,
-        CLIENT_TOPICS,
+        CLIENT_TOPIC_PATTERN,
         lww_handler,
+        batch_size=BATCH_SIZE,
+        batch_timeout=BATCH_TIMEOUT_MS / 1000,
+        metadata_refresh_ms=TOPIC_REFRESH_MS,
+        num_workers=WORKERS,
+        max_buffered_messages=PREFETCH_MAX_MESSAGES,
+        max_buffered_bytes=PREFETCH_MAX_BYTES,
+        catchup=catchup,
     )
 
 
@@ -0,0 +1,85 @@
+import json
+import logging
+import threading
+from itertools import count
+
+from prometheus_client import Counter, Gauge, Histogram
+
+EVENTS_APPLIED = Counter(
+    "sink_events_applied_total", "CDC events applied by the sink", ["op"]
+)
+CONFLICTS = Counter(
+    "sink_conflicts_total",
+    "LWW decisions that did not simply apply the event "
+    "(echo_skip, sync_skip, lww_overwrite, stale_skip, blocked_create, conflict_delete)",
+    ["type"],
+)
+EVENTS_COALESCED = Counter(
+    "sink_events_coalesced_total",
+    "CDC events folded into a later event of the same todo within a batch",
+)
+STAGE_LATENCY = Histogram(
+    "sink_stage_duration_seconds",
+    "Duration of the stages of applying a message or batch",
+    ["stage"],
+)
+COMMIT_DURATION = Histogram(
+    "sink_commit_duration_seconds", "Duration of the database commits"
+)
+CONSUMER_LAG = Gauge(
+    "sink_consumer_lag_messages",
+    "Messages between the consumer position and the end of a partition",
+    ["topic", "partition"],
+)
+CATCHUP_ACTIVE = Gauge(
+    "sink_catchup_active", "1 while the consumer catches up on a backlog with bulk merges"
+)
+DEAD_LETTERS = Gauge(
+    "sink_dead_letters", "Messages in the dead-letter store waiting to be retried"
+)
+DEAD_LETTERED = Counter(
+    "sink_dead_lettered_total",
+    "Messages moved to the dead-letter store "
+    "(error: applying failed, parked: an earlier message of the todo is dead-lettered)",
+    ["reason"],
+)
+DEAD_LETTER_RETRIES = Counter(
+    "sink_dead_letter_retries_total",
+    "Attempts to apply a message of the dead-letter store "
+    "(success, failure: retried later, given_up: not retried again)",
+    ["result"],
+)
+
+
+def record_consumer_lag(stats_json: str):
+    """`stats_cb` of the Consumer, publishes the consumer lag reported by librdkafka."""
+    stats = json.loads(stats_json)
+    for topic, topic_stats in stats.get("topics", {}).items():
+        for partition, partition_stats in topic_stats.get("partitions", {}).items():
+            lag = partition_stats.get("consumer_lag", -1)
+            if partition == "-1" or lag < 0:
+                continue  # Internal partition or not consumed by this consumer
+            CONSUMER_LAG.labels(topic=topic, partition=partition).set(lag)
+
+
+class SampledEventLog:
+    """Logs the hot-path messages of only every n-th event.
+
+    `sample()` is called once per event and decides for all messages of that event,
+    so the messages of a logged event always appear together.
+    """
+
+    def __init__(self, every: int = 1):
+        self.every = max(every, 1)
+        self._events = count()
+        self._local = threading.local()
+
+    def sample(self):
+        self._local.enabled = next(self._events) % self.every == 0
+
+    def info(self, msg: str, *args):
+        if getattr(self._local, "enabled", True):
+            logging.info(msg, *args)
+
+
+event_log = SampledEventLog()
@@ -1,3 +1,6 @@
+# trunk-ignore(ruff/F401)
+from .dead_letters import DeadLetterORM
+
 # trunk-ignore(ruff/F401)
 from .todos import TodoORM
 
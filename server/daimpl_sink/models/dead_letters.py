@@ -0,0 +1,42 @@
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+)
+from sqlalchemy.sql import func
+
+from .base import Base
+
+
+class DeadLetterORM(Base):
+    """A message that could not be applied, kept for retries with backoff.
+
+    `todo_id` and `todo_client_id` are the key of the todo the message refers to, they
+    are None if the key itself could not be decoded. `given_up_at` is set once the message
+    failed too often, it is kept for inspection but no longer retried.
+    """
+
+    __tablename__ = "dead_letters"
+    __table_args__ = (
+        Index("idx_dead_letters_next_attempt_at", "next_attempt_at"),
+        # Looked up for every consumed message of a parked todo, see has_key
+        Index("idx_dead_letters_todo", "todo_id", "todo_client_id"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    topic = Column(String, nullable=False)
+    partition = Column(Integer, nullable=False)
+    offset = Column(BigInteger, nullable=False)
+    todo_id = Column(Integer)
+    todo_client_id = Column(String)
+    key = Column(LargeBinary)
+    value = Column(LargeBinary)
+    error = Column(String)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    next_attempt_at = Column(DateTime(timezone=True), server_default=func.now())
+    given_up_at = Column(DateTime(timezone=True))
@@ -7,11 +7,14 @@ class TodoORM(Base):
     __tablename__ = "todos"
 
     id = Column(Integer, primary_key=True)
-    client_id = Column(String, primary_key=True, index=True)
-    title = Column(String, index=True)
-    description = Column(String, index=True)
-    completed = Column(Boolean, index=True)
+    client_id = Column(String, primary_key=True)
+    title = Column(String)
+    description = Column(String)
+    completed = Column(Boolean)
     created_at = Column(DateTime(timezone=True))
     updated_at = Column(DateTime(timezone=True))
+    # Client whose write produced the current state of the row
+    origin = Column(String)
 
+    # The sink only reads todos by their key, further indexes would only slow down writes
     __table_args__ = (PrimaryKeyConstraint("id", "client_id"),)  # Composite primary key
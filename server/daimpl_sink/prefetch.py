@@ -0,0 +1,136 @@
+import logging
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from confluent_kafka import Consumer, Message, TopicPartition
+
+
+def message_size(msg: Message) -> int:
+    return len(msg.key() or b"") + len(msg.value() or b"")
+
+
+class Backpressure:
+    """Bounds the consumed messages that wait for or are being applied.
+
+    The poll loop cannot block once the buffer is full, it has to keep polling to stay
+    in the consumer group. Instead `update` pauses the partitions that have buffered
+    messages, so the consumer stops fetching them, and resumes them once the buffer
+    has drained to `resume_ratio` of its limits.
+
+    The limits are soft: the messages returned by a single poll are always accepted.
+    """
+
+    def __init__(self, max_messages: int, max_bytes: int, resume_ratio: float = 0.5):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.resume_ratio = resume_ratio
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Condition()
+        self._partitions: Dict[Tuple[str, int], int] = {}
+        self._paused: Set[Tuple[str, int]] = set()
+
+    def reserve(self, msg: Message):
+        """Accounts for a message handed from the poll loop to the apply side."""
+        tp = (msg.topic(), msg.partition())
+        with self._lock:
+            self.messages += 1
+            self.bytes += message_size(msg)
+            self._partitions[tp] = self._partitions.get(tp, 0) + 1
+
+    def release(self, msg: Message):
+        """Releases a message once it has been applied or dropped."""
+        tp = (msg.topic(), msg.partition())
+        with self._lock:
+            self.messages -= 1
+            self.bytes -= message_size(msg)
+            remaining = self._partitions.get(tp, 0) - 1
+            if remaining > 0:
+                self._partitions[tp] = remaining
+            else:
+                self._partitions.pop(tp, None)
+            self._lock.notify_all()
+
+    def update(self, consumer: Consumer):
+        """Pauses or resumes partitions. Must be called from the poll loop after every poll."""
+        pause: List[Tuple[str, int]] = []
+        resume: List[Tuple[str, int]] = []
+        with self._lock:
+            if self.messages >= self.max_messages or self.bytes >= self.max_bytes:
+                pause = [tp for tp in self._partitions if tp not in self._paused]
+                self._paused.update(pause)
+            elif (
+                self._paused
+                and self.messages <= self.max_messages * self.resume_ratio
+                and self.bytes <= self.max_bytes * self.resume_ratio
+            ):
+                resume = list(self._paused)
+                self._paused.clear()
+            messages, size = self.messages, self.bytes
+
+        if pause:
+            logging.info(
+                f"Prefetch buffer full ({messages} messages, {size} bytes). Pausing {pause}"
+            )
+            consumer.pause([TopicPartition(topic, partition) for topic, partition in pause])
+        if resume:
+            logging.info(
+                f"Prefetch buffer drained ({messages} messages, {size} bytes). Resuming {resume}"
+            )
+            consumer.resume([TopicPartition(topic, partition) for topic, partition in resume])
+
+    def forget(self, partitions: List[TopicPartition]):
+        """Drops the paused state of revoked partitions, they are unpaused when assigned again."""
+        with self._lock:
+            for p in partitions:
+                self._paused.discard((p.topic, p.partition))
+
+
+class PrefetchQueue(Backpressure):
+    """FIFO of consumed messages between the poll loop and an apply thread, bounded by
+    pausing partitions, see Backpressure.
+
+    A message counts against the limits until `task_done` is called for it.
+    """
+
+    def __init__(self, max_messages: int, max_bytes: int, resume_ratio: float = 0.5):
+        super().__init__(max_messages, max_bytes, resume_ratio)
+        self._queue: Deque[Message] = deque()
+
+    def put(self, msg: Message):
+        self.reserve(msg)
+        with self._lock:
+            self._queue.append(msg)
+            self._lock.notify_all()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Message]:
+        """Takes the next message, or returns None if there is none within `timeout` seconds."""
+        with self._lock:
+            if not self._lock.wait_for(lambda: self._queue, timeout):
+                return None
+            return self._queue.popleft()
+
+    def get_many(self, max_messages: int) -> List[Message]:
+        """Takes up to `max_messages` of the messages that are already waiting."""
+        with self._lock:
+            msgs = []
+            while self._queue and len(msgs) < max_messages:
+                msgs.append(self._queue.popleft())
+            return msgs
+
+    def task_done(self, msg: Message):
+        self.release(msg)
+
+    def clear(self):
+        """Drops the messages that were not taken yet."""
+        with self._lock:
+            dropped = list(self._queue)
+            self._queue.clear()
+        for msg in dropped:
+            self.release(msg)
+
+    def join(self):
+        """Blocks until every message that was put has been released."""
+        with self._lock:
+            self._lock.wait_for(lambda: self.messages == 0)
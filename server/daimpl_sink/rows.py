@@ -0,0 +1,74 @@
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+# A Row is a plain tuple of the todo columns in this order. Two rows are equal exactly
+# when all their columns are equal, so LWW decisions can be made without building
+# Pydantic models for every event.
+ROW_FIELDS = (
+    "id",
+    "client_id",
+    "title",
+    "description",
+    "completed",
+    "created_at",
+    "updated_at",
+    "origin",
+)
+ID, CLIENT_ID, TITLE, DESCRIPTION, COMPLETED, CREATED_AT, UPDATED_AT, ORIGIN = range(
+    len(ROW_FIELDS)
+)
+# The columns an update event changes, see TodoUpdate
+UPDATE_FIELDS = (TITLE, DESCRIPTION, COMPLETED, UPDATED_AT, ORIGIN)
+
+Row = Tuple[Any, ...]
+
+_FRACTION = re.compile(r"\.(\d+)")
+
+
+@lru_cache(maxsize=8192)
+def _parse_timestamp_str(value: str) -> datetime:
+    # Debezium writes ZonedTimestamps with a `Z` suffix and a variable number of
+    # fractional digits, which `fromisoformat` only accepts from Python 3.11 on
+    value = value.replace("Z", "+00:00")
+    value = _FRACTION.sub(lambda m: "." + m.group(1)[:6].ljust(6, "0"), value, count=1)
+    return datetime.fromisoformat(value)
+
+
+def parse_timestamp(value) -> Optional[datetime]:
+    """Parses a timestamp of a CDC event. Repeated values are served from a cache."""
+    if value is None or isinstance(value, datetime):
+        return value
+    return _parse_timestamp_str(value)
+
+
+def row_from_dict(obj: Dict) -> Row:
+    """Builds a Row from the `before` or `after` object of a CDC event."""
+    return (
+        obj.get("id"),
+        obj.get("client_id"),
+        obj.get("title"),
+        obj.get("description"),
+        obj.get("completed", False),
+        parse_timestamp(obj.get("created_at")),
+        parse_timestamp(obj.get("updated_at")),
+        obj.get("origin"),
+    )
+
+
+def row_from_orm(db_obj) -> Row:
+    """Builds a Row from a TodoORM object."""
+    return tuple(getattr(db_obj, field) for field in ROW_FIELDS)
+
+
+def row_to_dict(row: Row) -> Dict:
+    return dict(zip(ROW_FIELDS, row))
+
+
+def apply_update(row: Row, after: Row) -> Row:
+    """Returns `row` with the columns of an update event taken from `after`."""
+    updated = list(row)
+    for field in UPDATE_FIELDS:
+        updated[field] = after[field]
+    return tuple(updated)
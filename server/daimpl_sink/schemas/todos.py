@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Optional
 
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -16,11 +17,17 @@ class TodoCreate(TodoBase):
     client_id: str = Field(..., description="Client ID of the user")
     created_at: datetime
     updated_at: datetime
+    origin: Optional[str] = Field(
+        default=None, description="Client whose write produced this state"
+    )
     pass
 
 
 class TodoUpdate(TodoBase):
     updated_at: datetime
+    origin: Optional[str] = Field(
+        default=None, description="Client whose write produced this state"
+    )
     pass
 
 
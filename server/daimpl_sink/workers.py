@@ -0,0 +1,145 @@
+import json
+import logging
+import queue
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from confluent_kafka import Message, TopicPartition
+from prefetch import Backpressure
+
+
+class OffsetTracker:
+    """Tracks the in-flight messages of every partition.
+
+    Messages can be applied out of order by the workers. The tracker only reports an
+    offset as committable once every message before it in the same partition has been
+    applied as well.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[str, int], Deque[int]] = {}
+        self._applied: Dict[Tuple[str, int], Set[int]] = {}
+        self._committable: Dict[Tuple[str, int], int] = {}
+
+    def track(self, msg: Message):
+        """Registers a message before it is handed to a worker."""
+        tp = (msg.topic(), msg.partition())
+        with self._lock:
+            self._pending.setdefault(tp, deque()).append(msg.offset())
+            self._applied.setdefault(tp, set())
+
+    def ack(self, msg: Message):
+        """Marks a message as applied."""
+        tp = (msg.topic(), msg.partition())
+        with self._lock:
+            pending = self._pending.get(tp)
+            if pending is None:
+                return  # Partition was revoked in the meantime
+            applied = self._applied[tp]
+            applied.add(msg.offset())
+            while pending and pending[0] in applied:
+                offset = pending.popleft()
+                applied.discard(offset)
+                self._committable[tp] = offset + 1
+
+    def committable(self) -> List[TopicPartition]:
+        """Returns the offsets that advanced since the last call.
+
+        The offsets point to the next message to consume, as expected by `store_offsets`.
+        """
+        with self._lock:
+            offsets = [
+                TopicPartition(topic, partition, offset)
+                for (topic, partition), offset in self._committable.items()
+            ]
+            self._committable.clear()
+        return offsets
+
+    def forget(self, partitions: List[TopicPartition]):
+        """Drops the state of revoked partitions."""
+        with self._lock:
+            for p in partitions:
+                tp = (p.topic, p.partition)
+                self._pending.pop(tp, None)
+                self._applied.pop(tp, None)
+                self._committable.pop(tp, None)
+
+
+def shard_key(msg: Message) -> Tuple[int, str]:
+    """Get the (id, client_id) key a message is routed by."""
+    key_payload = json.loads(msg.key()).get("payload", {})
+    return key_payload.get("id"), key_payload.get("client_id")
+
+
+class ShardedApplier:
+    """Applies messages on a pool of worker threads.
+
+    Messages are routed by a hash of their (id, client_id) key. All changes of a todo
+    are therefore applied by the same worker in the order they were consumed, while
+    unrelated todos are applied in parallel.
+
+    The queued messages are bounded by the Backpressure, which pauses the partitions
+    of the consumer while the workers fall behind.
+    """
+
+    def __init__(
+        self,
+        handler,
+        num_workers: int,
+        tracker: OffsetTracker,
+        backpressure: Backpressure,
+    ):
+        self.handler = handler
+        self.tracker = tracker
+        self.backpressure = backpressure
+        self._error: Optional[BaseException] = None
+        self._queues: List[queue.Queue] = [queue.Queue() for _ in range(num_workers)]
+        self._threads = [
+            threading.Thread(target=self._work, args=(q,), name=f"apply-worker-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, msg: Message):
+        """Hands a message to the worker responsible for its key."""
+        self.tracker.track(msg)
+        self.backpressure.reserve(msg)
+        worker = hash(shard_key(msg)) % len(self._queues)
+        self._queues[worker].put(msg)
+
+    def drain(self):
+        """Blocks until every submitted message has been processed."""
+        for q in self._queues:
+            q.join()
+
+    def raise_if_failed(self):
+        """Re-raises the first error of a worker on the calling thread."""
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self, q: queue.Queue):
+        while True:
+            msg = q.get()
+            try:
+                if msg is None:
+                    return
+                if self._error is not None:
+                    continue  # Do not apply anything past a failed message
+                self.handler.handle_message(msg)
+                self.tracker.ack(msg)
+            except Exception as e:
+                logging.exception("Applying message failed")
+                self._error = e
+            finally:
+                if msg is not None:
+                    self.backpressure.release(msg)
+                q.task_done()
@@ -6,13 +6,35 @@ CREATE TABLE todos (
     completed BOOLEAN,
     created_at TIMESTAMPTZ,
     updated_at TIMESTAMPTZ,
+    -- Client whose write produced the current state of the row
+    origin VARCHAR,
     PRIMARY KEY (id, client_id)
 );
 
-
-CREATE INDEX idx_todos_client_id ON todos(client_id);
-CREATE INDEX idx_todos_title ON todos(title);
-CREATE INDEX idx_todos_description ON todos(description);
-CREATE INDEX idx_todos_completed ON todos(completed);
+-- No secondary indexes: the sink only reads todos by their primary key and every index
+-- would be maintained by each applied event
 
 ALTER TABLE todos REPLICA IDENTITY FULL;
+
+-- Messages that could not be applied, retried with backoff. Later messages of a todo
+-- with a dead letter are parked here as well to keep the order of its changes.
+CREATE TABLE dead_letters (
+    id SERIAL PRIMARY KEY,
+    topic VARCHAR NOT NULL,
+    partition INTEGER NOT NULL,
+    "offset" BIGINT NOT NULL,
+    todo_id INTEGER,
+    todo_client_id VARCHAR,
+    key BYTEA,
+    value BYTEA,
+    error VARCHAR,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    next_attempt_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    -- Set once the message failed DLQ_MAX_ATTEMPTS times, it is no longer retried
+    given_up_at TIMESTAMPTZ,
+    UNIQUE (topic, partition, "offset")
+);
+
+CREATE INDEX idx_dead_letters_next_attempt_at ON dead_letters(next_attempt_at);
+CREATE INDEX idx_dead_letters_todo ON dead_letters(todo_id, todo_client_id);
@@ -0,0 +1,15 @@
+-- Moves the indexes of a server database to the layout of init.sql: the sink only reads
+-- todos by their primary key, so the secondary indexes only cost writes. Only the
+-- indexes are changed, the tables and columns of init.sql must exist already.
+-- Run it with psql outside of a transaction, CONCURRENTLY keeps the todos writable:
+--   psql -U postgres -f 0001_index_layout.sql
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_todos_client_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_todos_title;
+DROP INDEX CONCURRENTLY IF EXISTS idx_todos_description;
+DROP INDEX CONCURRENTLY IF EXISTS idx_todos_completed;
+-- Created by SQLAlchemy for the `index=True` columns if it created the table
+DROP INDEX CONCURRENTLY IF EXISTS ix_todos_client_id;
+DROP INDEX CONCURRENTLY IF EXISTS ix_todos_title;
+DROP INDEX CONCURRENTLY IF EXISTS ix_todos_description;
+DROP INDEX CONCURRENTLY IF EXISTS ix_todos_completed;
@@ -17,7 +17,7 @@ fi
 # Start the server 
 echo "Starting server..."
 cd server
-NUM_CLIENTS=${num_clients} docker-compose up --build -d --force-recreate
+docker-compose up --build -d --force-recreate
 
 echo "Waiting for Server Debezium connector to start..."
 while true; do
@@ -63,6 +63,7 @@ do
     DB_PORT=$((5431+i))
     CONNECTOR_PORT=$((8082+i))
     BACKEND_PORT=$((7999+i))
+    METRICS_PORT=$((9099+i))
     BACKEND_PORTS+=(${BACKEND_PORT})
     BACKEND_HOSTS+=(${CLIENT_NAME}-backend)
     CLIENT_TOPICS+=(${CLIENT_NAME}-topic.public.todos)
@@ -109,8 +110,27 @@ services:
       - POSTGRES_HOST=${CLIENT_NAME}-postgres
       - POSTGRES_PORT=5432
       - CLIENT_ID=${CLIENT_NAME}
+      - BOOTSTRAP=auto
+      - SERVER_POSTGRES_HOST=server-postgres
+      - SERVER_POSTGRES_PORT=5432
+      - METRICS_PORT=9100
+      - LOG_SAMPLE_RATE=100
+      - PREFETCH_MAX_MESSAGES=1000
+      - PREFETCH_MAX_BYTES=16777216
+      - DLQ_RETRY_INTERVAL=5
+      - DLQ_MAX_BACKOFF=600
+      - DLQ_MAX_ATTEMPTS=10
+      - CATCHUP_LAG_THRESHOLD=5000
+      - CATCHUP_BATCH_SIZE=1000
+      - STATUS_INTERVAL=5
+      - API_THREADS=20
+      - DB_POOL_SIZE=10
+      - DB_MAX_OVERFLOW=10
+      - DB_POOL_TIMEOUT=30
+      - TODO_VIEW=off
     ports:
       - ${BACKEND_PORT}:8000
+      - ${METRICS_PORT}:9100
     depends_on:
       - ${CLIENT_NAME}-postgres
     networks:
@@ -135,7 +155,7 @@ EOF
         "database.password": "postgres",
         "database.dbname" : "postgres",
         "topic.prefix": "${CLIENT_NAME}-topic",
-        "schema.include.list": "public"
+        "table.include.list": "public.todos"
     }
 }
 EOF
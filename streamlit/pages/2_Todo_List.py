@@ -19,6 +19,8 @@ def handle_error(e):
 refresh = st.sidebar.button("Refresh")
 if refresh:
     st.experimental_rerun()
+# Reruns the page when the todos change, see the end of the page
+live_updates = st.sidebar.checkbox("Live updates", value=True)
 
 
 # Creating a form for creating a new todo
@@ -41,12 +43,60 @@ with st.form("create_todo_form"):
         except Exception as e:
             handle_error(e)
 
+# Filters and paging of the todo list. The backend pages with cursors, the cursors of
+# the pages before the current one are kept to go back.
+PAGE_SIZE = 20
+completed_filter = st.sidebar.selectbox("Show", ["All", "Open", "Completed"])
+title_prefix = st.sidebar.text_input("Title starts with")
+filters = (BACKEND_URI, completed_filter, title_prefix)
+if st.session_state.get("todo_filters") != filters:
+    st.session_state.todo_filters = filters
+    st.session_state.todo_cursors = [None]
+    st.session_state.todo_pages = {}
+
+params = {"limit": PAGE_SIZE}
+if st.session_state.todo_cursors[-1] is not None:
+    params["cursor"] = st.session_state.todo_cursors[-1]
+if completed_filter != "All":
+    params["completed"] = completed_filter == "Completed"
+if title_prefix:
+    params["title_prefix"] = title_prefix
+
 # Show all todos with option for deleting them
 st.header("All Todos")
+change_cursor = None
 try:
-    response = requests.get(f"{BACKEND_URI}/todo")
-    response.raise_for_status()
-    todos = response.json()
+    # The last response of every page is kept with its ETag, a rerun without changes in
+    # the backend gets a 304 and shows the kept todos
+    page_cache = st.session_state.todo_pages
+    page_key = tuple(sorted(params.items()))
+    cached = page_cache.get(page_key)
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+    response = requests.get(f"{BACKEND_URI}/todo", params=params, headers=headers)
+    if response.status_code == 304 and cached:
+        todos, next_cursor = cached["todos"], cached["next_cursor"]
+        change_cursor = cached["change_cursor"]
+    else:
+        response.raise_for_status()
+        todos = response.json()
+        next_cursor = response.headers.get("X-Next-Cursor")
+        change_cursor = response.headers.get("X-Change-Cursor")
+        if "ETag" in response.headers:
+            page_cache[page_key] = {
+                "etag": response.headers["ETag"],
+                "todos": todos,
+                "next_cursor": next_cursor,
+                "change_cursor": change_cursor,
+            }
+
+    page_col1, page_col2, _ = st.columns([1, 1, 5])
+    if page_col1.button("Previous", disabled=len(st.session_state.todo_cursors) == 1):
+        st.session_state.todo_cursors.pop()
+        st.experimental_rerun()
+    if page_col2.button("Next", disabled=next_cursor is None):
+        st.session_state.todo_cursors.append(next_cursor)
+        st.experimental_rerun()
+
     for todo in todos:
         container = st.container()
 
@@ -92,3 +142,23 @@ try:
         st.write("---")
 except Exception as e:
     handle_error(e)
+
+# Waits for the next change of the todos and reruns. The stream starts at the change
+# cursor of the shown page, so changes made while the page loaded are not missed.
+if live_updates and change_cursor is not None:
+    live_status = st.sidebar.empty()
+    try:
+        with requests.get(
+            f"{BACKEND_URI}/todo/events",
+            params={"cursor": change_cursor, "keepalive": 1},
+            stream=True,
+            timeout=(5, 30),
+        ) as events:
+            for line in events.iter_lines(decode_unicode=True):
+                if line.startswith("event: change"):
+                    break
+                # Writing to the page every keepalive lets a click interrupt the wait
+                live_status.caption(f"Live, checked at {time.strftime('%X')}")
+        st.experimental_rerun()
+    except requests.RequestException as e:
+        handle_error(e)